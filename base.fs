@@ -0,0 +1 @@
+FS30
\ No newline at end of file
@@ -13,6 +13,8 @@
 ##############################################################################
 
 import logging
+import threading
+from collections import OrderedDict
 
 import six
 import zope.interface
@@ -232,11 +234,104 @@ def persistent_id(object):
         return None
     return object.data
 
+_immutable_types = frozenset(
+    six.integer_types + six.string_types +
+    (bytes, six.text_type, float, bool, type(None), PersistentReference))
+
+def _immutable(state):
+    # Return whether a state is made only of immutable objects, so
+    # that resolvers can't change it and it can be shared.
+    todo = [state]
+    while todo:
+        ob = todo.pop()
+        if ob.__class__ is tuple:
+            todo.extend(ob)
+        elif ob.__class__ not in _immutable_types:
+            return False
+    return True
+
+class ConflictStates(object):
+    """Unpickled states of object revisions used to resolve conflicts
+
+    Objects that conflict often, like BTree buckets and
+    ``BTrees.Length`` counters, are resolved against the same
+    committed revisions again and again, so the states read for them
+    are kept, up to ``size`` of them, discarding the least recently
+    used first.  Only states made of immutable objects are kept, as
+    resolvers may change the states they're given.
+
+    Counts of resolution attempts and their outcomes are kept too.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = dict(attempts=0, resolved=0, unresolvable=0, failed=0,
+                          state_hits=0, state_misses=0)
+
+    def __len__(self):
+        return len(self._data)
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, key):
+        with self._lock:
+            state = self._data.pop(key, self)
+            if state is self:
+                self.stats['state_misses'] += 1
+                return None
+            self._data[key] = state
+            self.stats['state_hits'] += 1
+            return state
+
+    def store(self, key, state):
+        if self.size <= 0 or not _immutable(state):
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = state
+            while len(self._data) > self.size:
+                self._data.popitem(False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+_states_lock = threading.Lock()
+def _conflict_states(self):
+    states = self._crs_states
+    if states is None:
+        with _states_lock:
+            states = self._crs_states
+            if states is None:
+                states = self._crs_states = ConflictStates(
+                    self.conflict_state_cache_size)
+    return states
+
+def _cached_state(self, states, oid, serial, prfactory, p=b''):
+    # Return the state of a committed revision, from the cache if we
+    # can.  States for given data aren't cached, as they may not have
+    # been committed.
+    if p:
+        return state(self, oid, serial, prfactory, p)
+    key = oid, serial
+    result = states.get(key)
+    if result is None:
+        result = state(self, oid, serial, prfactory)
+        states.store(key, result)
+    return result
+
 _unresolvable = {}
+_resolvers = {}
 def tryToResolveConflict(self, oid, committedSerial, oldSerial, newpickle,
                          committedData=b''):
     # class_tuple, old, committed, newstate = ('',''), 0, 0, 0
     klass = 'n/a'
+    states = _conflict_states(self)
+    states.count('attempts')
     try:
         prfactory = PersistentReferenceFactory()
         newpickle = self._crs_untransform_record_data(newpickle)
@@ -254,31 +349,33 @@ def tryToResolveConflict(self, oid, committedSerial, oldSerial, newpickle,
             newargs = ()
 
         if klass in _unresolvable:
+            states.count('unresolvable')
             raise ConflictError
 
         inst = klass.__new__(klass, *newargs)
 
-        try:
-            resolve = inst._p_resolveConflict
-        except AttributeError:
-            _unresolvable[klass] = 1
-            raise ConflictError
-
-
-        oldData = self.loadSerial(oid, oldSerial)
-        if not committedData:
-            committedData  = self.loadSerial(oid, committedSerial)
-
+        resolve = _resolvers.get(klass)
+        if resolve is None:
+            try:
+                resolve = klass._p_resolveConflict
+            except AttributeError:
+                _unresolvable[klass] = 1
+                states.count('unresolvable')
+                raise ConflictError
+            _resolvers[klass] = resolve
+
+        old = _cached_state(self, states, oid, oldSerial, prfactory)
+        committed = _cached_state(
+            self, states, oid, committedSerial, prfactory, committedData)
         newstate = unpickler.load()
-        old       = state(self, oid, oldSerial, prfactory, oldData)
-        committed = state(self, oid, committedSerial, prfactory, committedData)
 
-        resolved = resolve(old, committed, newstate)
+        resolved = resolve(inst, old, committed, newstate)
 
         file = BytesIO()
         pickler = PersistentPickler(persistent_id, file, _protocol)
         pickler.dump(meta)
         pickler.dump(resolved)
+        states.count('resolved')
         return self._crs_transform_record_data(file.getvalue())
     except (ConflictError, BadClassName) as e:
         logger.debug(
@@ -293,14 +390,31 @@ def tryToResolveConflict(self, oid, committedSerial, oldSerial, newpickle,
         logger.exception(
             "Unexpected error while trying to resolve conflict on %s", klass)
 
+    states.count('failed')
     raise ConflictError(oid=oid, serials=(committedSerial, oldSerial),
                         data=newpickle)
 
 class ConflictResolvingStorage(object):
     "Mix-in class that provides conflict resolution handling for storages"
 
+    # The number of unpickled states kept for resolving conflicts
+    conflict_state_cache_size = 1000
+    _crs_states = None
+
     tryToResolveConflict = tryToResolveConflict
 
+    def conflictResolutionStats(self):
+        """Return counts of conflict resolution attempts and outcomes
+
+        The counts are of attempts, conflicts resolved, conflicts that
+        couldn't be resolved, those of them whose objects' classes
+        don't support resolution, and the states of committed
+        revisions found and not found in the cache.
+        """
+        states = _conflict_states(self)
+        with states._lock:
+            return dict(states.stats)
+
     _crs_transform_record_data = _crs_untransform_record_data = (
         lambda self, o: o)
 
@@ -92,6 +92,10 @@ class Connection(ExportImport, object):
 
     _code_timestamp = 0
 
+    # The affinity passed to DB.open when the connection was last
+    # opened with one.
+    _affinity = None
+
     #: Transaction manager associated with the connection when it was opened.
     transaction_manager = valuedoc.ValueDoc('current transaction manager')
 
@@ -106,6 +110,7 @@ class Connection(ExportImport, object):
 
         self._db = db
         self.large_record_size = db.large_record_size
+        self.serialize_early = db.serialize_early
 
         # historical connection
         self.before = before
@@ -147,6 +152,10 @@ class Connection(ExportImport, object):
         # persistent data set.
         self._pre_cache = {}
 
+        # Records loaded by get_many and activate_many, for setstate
+        # to use when the objects are activated.
+        self._preloaded = {} # {oid -> (data, serial)}
+
         # List of all objects (not oids) registered as modified by the
         # persistence machinery, or by add(), or whose access caused a
         # ReadConflictError (just to be able to clean them up from the
@@ -168,6 +177,11 @@ class Connection(ExportImport, object):
         # objects added as a side-effect of storing a modified object.
         self._added_during_commit = None
 
+        # When objects are serialized before the storage commit
+        # begins, a list of the records to store, and the number of
+        # registered objects that were serialized.
+        self._prepared = None # ([(obj, oid, serial, data)], n)
+
         # During commit, all objects go to either _modified or _creating:
 
         # Dict of oid->flag of new objects (without serial), either
@@ -256,6 +270,77 @@ class Connection(ExportImport, object):
         self._pre_cache.pop(oid)
         return obj
 
+    def get_many(self, oids):
+        """Return the loaded persistent objects with the given oids."""
+        if self.opened is None:
+            raise ConnectionStateError("The database connection is closed")
+
+        found = {}
+        missing = []
+        ghosts = []
+        for oid in oids:
+            if oid in found:
+                continue
+            obj = self._cache.get(oid, None)
+            if obj is None:
+                obj = self._added.get(oid, None)
+            if obj is None:
+                obj = self._pre_cache.get(oid, None)
+            if obj is None:
+                missing.append(oid)
+            elif (obj._p_jar is self and obj._p_changed is None
+                  and oid not in self._preloaded):
+                ghosts.append(oid)
+            found[oid] = obj
+
+        # Load the missing objects and the cached ghosts together, so
+        # activate_many finds their records preloaded.
+        preload = missing + ghosts
+        try:
+            self._preloaded.update(zip(preload, self._load_many(preload)))
+            for oid in missing:
+                r = self._preloaded[oid]
+                obj = self._reader.getGhost(r[0])
+                self._pre_cache[oid] = obj
+                self._cache.new_ghost(oid, obj)
+                self._pre_cache.pop(oid)
+                found[oid] = obj
+
+            objects = [found[oid] for oid in oids]
+            self.activate_many(objects)
+        finally:
+            for oid in preload:
+                self._preloaded.pop(oid, None)
+        return objects
+
+    def activate_many(self, objects):
+        """Load the states of ghosts with a single storage call."""
+        if self.opened is None:
+            raise ConnectionStateError("The database connection is closed")
+
+        ghosts = {}
+        for obj in objects:
+            if obj._p_jar is self and obj._p_changed is None:
+                ghosts[obj._p_oid] = obj
+        oids = [oid for oid in ghosts if oid not in self._preloaded]
+        try:
+            self._preloaded.update(zip(oids, self._load_many(oids)))
+            for obj in ghosts.values():
+                obj._p_activate()
+        finally:
+            for oid in oids:
+                self._preloaded.pop(oid, None)
+
+    def _load_many(self, oids):
+        # Load records for a list of oids with one storage call, if
+        # the storage supports it.
+        if not oids:
+            return []
+        load_many = getattr(self._storage, 'load_many', None)
+        if load_many is None:
+            return [self._storage.load(oid) for oid in oids]
+        return load_many(oids)
+
     def cacheMinimize(self):
         """Deactivate all unmodified objects in the cache.
         """
@@ -464,6 +549,7 @@ class Connection(ExportImport, object):
         self._conflicts.clear()
         self._needs_to_join = True
         self._registered_objects = []
+        self._prepared = None
         self._creating.clear()
 
     def tpc_begin(self, transaction):
@@ -478,6 +564,23 @@ class Connection(ExportImport, object):
         # _creating is a list of oids of new objects, which is used to
         # remove them from the cache if a transaction aborts.
         self._creating.clear()
+
+        if (self.serialize_early and self._savepoint_storage is None
+            and not self._import and self.before is None):
+            # Pickle the changes before the storage commit begins, so
+            # that less time is spent holding its commit lock.
+            records = []
+            self._added_during_commit = []
+            try:
+                self._serialize_registered(
+                    records.extend, self._registered_objects)
+                n = len(self._registered_objects)
+                for obj in self._added_during_commit:
+                    records.extend(self._serialize_objects(ObjectWriter(obj)))
+            finally:
+                self._added_during_commit = None
+            self._prepared = records, n
+
         self._normal_storage.tpc_begin(meta_data)
 
     def commit(self, transaction):
@@ -526,7 +629,27 @@ class Connection(ExportImport, object):
 
         self._added_during_commit = []
 
-        for obj in self._registered_objects:
+        def store(records):
+            self._store_records(transaction, records)
+
+        registered = self._registered_objects
+        if self._prepared is not None:
+            records, n = self._prepared
+            self._prepared = None
+            store(records)
+            # Objects registered since tpc_begin haven't been serialized.
+            registered = registered[n:]
+
+        self._serialize_registered(store, registered)
+
+        for obj in self._added_during_commit:
+            store(self._serialize_objects(ObjectWriter(obj)))
+        self._added_during_commit = None
+
+    def _serialize_registered(self, handle, registered):
+        # Pass the records for the registered objects, and the new
+        # objects they reference, to handle.
+        for obj in registered:
             oid = obj._p_oid
             assert oid
             if oid in self._conflicts:
@@ -544,13 +667,11 @@ class Connection(ExportImport, object):
                 # already processed.
                 continue
 
-            self._store_objects(ObjectWriter(obj), transaction)
-
-        for obj in self._added_during_commit:
-            self._store_objects(ObjectWriter(obj), transaction)
-        self._added_during_commit = None
+            handle(self._serialize_objects(ObjectWriter(obj)))
 
-    def _store_objects(self, writer, transaction):
+    def _serialize_objects(self, writer):
+        # Generate (obj, oid, serial, data) for the objects written,
+        # noting which are new and which are modified.
         for obj in writer:
             oid = obj._p_oid
             serial = getattr(obj, "_p_serial", z64)
@@ -580,52 +701,79 @@ class Connection(ExportImport, object):
             if len(p) >= self.large_record_size:
                 warnings.warn(large_object_message % (obj.__class__, len(p)))
 
-            if isinstance(obj, Blob):
-                if not IBlobStorage.providedBy(self._storage):
-                    raise Unsupported(
-                        "Storing Blobs in %s is not supported." %
-                        repr(self._storage))
-                if obj.opened():
-                    raise ValueError("Can't commit with opened blobs.")
-                blobfilename = obj._uncommitted()
-                if blobfilename is None:
-                    assert serial is not None # See _uncommitted
-                    self._modified.pop() # not modified
-                    continue
-                s = self._storage.storeBlob(oid, serial, p, blobfilename,
-                                            '', transaction)
-                # we invalidate the object here in order to ensure
-                # that that the next attribute access of its name
-                # unghostify it, which will cause its blob data
-                # to be reattached "cleanly"
-                obj._p_invalidate()
-            else:
-                s = self._storage.store(oid, serial, p, '', transaction)
+            yield obj, oid, serial, p
 
-            self._store_count += 1
-            # Put the object in the cache before handling the
-            # response, just in case the response contains the
-            # serial number for a newly created object
-            try:
-                self._cache[oid] = obj
-            except:
-                # Dang, I bet it's wrapped:
-                # TODO:  Deprecate, then remove, this.
-                if hasattr(obj, 'aq_base'):
-                    self._cache[oid] = obj.aq_base
-                else:
-                    raise
+    def _store_records(self, transaction, records):
+        # Store records from _serialize_objects.  If the storage has
+        # storeMany, the records for objects that aren't blobs are
+        # passed to it together.
+        storeMany = getattr(self._storage, 'storeMany', None)
+        if storeMany is None:
+            for record in records:
+                self._store_record(transaction, *record)
+            return
 
-            self._cache.update_object_size_estimation(oid, len(p))
-            obj._p_estimated_size = len(p)
+        batch = []
+        for record in records:
+            if isinstance(record[0], Blob):
+                self._store_record(transaction, *record)
+            else:
+                batch.append(record)
+        if batch:
+            storeMany([(oid, serial, p) for _, oid, serial, p in batch],
+                      transaction)
+            for obj, oid, _, p in batch:
+                self._stored(obj, oid, p, None)
+
+    def _store_record(self, transaction, obj, oid, serial, p):
+        if isinstance(obj, Blob):
+            if not IBlobStorage.providedBy(self._storage):
+                raise Unsupported(
+                    "Storing Blobs in %s is not supported." %
+                    repr(self._storage))
+            if obj.opened():
+                raise ValueError("Can't commit with opened blobs.")
+            blobfilename = obj._uncommitted()
+            if blobfilename is None:
+                assert serial is not None # See _uncommitted
+                self._modified.remove(oid) # not modified
+                return
+            s = self._storage.storeBlob(oid, serial, p, blobfilename,
+                                        '', transaction)
+            # we invalidate the object here in order to ensure
+            # that that the next attribute access of its name
+            # unghostify it, which will cause its blob data
+            # to be reattached "cleanly"
+            obj._p_invalidate()
+        else:
+            s = self._storage.store(oid, serial, p, '', transaction)
+        self._stored(obj, oid, p, s)
+
+    def _stored(self, obj, oid, p, s):
+        self._store_count += 1
+        # Put the object in the cache before handling the
+        # response, just in case the response contains the
+        # serial number for a newly created object
+        try:
+            self._cache[oid] = obj
+        except:
+            # Dang, I bet it's wrapped:
+            # TODO:  Deprecate, then remove, this.
+            if hasattr(obj, 'aq_base'):
+                self._cache[oid] = obj.aq_base
+            else:
+                raise
 
-            # if we write an object, we don't want to check if it was read
-            # while current.  This is a convenient choke point to do this.
-            self._readCurrent.pop(oid, None)
-            if s:
-                # savepoint
-                obj._p_changed = 0 # transition from changed to up-to-date
-                obj._p_serial = s
+        self._cache.update_object_size_estimation(oid, len(p))
+        obj._p_estimated_size = len(p)
+
+        # if we write an object, we don't want to check if it was read
+        # while current.  This is a convenient choke point to do this.
+        self._readCurrent.pop(oid, None)
+        if s:
+            # savepoint
+            obj._p_changed = 0 # transition from changed to up-to-date
+            obj._p_serial = s
 
     def tpc_abort(self, transaction):
         transaction = transaction.data(self)
@@ -793,7 +941,10 @@ class Connection(ExportImport, object):
                 raise
 
         try:
-            p, serial = self._storage.load(oid)
+            r = self._preloaded.pop(oid, None)
+            if r is None:
+                r = self._storage.load(oid)
+            p, serial = r
 
             self._load_count += 1
 
@@ -1060,7 +1211,7 @@ class Connection(ExportImport, object):
                 else:
                     self._storage.store(oid, serial, data, '', transaction)
 
-                self._readCurrent.pop(oid, None) # same as in _store_objects()
+                self._readCurrent.pop(oid, None) # same as in _store_record()
         finally:
             src.close()
 
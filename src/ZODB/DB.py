@@ -17,8 +17,12 @@ from __future__ import print_function
 import sys
 import logging
 import datetime
+import os
+import threading
 import time
 import warnings
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
 
 from . import utils
 
@@ -113,6 +117,9 @@ class AbstractConnectionPool(object):
 
 class ConnectionPool(AbstractConnectionPool):
 
+    # The maximum number of affinities hits and misses are counted for.
+    affinity_stats_size = 1000
+
     def __init__(self, size, timeout=1<<31):
         super(ConnectionPool, self).__init__(size, timeout)
 
@@ -123,6 +130,10 @@ class ConnectionPool(AbstractConnectionPool):
         # in this stack.
         self.available = []
 
+        # {affinity: [hits, misses]} for pops asking for an affinity,
+        # in the order they were first counted.
+        self.affinity_stats = OrderedDict()
+
     def _append(self, c):
         available = self.available
         cactive = c._cache.cache_non_ghost_count
@@ -193,21 +204,60 @@ class ConnectionPool(AbstractConnectionPool):
     def reduce_size(self):
         self._reduce_size()
 
-    def pop(self):
+    def pop(self, affinity=None):
         """Pop an available connection and return it.
 
         Return None if none are available - in this case, the caller should
         create a new connection, register it via push(), and call pop() again.
         The caller is responsible for serializing this sequence.
+
+        If an affinity is given, the most recently pushed available
+        connection whose ``_affinity`` is equal to it is returned in
+        preference to the top of the stack, and a hit or miss is
+        counted in affinity_stats.
         """
         result = None
-        if self.available:
-            _, result = self.available.pop()
+        available = self.available
+        if available:
+            if affinity is not None:
+                i = len(available) - 1
+                while i >= 0:
+                    if available[i][1]._affinity == affinity:
+                        _, result = available.pop(i)
+                        break
+                    i -= 1
+            hit = result is not None
+            if result is None:
+                _, result = available.pop()
             # Leave it in self.all, so we can still get at it for statistics
             # while it's alive.
             assert result in self.all
+        else:
+            hit = False
+        if affinity is not None:
+            stats = self.affinity_stats.get(affinity)
+            if stats is None:
+                if len(self.affinity_stats) >= self.affinity_stats_size:
+                    self._prune_affinity_stats()
+                stats = self.affinity_stats[affinity] = [0, 0]
+            stats[not hit] += 1
         return result
 
+    def _prune_affinity_stats(self):
+        # Forget the affinities no pooled connection has and, if there
+        # are still too many, those counted first.
+        held = set()
+        for r in self.all.as_weakref_list():
+            c = r()
+            if c is not None:
+                held.add(c._affinity)
+        stats = self.affinity_stats
+        for affinity in list(stats):
+            if affinity not in held:
+                del stats[affinity]
+        while len(stats) >= self.affinity_stats_size:
+            stats.popitem(False)
+
     def map(self, f):
         """For every live connection c, invoke f(c)."""
         self.all.map(f)
@@ -377,6 +427,12 @@ class DB(object):
                  databases=None,
                  xrefs=True,
                  large_record_size=1<<24,
+                 record_cache_size=0,
+                 invalidation_log_size=None,
+                 serialize_early=False,
+                 cache_snapshot=None,
+                 cache_snapshot_interval=300,
+                 warm_cache=False,
                  **storage_args):
         """Create an object database.
 
@@ -424,6 +480,38 @@ class DB(object):
         :param int large_record_size: When object records are saved
              that are larger than this, a warning is issued,
              suggesting that blobs should be used instead.
+        :param int record_cache_size: target total size of object
+             records kept in memory and shared by all non-historical
+             connections, so that records loaded by one connection
+             needn't be loaded from the storage by others.  0, the
+             default, disables the cache.  The cache isn't used with
+             storages that implement
+             :class:`~ZODB.interfaces.IMVCCStorage`.
+        :param int invalidation_log_size: maximum number of oids kept
+             in the log of invalidations that non-historical
+             connections read when they're opened or synchronized.
+             Connections that haven't read entries dropped from the
+             log invalidate their caches entirely.  The default is
+             100000.  The log isn't used with storages that implement
+             :class:`~ZODB.interfaces.IMVCCStorage`.
+        :param boolean serialize_early: Flag indicating whether
+             connections pickle the objects they commit before the
+             storage commit begins, rather than while holding the
+             storage's commit lock.  The records are then stored
+             together.  Objects that other data managers change in
+             their ``tpc_begin`` methods, after they've been pickled,
+             aren't saved again.
+        :param str cache_snapshot: the name of a file to save the oids
+             of the most recently used objects in the caches of
+             available connections to.  It's saved periodically and
+             when the database is closed.  Object data aren't saved.
+        :param seconds cache_snapshot_interval: how often the cache
+             snapshot is saved.  If 0, it's only saved when the
+             database is closed.
+        :param boolean warm_cache: Flag indicating whether, if the
+             cache snapshot file exists, the objects it lists are
+             loaded into the caches of new connections in a
+             background thread when the database is opened.
         :param storage_args: Extra keywork arguments passed to a
              storage constructor if a path name or None is passed as
              the storage argument.
@@ -457,7 +545,8 @@ class DB(object):
             self._mvcc_storage = storage
         else:
             from .mvccadapter import MVCCAdapter
-            self._mvcc_storage = MVCCAdapter(storage)
+            self._mvcc_storage = MVCCAdapter(
+                storage, record_cache_size, invalidation_log_size)
 
         self.references = ZODB.serialize.referencesf
 
@@ -481,6 +570,7 @@ class DB(object):
         self.xrefs = xrefs
 
         self.large_record_size = large_record_size
+        self.serialize_early = serialize_early
 
         # Make sure we have a root:
         with self.transaction(u'initial database creation') as conn:
@@ -491,10 +581,99 @@ class DB(object):
                 root = PersistentMapping()
                 conn._add(root, z64)
 
+        self.cache_snapshot = cache_snapshot
+        self._snapshot_stop = threading.Event()
+        self._snapshot_threads = []
+        if cache_snapshot:
+            if warm_cache and os.path.exists(cache_snapshot):
+                self._start_snapshot_thread(
+                    'warm caches', self._warm_caches,
+                    self._read_cache_snapshot())
+            if cache_snapshot_interval:
+                self._start_snapshot_thread(
+                    'save cache snapshots', self._save_cache_snapshots,
+                    cache_snapshot_interval)
+
     @property
     def _storage(self):      # Backward compatibility
         return self.storage
 
+    def _start_snapshot_thread(self, name, target, *args):
+        thread = threading.Thread(
+            target=target, args=args,
+            name='%s for %s' % (name, self.database_name))
+        thread.daemon = True
+        self._snapshot_threads.append(thread)
+        thread.start()
+
+    def saveCacheSnapshot(self):
+        """Save the oids in the caches of available connections
+
+        The oids of the non-ghost objects in each available
+        connection's cache are written to a line of the
+        ``cache_snapshot`` file, most recently used first.  The
+        connections are written in the order they'd be reused.
+        """
+        with self._lock:
+            working_sets = [
+                [oid for oid, ob in reversed(c._cache.lru_items())]
+                [:self._cache_size]
+                for t, c in reversed(self.pool.available)]
+        working_sets = [oids for oids in working_sets if oids]
+        if not working_sets:
+            # Don't replace a snapshot with an empty one.
+            return
+        tmp = self.cache_snapshot + '.tmp'
+        with open(tmp, 'wb') as f:
+            for oids in working_sets:
+                f.write(b' '.join(hexlify(oid) for oid in oids) + b'\n')
+        getattr(os, 'replace', os.rename)(tmp, self.cache_snapshot)
+
+    def _read_cache_snapshot(self):
+        with open(self.cache_snapshot, 'rb') as f:
+            return [[unhexlify(h) for h in line.split()] for line in f]
+
+    def _save_cache_snapshots(self, interval):
+        while not self._snapshot_stop.wait(interval):
+            try:
+                self.saveCacheSnapshot()
+            except Exception:
+                logger.exception("Error saving cache snapshot")
+
+    def _warm_caches(self, working_sets, chunk_size=100):
+        # Load the objects in a cache snapshot into new connections,
+        # least recently used first, so the objects that were used
+        # most recently are the last to be evicted.
+        stop = self._snapshot_stop
+        conns = []
+        try:
+            for oids in working_sets[:self.pool.size]:
+                if stop.is_set():
+                    break
+                conn = self.open(transaction.TransactionManager())
+                conns.append(conn)
+                oids.reverse()
+                for i in range(0, len(oids), chunk_size):
+                    if stop.is_set():
+                        break
+                    chunk = oids[i:i+chunk_size]
+                    try:
+                        conn.get_many(chunk)
+                    except POSException.POSKeyError:
+                        # Objects may have been packed away.
+                        for oid in chunk:
+                            try:
+                                conn.get(oid)._p_activate()
+                            except POSException.POSKeyError:
+                                pass
+        except Exception:
+            logger.exception("Error warming connection caches")
+        finally:
+            # Close the most recently used connection last, so it's
+            # on top of the pool's stack.
+            for conn in reversed(conns):
+                conn.close()
+
     # This is called by Connection.close().
     def _returnToPool(self, connection):
         """Return a connection to the pool.
@@ -633,6 +812,21 @@ class DB(object):
         return sorted(
             m, key=lambda x: (x['connection'], x['ngsize'], x['size']))
 
+    def cacheAffinityDetail(self):
+        """Return connection pool hits and misses by affinity.
+
+        A hit is counted when ``open`` is passed an affinity and an
+        available connection last opened with it is reused.  Counts
+        are kept for at most 1000 affinities; when there are more,
+        those no pooled connection was last opened with are dropped.
+        """
+        with self._lock:
+            stats = self.pool.affinity_stats
+            return sorted(
+                ({'affinity': affinity, 'hits': hits, 'misses': misses}
+                 for affinity, (hits, misses) in stats.items()),
+                key=lambda x: repr(x['affinity']))
+
     def close(self):
         """Close the database and its underlying storage.
 
@@ -649,6 +843,15 @@ class DB(object):
         noop = lambda *a: None
         self.close = noop
 
+        self._snapshot_stop.set()
+        for thread in self._snapshot_threads:
+            thread.join()
+        if self.cache_snapshot:
+            try:
+                self.saveCacheSnapshot()
+            except Exception:
+                logger.exception("Error saving cache snapshot")
+
         @self._connectionMap
         def _(c):
             if c.transaction_manager is not None:
@@ -722,7 +925,8 @@ class DB(object):
         """
         return len(self.storage)
 
-    def open(self, transaction_manager=None, at=None, before=None):
+    def open(self, transaction_manager=None, at=None, before=None,
+             affinity=None):
         """Return a database Connection for use by application code.
 
         Note that the connection pool is managed as a stack, to
@@ -739,6 +943,12 @@ class DB(object):
             A timezone-naive datetime.datetime is treated as a UTC value.
           - `before`: like `at`, but opens the readonly state before the
             tid or datetime.
+          - `affinity`: a hashable key, such as a site name, for the
+            objects the connection will be used for.  An available
+            connection that was last opened with the same key is
+            preferred, because its cache is likely to hold them.
+            Hits and misses are reported by `cacheAffinityDetail`.
+            Historical connections ignore it.
         """
         # `at` is normalized to `before`, since we use storage.loadBefore
         # as the underlying implementation of both.
@@ -771,7 +981,7 @@ class DB(object):
                     self.historical_pool.push(c, before)
                     result = self.historical_pool.pop(before)
             else:
-                result = self.pool.pop()
+                result = self.pool.pop(affinity)
                 if result is None:
                     c = self.klass(self,
                                    self._cache_size,
@@ -780,6 +990,8 @@ class DB(object):
                                    )
                     self.pool.push(c)
                     result = self.pool.pop()
+                if affinity is not None:
+                    result._affinity = affinity
             assert result is not None
 
             # A good time to do some cache cleanup.
@@ -849,7 +1061,7 @@ class DB(object):
             t = time.time()
         t -= days * 86400
         try:
-            self.storage.pack(t, self.references)
+            self._mvcc_storage.pack(t, self.references)
         except:
             logger.exception("packing")
             raise
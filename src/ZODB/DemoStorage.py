@@ -38,6 +38,7 @@ from .utils import load_current, maxtid
 @zope.interface.implementer(
         ZODB.interfaces.IStorage,
         ZODB.interfaces.IStorageIteration,
+        ZODB.interfaces.IMultiLoadStorage,
         )
 class DemoStorage(ConflictResolvingStorage):
     """A storage that stores changes against a read-only base database
@@ -257,6 +258,27 @@ class DemoStorage(ConflictResolvingStorage):
 
         return result
 
+    def loadBeforeMany(self, oids, tid):
+        results = [None] * len(oids)
+        in_base = []
+        for i, oid in enumerate(oids):
+            try:
+                r = self.changes.loadBefore(oid, tid)
+            except ZODB.POSException.POSKeyError:
+                in_base.append(i)
+            else:
+                if r is None:
+                    # There are no earlier records in the changes, so
+                    # look in the base, as loadBefore does.
+                    r = self.loadBefore(oid, tid)
+                results[i] = r
+
+        if in_base:
+            for i, r in zip(in_base, ZODB.utils.load_before_many(
+                    self.base, [oids[i] for i in in_base], tid)):
+                results[i] = r
+        return results
+
     def loadBlob(self, oid, serial):
         try:
             return self.changes.loadBlob(oid, serial)
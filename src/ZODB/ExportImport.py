@@ -13,8 +13,10 @@
 ##############################################################################
 """Support for database export and import."""
 
+import io
 import logging
 import os
+from collections import deque
 from tempfile import TemporaryFile
 
 import six
@@ -29,47 +31,80 @@ from ZODB._compat import PersistentPickler, Unpickler, BytesIO, _protocol
 
 logger = logging.getLogger('ZODB.ExportImport')
 
+sendfile = getattr(os, 'sendfile', None)
+
 class ExportImport(object):
 
-    def exportFile(self, oid, f=None):
+    def exportFile(self, oid, f=None, batch_size=100, progress=None):
+        """Export an object and the objects reachable from it
+
+        Records are loaded ``batch_size`` at a time, with one storage
+        call where the storage supports it.  If ``progress`` is given,
+        it's called with the number of records exported after each
+        batch.
+        """
         if f is None:
             f = TemporaryFile(prefix="EXP")
         elif isinstance(f, six.string_types):
             f = open(f,'w+b')
         f.write(b'ZEXP')
-        oids = [oid]
-        done_oids = {}
-        done = done_oids.__contains__
-        load = self._storage.load
+        oids = deque([oid])
+        done_oids = set()
         supports_blobs = IBlobStorage.providedBy(self._storage)
+        exported = 0
         while oids:
-            oid = oids.pop(0)
-            if oid in done_oids:
-                continue
-            done_oids[oid] = True
-            try:
-                p, serial = load(oid)
-            except:
-                logger.debug("broken reference for oid %s", repr(oid),
-                             exc_info=True)
-            else:
+            batch = []
+            while oids and len(batch) < batch_size:
+                oid = oids.popleft()
+                if oid not in done_oids:
+                    done_oids.add(oid)
+                    batch.append(oid)
+            if not batch:
+                break
+
+            for oid, r in zip(batch, self._export_load(batch)):
+                if r is None:
+                    continue
+                p, serial = r
                 referencesf(p, oids)
                 f.writelines([oid, p64(len(p)), p])
+                exported += 1
 
                 if supports_blobs:
                     if not isinstance(self._reader.getGhost(p), Blob):
                         continue # not a blob
 
                     blobfilename = self._storage.loadBlob(oid, serial)
+                    size = os.stat(blobfilename).st_size
                     f.write(blob_begin_marker)
-                    f.write(p64(os.stat(blobfilename).st_size))
-                    blobdata = open(blobfilename, "rb")
-                    cp(blobdata, f)
-                    blobdata.close()
+                    f.write(p64(size))
+                    with open(blobfilename, "rb") as blobdata:
+                        _copy_blob(blobdata, f, size)
+
+            if progress is not None:
+                progress(exported)
 
         f.write(export_end_marker)
         return f
 
+    def _export_load(self, oids):
+        # Load records for export, with None for broken references.
+        try:
+            return self._load_many(oids)
+        except Exception:
+            pass
+
+        result = []
+        load = self._storage.load
+        for oid in oids:
+            try:
+                result.append(load(oid))
+            except:
+                logger.debug("broken reference for oid %s", repr(oid),
+                             exc_info=True)
+                result.append(None)
+        return result
+
     def importFile(self, f, clue='', customImporters=None):
         # This is tricky, because we need to work in a transaction!
 
@@ -190,6 +225,29 @@ class ExportImport(object):
                 self._storage.store(oid, None, data, '', transaction)
 
 
+def _copy_blob(blobdata, f, size):
+    # Copy blob data to an export file, in the kernel if we can.
+    # Only plain files are written to directly, not wrappers like
+    # GzipFile that have the file descriptor of another file.
+    sent = 0
+    if (sendfile is not None and
+        isinstance(f, (io.BufferedWriter, io.BufferedRandom, io.FileIO))):
+        f.flush()
+        pos = f.tell()
+        try:
+            while sent < size:
+                n = sendfile(f.fileno(), blobdata.fileno(), sent, size - sent)
+                if not n:
+                    break
+                sent += n
+        except OSError:
+            pass # Copy the rest below.
+        # The file's position is cached, so tell it where we are.
+        f.seek(pos + sent)
+    if sent < size:
+        blobdata.seek(sent)
+        cp(blobdata, f, size - sent)
+
 export_end_marker = b'\377'*16
 blob_begin_marker = b'\000BLOBSTART'
 
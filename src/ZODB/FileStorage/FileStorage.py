@@ -16,16 +16,23 @@
 from __future__ import print_function
 
 import binascii
+import bisect
 import contextlib
 import errno
 import logging
+import mmap
+import multiprocessing
 import os
+import sys
+import threading
 import time
+from collections import OrderedDict
 from struct import pack
 from struct import unpack
 
 from persistent.TimeStamp import TimeStamp
 from six import string_types as STRING_TYPES
+from six.moves.queue import Queue
 from zc.lockfile import LockFile
 from zope.interface import alsoProvides
 from zope.interface import implementer
@@ -40,18 +47,27 @@ from ZODB.BaseStorage import BaseStorage
 from ZODB.BaseStorage import DataRecord as _DataRecord
 from ZODB.BaseStorage import TransactionRecord as _TransactionRecord
 from ZODB.ConflictResolution import ConflictResolvingStorage
+from ZODB.FileStorage.format import CommittedFile
 from ZODB.FileStorage.format import CorruptedDataError
 from ZODB.FileStorage.format import CorruptedError
 from ZODB.FileStorage.format import DATA_HDR
 from ZODB.FileStorage.format import DATA_HDR_LEN
 from ZODB.FileStorage.format import DataHeader
 from ZODB.FileStorage.format import FileStorageFormatter
+from ZODB.FileStorage.format import MappedFile
 from ZODB.FileStorage.format import TRANS_HDR
 from ZODB.FileStorage.format import TRANS_HDR_LEN
 from ZODB.FileStorage.format import TxnHeader
+from ZODB.FileStorage.tidindex import TidIndex
+from ZODB.FileStorage.format import WindowedFile
 from ZODB.FileStorage.fspack import FileStoragePacker
+from ZODB.FileStorage.references import ReferencesFile
+from ZODB.FileStorage.references import iter_refs
 from ZODB.interfaces import IBlobStorageRestoreable
 from ZODB.interfaces import IExternalGC
+from ZODB.interfaces import IMultiLoadStorage
+from ZODB.interfaces import IMultiStoreStorage
+from ZODB.interfaces import IPrefetchStorage
 from ZODB.interfaces import IStorage
 from ZODB.interfaces import IStorageCurrentRecordIteration
 from ZODB.interfaces import IStorageIteration
@@ -60,16 +76,21 @@ from ZODB.interfaces import IStorageUndoable
 from ZODB.POSException import ConflictError
 from ZODB.POSException import MultipleUndoErrors
 from ZODB.POSException import POSKeyError
+from ZODB.POSException import ReadConflictError
 from ZODB.POSException import ReadOnlyError
 from ZODB.POSException import StorageError
 from ZODB.POSException import StorageSystemError
 from ZODB.POSException import StorageTransactionError
 from ZODB.POSException import UndoError
+from ZODB.fsIndex import apply_deltas
 from ZODB.fsIndex import fsIndex
+from ZODB.fsIndex import write_delta
+from ZODB.serialize import referencesf
 from ZODB.utils import as_bytes
 from ZODB.utils import as_text
 from ZODB.utils import cp
 from ZODB.utils import load_current
+from ZODB.utils import maxtid
 from ZODB.utils import mktemp
 from ZODB.utils import p64
 from ZODB.utils import u64
@@ -133,6 +154,9 @@ class TempFormatter(FileStorageFormatter):
         IStorageUndoable,
         IStorageCurrentRecordIteration,
         IExternalGC,
+        IMultiLoadStorage,
+        IMultiStoreStorage,
+        IPrefetchStorage,
         )
 class FileStorage(
     FileStorageFormatter,
@@ -146,9 +170,16 @@ class FileStorage(
     # Set True while a pack is in progress; undo is blocked for the duration.
     _pack_is_in_progress = False
 
+    # Maximum number of threads used to read records in prefetch().
+    prefetch_threads = 4
+
     def __init__(self, file_name, create=False, read_only=False, stop=None,
                  quota=None, pack_gc=True, pack_keep_old=True, packer=None,
-                 blob_dir=None):
+                 blob_dir=None, prefetch_cache_size=1<<24, use_mmap=False,
+                 checkpoint_transactions=0, checkpoint_size=0,
+                 index_rebuild_processes=0, pack_gc_processes=0,
+                 refs_sidecar=False, group_commit=False,
+                 revision_index_threshold=0, revision_index_size=100000):
         """Create a file storage
 
         :param str file_name: Path to store data file
@@ -171,6 +202,46 @@ class FileStorage(
            :interface:`packer <ZODB.FileStorage.interfaces.IFileStoragePacker>`.
         :param str blob_dir: A blob-directory path name.
            Blobs will be supported if this option is provided.
+        :param int prefetch_cache_size: Maximum number of bytes of
+           record data held for :meth:`prefetch` until they're
+           loaded.  Pass 0 to make :meth:`prefetch` a no-op.
+        :param bool use_mmap: Flag indicating whether loads should
+           read from a memory map of the committed part of the data
+           file rather than from a pool of file objects.
+        :param int checkpoint_transactions: If non-zero, the index
+           changes made by this many transactions are appended to the
+           ``.index_delta`` file.
+        :param int checkpoint_size: If non-zero, index changes are
+           appended to the ``.index_delta`` file whenever this many
+           bytes have been committed.
+        :param int index_rebuild_processes: If greater than 1, the
+           number of processes used to read the data file when the
+           index has to be rebuilt.
+        :param int pack_gc_processes: If greater than 1, the number
+           of processes used to extract object references when
+           finding the objects to keep during pack.
+        :param bool refs_sidecar: Flag indicating whether the oids
+           referenced by committed records should be recorded in the
+           ``.refs`` file, so pack doesn't have to unpickle records
+           to find references.  They're extracted in a background
+           thread after transactions are committed.
+        :param bool group_commit: Flag indicating whether commits
+           release the commit lock before syncing the data file to
+           disk, so that the transactions committed while one sync is
+           in progress are made durable by a single sync.
+           Transactions aren't visible, and invalidations aren't
+           sent, until their data are on disk, and they're published
+           in order.
+        :param int revision_index_threshold: If non-zero, when
+           loading an old revision of an object means following at
+           least this many back pointers, all of the object's
+           revisions are indexed in memory, so its old revisions can
+           be found with a binary search.  The indexes are kept up to
+           date as transactions are committed.
+        :param int revision_index_size: The maximum number of
+           revisions kept in the revision index.  The revisions of
+           the least recently used objects are discarded when there
+           are more.
 
         A file storage stores data in a single file that behaves like
         a traditional transaction log. New data records are appended
@@ -199,6 +270,20 @@ class FileStorage(
            long because it's necessary to scan the data file to build
            the index.
 
+        .index_delta
+           Changes to the in-memory index since the ``.index`` file
+           was saved.  These are written in the background when
+           checkpoints are enabled, so that after a crash only the
+           transactions committed since the last checkpoint have to
+           be scanned at startup.
+
+        .refs
+           The oids referenced by data records, keyed by record
+           position, written when the ``refs_sidecar`` option is
+           used.  Missing or out-of-date references are added when
+           the storage is packed, and the packer writes a new file
+           for the packed data file.
+
         .lock
            A lock file preventing multiple processes from opening a
            file storage on non-read-only mode.
@@ -249,6 +334,7 @@ class FileStorage(
 
         self._pack_gc = pack_gc
         self.pack_keep_old = pack_keep_old
+        self.pack_gc_processes = pack_gc_processes
         if packer is not None:
             self.packer = packer
 
@@ -288,29 +374,65 @@ class FileStorage(
             self._file = open(file_name, 'w+b')
             self._file.write(packed_version)
 
-        self._files = FilePool(self._file_name)
+        self._files = FilePool(self._file_name, use_mmap)
+        self._prefetched = PrefetchCache(prefetch_cache_size)
+        if revision_index_threshold:
+            self._revisions = RevisionIndex(revision_index_threshold,
+                                            revision_index_size)
+        else:
+            self._revisions = None
+        self._checkpoint_transactions = checkpoint_transactions
+        self._checkpoint_size = checkpoint_size
+        self._checkpointer = IndexCheckpointer(file_name + '.index_delta')
+        if refs_sidecar:
+            self._refs = ReferencesFile(file_name + '.refs')
+            self._refs_appender = ReferencesAppender(self._refs, self._files)
+        else:
+            self._refs = self._refs_appender = None
+        if group_commit and fsync is not None:
+            self._group_sync = GroupSync(lambda: self._file)
+        else:
+            self._group_sync = None
+        # Transactions written but not yet published, in tid order,
+        # each a tid, callback, start, end (None if nothing was
+        # written) and index.  See tpc_finish.
+        self._unpublished = []
+        self._unpublished_cond = utils.Condition()
         r = self._restore_index()
         if r is not None:
             self._used_index = 1 # Marker for testing
             index, start, ltid = r
 
             self._initIndex(index, tindex)
+            self._tids = self._restore_tid_index(start)
             self._pos, self._oid, tid = read_index(
                 self._file, file_name, index, tindex, stop,
                 ltid=ltid, start=start, read_only=read_only,
+                processes=index_rebuild_processes, tids=self._tids,
                 )
+            if self._tids is not None:
+                # The saved index may go past a stop.
+                self._tids.truncate(self._pos)
+            if self._used_deltas or self._pos > start:
+                # Fold the checkpoints and the transactions read
+                # into the index, so later checkpoints start from it.
+                self._save_index()
         else:
             self._used_index = 0 # Marker for testing
+            self._tids = TidIndex()
             self._pos, self._oid, tid = read_index(
                 self._file, file_name, index, tindex, stop,
-                read_only=read_only,
+                read_only=read_only, processes=index_rebuild_processes,
+                tids=self._tids,
                 )
             self._save_index()
 
+        self._files.set_size(self._pos)
         self._ltid = tid
+        self._checkpoint_start()
 
         # self._pos should always point just past the last
-        # transaction.  During 2PC, data is written after _pos.
+        # transaction written.  During 2PC, data is written after _pos.
         # invariant is restored at tpc_abort() or tpc_finish().
 
         self._ts = tid = TimeStamp(tid)
@@ -365,7 +487,23 @@ class FileStorage(
         index_name = self.__name__ + '.index'
         tmp_name = index_name + '.index_tmp'
 
-        self._index.save(self._pos, tmp_name)
+        pos = self._published_pos()
+        self._index.save(pos, tmp_name)
+
+        tids_name = self.__name__ + '.tindex'
+        try:
+            if self._tids is not None:
+                self._tids.save(tids_name, pos)
+            elif os.path.exists(tids_name):
+                # It's out of date.
+                os.remove(tids_name)
+        except Exception:
+            logger.exception("Error saving transaction index")
+
+        # The checkpoints are in the new index.  Remove them before
+        # it's in place, so they can't be applied to the wrong index.
+        self._checkpointer.remove()
+        self._checkpoint_start()
 
         try:
             try:
@@ -377,6 +515,35 @@ class FileStorage(
 
         self._saved += 1
 
+    def _published_pos(self):
+        """Return the end of the published transactions
+
+        Transactions written after it are waiting for the data file
+        to be synced.  The storage lock must be held.
+        """
+        if self._unpublished:
+            return self._unpublished[0][2]
+        return self._pos
+
+    def _checkpoint_start(self):
+        self._checkpoint_pos = self._published_pos()
+        self._checkpoint_count = 0
+        self._checkpoint_changes = {}
+
+    def _checkpoint(self, tindex, pos):
+        """Note index changes, writing them when a checkpoint is due."""
+        if self._checkpoint_pos is None:
+            return
+        self._checkpoint_changes.update(tindex)
+        self._checkpoint_count += 1
+        if ((self._checkpoint_transactions and
+             self._checkpoint_count >= self._checkpoint_transactions) or
+            (self._checkpoint_size and
+             pos - self._checkpoint_pos >= self._checkpoint_size)):
+            self._checkpointer.write(
+                self._checkpoint_pos, pos, self._checkpoint_changes)
+            self._checkpoint_start()
+
     def _clear_index(self):
         index_name = self.__name__ + '.index'
         if os.path.exists(index_name):
@@ -449,6 +616,46 @@ class FileStorage(
 
             return ltid
 
+    _tids = None # The TidIndex, or None if it hasn't been built
+
+    def _restore_tid_index(self, pos):
+        """Load the saved transaction id index
+
+        Transactions before ``pos`` that it's missing are added.
+        Return None if it can't be loaded.
+        """
+        r = TidIndex.load(self.__name__ + '.tindex')
+        if r is None:
+            return None
+        tids, tids_pos = r
+        if tids_pos > pos:
+            return None
+        try:
+            last = tids.last()
+            if last is not None:
+                # Make sure it's for this file.
+                tid, tpos = last
+                self._file.seek(tpos)
+                if self._file.read(8) != tid:
+                    return None
+            tids.scan(self._file, tids_pos, pos)
+        except Exception:
+            logger.exception("Error reading transaction ids")
+            return None
+        return tids
+
+    def _tid_index(self):
+        """Return the transaction id index, building it if necessary
+
+        The storage lock must be held.
+        """
+        if self._tids is None:
+            tids = TidIndex()
+            tids.scan(self._file, 4, self._published_pos())
+            self._tids = tids
+        return self._tids
+
+    _used_deltas = 0 # Number of checkpoints applied, for testing
     def _restore_index(self):
         """Load database index to support quick startup."""
         # Returns (index, pos, tid), or None in case of error.
@@ -462,7 +669,11 @@ class FileStorage(
 
         if os.path.exists(index_name):
             try:
-                info = fsIndex.load(index_name)
+                # Search binary index files in place, rather than
+                # loading them, except on Windows, where mapped files
+                # can't be replaced when the index is saved.
+                info = fsIndex.load(index_name,
+                                    mapped=sys.platform != 'win32')
             except:
                 logger.exception('loading index')
                 return None
@@ -476,7 +687,7 @@ class FileStorage(
         pos = int(pos)
 
         if (isinstance(index, dict) or
-                (isinstance(index, fsIndex) and
+                (index.__class__ is fsIndex and
                  isinstance(index._data, dict))):
             # Convert dictionary indexes to fsIndexes *or* convert fsIndexes
             # which have a dict `_data` attribute to a new fsIndex (newer
@@ -494,6 +705,14 @@ class FileStorage(
                 # Now call this method again to get the new data.
                 return self._restore_index()
 
+        delta_name = index_name + '_delta'
+        if os.path.exists(delta_name):
+            try:
+                pos, self._used_deltas = apply_deltas(delta_name, index, pos)
+            except:
+                logger.exception('loading index checkpoints')
+                return None
+
         tid = self._sane(index, pos)
         if not tid:
             return None
@@ -501,8 +720,13 @@ class FileStorage(
         return index, pos, tid
 
     def close(self):
+        if self._refs is not None:
+            # Finish appending references before the files are closed.
+            self._refs_appender.close()
+            self._refs.close()
         self._file.close()
         self._files.close()
+        self._checkpointer.close()
         if hasattr(self,'_lock_file'):
             self._lock_file.close()
         if self._tfile:
@@ -530,7 +754,7 @@ class FileStorage(
         """Return pickle data and serial number."""
         assert not version
 
-        with self._files.get() as _file:
+        with self._files.get(maxtid) as _file:
             pos = self._lookup_pos(oid)
             h = self._read_data_header(pos, oid, _file)
             if h.plen:
@@ -545,41 +769,222 @@ class FileStorage(
                 raise POSKeyError(oid)
 
     def loadSerial(self, oid, serial):
-        with self._lock:
+        with self._files.get(maxtid) as _file:
             pos = self._lookup_pos(oid)
+            revisions = self._revisions
+            if revisions is not None:
+                indexed = revisions.serial(oid, serial)
+                if indexed is not None:
+                    if not indexed:
+                        raise POSKeyError(oid)
+                    pos = indexed
+            steps = 0
             while 1:
-                h = self._read_data_header(pos, oid)
+                h = self._read_data_header(pos, oid, _file)
                 if h.tid == serial:
                     break
                 pos = h.prev
                 if h.tid < serial or not pos:
                     raise POSKeyError(oid)
+                steps += 1
             if h.plen:
-                return self._file.read(h.plen)
+                data = _file.read(h.plen)
             else:
-                return self._loadBack_impl(oid, h.back)[0]
+                data = self._loadBack_impl(oid, h.back, _file=_file)[0]
+            if revisions is not None and steps >= revisions.threshold:
+                self._index_revisions(oid, _file)
+            return data
 
     def loadBefore(self, oid, tid):
-        with self._files.get() as _file:
+        if self._prefetched:
+            r = self._prefetched.pop(oid, tid)
+            if r is not None:
+                return r
+
+        with self._files.get(tid) as _file:
             pos = self._lookup_pos(oid)
-            end_tid = None
-            while True:
-                h = self._read_data_header(pos, oid, _file)
-                if h.tid < tid:
-                    break
+            return self._loadBefore_impl(oid, tid, pos, _file)
 
-                pos = h.prev
-                end_tid = h.tid
+    def loadBeforeMany(self, oids, tid):
+        """Return the loadBefore results for a sequence of oids
+
+        Records that weren't prefetched are read in file order, with
+        one file from the pool.
+        """
+        results = [None] * len(oids)
+        todo = []
+        prefetched = self._prefetched
+        for i, oid in enumerate(oids):
+            if prefetched:
+                r = prefetched.pop(oid, tid)
+                if r is not None:
+                    results[i] = r
+                    continue
+            todo.append(i)
+
+        if todo:
+            with self._files.get(tid) as _file:
+                positions = sorted((self._lookup_pos(oids[i]), i)
+                                   for i in todo)
+                for pos, i in positions:
+                    results[i] = self._loadBefore_impl(
+                        oids[i], tid, pos, _file)
+        return results
+
+    def _loadBefore_impl(self, oid, tid, pos, _file):
+        revisions = self._revisions
+        if revisions is not None:
+            indexed = revisions.before(oid, tid)
+            if indexed is not None:
+                pos, end_tid = indexed
                 if not pos:
                     return None
+                h = self._read_data_header(pos, oid, _file)
+                return self._loadBefore_data(oid, h, end_tid, _file)
 
-            if h.plen:
-                return _file.read(h.plen), h.tid, end_tid
-            elif h.back:
-                data, _, _, _ = self._loadBack_impl(oid, h.back, _file=_file)
-                return data, h.tid, end_tid
-            else:
+        end_tid = None
+        steps = 0
+        while True:
+            h = self._read_data_header(pos, oid, _file)
+            if h.tid < tid:
+                break
+
+            pos = h.prev
+            end_tid = h.tid
+            steps += 1
+            if not pos:
+                h = None
+                break
+
+        if h is not None:
+            r = self._loadBefore_data(oid, h, end_tid, _file)
+        else:
+            r = None
+        if revisions is not None and steps >= revisions.threshold:
+            self._index_revisions(oid, _file)
+        return r
+
+    def _loadBefore_data(self, oid, h, end_tid, _file):
+        # Return the loadBefore result for a data record whose header
+        # was just read.
+        if h.plen:
+            return _file.read(h.plen), h.tid, end_tid
+        elif h.back:
+            data, _, _, _ = self._loadBack_impl(oid, h.back, _file=_file)
+            return data, h.tid, end_tid
+        else:
+            raise POSKeyError(oid)
+
+    def _index_revisions(self, oid, _file):
+        """Index the revisions of an object with many of them
+        """
+        pos = self._index_get(oid, 0)
+        tids = []
+        positions = []
+        try:
+            while pos:
+                h = self._read_data_header(pos, oid, _file)
+                tids.append(h.tid)
+                positions.append(pos)
+                pos = h.prev
+        except CorruptedError:
+            # The current record may not be readable with this file.
+            return
+        tids.reverse()
+        positions.reverse()
+        self._revisions.add(oid, tids, positions, self._index_get)
+
+    def prefetch(self, oids, tid):
+        """Read the records for the given oids in file order
+
+        The results are held in memory so that the ``loadBefore``
+        calls that follow, with the same ``tid``, don't have to go to
+        the file.
+        """
+        if not self._prefetched.size or tid is None:
+            return
+
+        index_get = self._index_get
+        positions = []
+        for oid in oids:
+            pos = index_get(oid, 0)
+            if pos:
+                positions.append((pos, oid))
+        if not positions:
+            return
+        positions.sort()
+
+        nthreads = min(self.prefetch_threads, len(positions) // 100)
+        if nthreads < 2:
+            return self._prefetch_chunk(positions, tid)
+
+        size = len(positions) // nthreads + 1
+        threads = [
+            threading.Thread(target=self._prefetch_chunk,
+                             args=(positions[i:i+size], tid))
+            for i in range(0, len(positions), size)
+            ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _prefetch_chunk(self, positions, tid):
+        with self._files.get(tid) as _file:
+            # Later commits could add records before tids past the
+            # last transaction, so we don't read ahead for them.
+            # Records read while a commit finishes are discarded, as
+            # the commit may have ended them.
+            generation = self._prefetched.generation
+            if u64(tid) > u64(self._ltid) + 1:
+                return
+            for pos, oid in positions:
+                try:
+                    r = self._loadBefore_impl(oid, tid, pos, _file)
+                except (POSKeyError, CorruptedDataError):
+                    continue
+                if r is not None:
+                    self._prefetched.store(oid, tid, r, generation)
+
+    def _written_pos(self, oid):
+        """Return the position of the current record for an oid, or 0
+
+        Unlike the index, records written by transactions that haven't
+        been published are included.  The storage lock must be held.
+        """
+        for entry in reversed(self._unpublished):
+            pos = entry[4].get(oid)
+            if pos is not None:
+                return pos
+        return self._index_get(oid, 0)
+
+    def _resolve(self, oid, old, committed_tid, oldserial, data):
+        # Records that haven't been published can't be loaded by
+        # serial, so their data are passed for conflict resolution.
+        committed_data = b''
+        if self._unpublished and old >= self._published_pos():
+            committed_data = self._loadBack_impl(oid, old, False)[0] or b''
+        return self.tryToResolveConflict(oid, committed_tid, oldserial, data,
+                                         committed_data)
+
+    def checkCurrentSerialInTransaction(self, oid, serial, transaction):
+        if not self._unpublished:
+            return BaseStorage.checkCurrentSerialInTransaction(
+                self, oid, serial, transaction)
+
+        if transaction is not self._transaction:
+            raise StorageTransactionError(self, transaction)
+        with self._lock:
+            pos = self._written_pos(oid)
+            if not pos:
                 raise POSKeyError(oid)
+            h = self._read_data_header(pos, oid)
+            if h.plen == 0 and h.back == 0:
+                raise POSKeyError(oid)
+            committed_tid = h.tid
+        if committed_tid != serial:
+            raise ReadConflictError(oid=oid, serials=(committed_tid, serial))
 
     def store(self, oid, oldserial, data, version, transaction):
         if self._is_read_only:
@@ -591,7 +996,7 @@ class FileStorage(
         with self._lock:
             if oid > self._oid:
                 self.set_max_oid(oid)
-            old = self._index_get(oid, 0)
+            old = self._written_pos(oid)
             committed_tid = None
             pnv = None
             if old:
@@ -599,8 +1004,8 @@ class FileStorage(
                 committed_tid = h.tid
 
                 if oldserial != committed_tid:
-                    data = self.tryToResolveConflict(oid, committed_tid,
-                                                     oldserial, data)
+                    data = self._resolve(oid, old, committed_tid,
+                                         oldserial, data)
                     self._resolved.append(oid)
 
             pos = self._pos
@@ -616,6 +1021,58 @@ class FileStorage(
                 raise FileStorageQuotaError(
                     "The storage quota has been exceeded.")
 
+    def storeMany(self, records, transaction):
+        """Store a sequence of (oid, serial, data) records
+
+        The committed serials are read in file order, and the data
+        records are written to the temporary file with one write.
+        """
+        if self._is_read_only:
+            raise ReadOnlyError()
+        if transaction is not self._transaction:
+            raise StorageTransactionError(self, transaction)
+        if not records:
+            return
+
+        with self._lock:
+            max_oid = max(oid for oid, _, _ in records)
+            if max_oid > self._oid:
+                self.set_max_oid(max_oid)
+
+            written_pos = self._written_pos
+            olds = [written_pos(oid) for oid, _, _ in records]
+            committed = {} # {old position -> committed tid}
+            for old, i in sorted((old, i) for i, old in enumerate(olds)
+                                 if old):
+                committed[old] = self._read_data_header(
+                    old, records[i][0]).tid
+
+            pos = self._pos
+            here = pos + self._tfile.tell() + self._thl
+            buf = []
+            for (oid, serial, data), old in zip(records, olds):
+                if old:
+                    committed_tid = committed[old]
+                    if serial != committed_tid:
+                        data = self._resolve(oid, old, committed_tid,
+                                             serial, data)
+                        self._resolved.append(oid)
+
+                self._tindex[oid] = here
+                buf.append(
+                    DataHeader(oid, self._tid, old, pos, 0, len(data)
+                               ).asString())
+                buf.append(data)
+                last = here
+                here += DATA_HDR_LEN + len(data)
+
+            self._tfile.write(b''.join(buf))
+
+            # Check quota
+            if self._quota is not None and last > self._quota:
+                raise FileStorageQuotaError(
+                    "The storage quota has been exceeded.")
+
     def deleteObject(self, oid, oldserial, transaction):
         if self._is_read_only:
             raise ReadOnlyError()
@@ -623,7 +1080,7 @@ class FileStorage(
             raise StorageTransactionError(self, transaction)
 
         with self._lock:
-            old = self._index_get(oid, 0)
+            old = self._written_pos(oid)
             if not old:
                 raise POSKeyError(oid)
             h = self._read_data_header(old, oid)
@@ -725,7 +1182,7 @@ class FileStorage(
                 prev_txn_pos = self._txn_find(prev_txn, 0)
                 if prev_txn_pos:
                     prev_pos = self._data_find(prev_txn_pos, oid, data)
-            old = self._index_get(oid, 0)
+            old = self._written_pos(oid)
             # Calculate the file position in the temporary file
             here = self._pos + self._tfile.tell() + self._thl
             # And update the temp file index
@@ -804,27 +1261,43 @@ class FileStorage(
                 # Hm, an error occurred writing out the data. Maybe the
                 # disk is full. We don't want any turd at the end.
                 self._file.truncate(self._pos)
-                self._files.flush()
                 raise
             self._nextpos = self._pos + (tl + 8)
             return self._resolved
 
     def tpc_finish(self, transaction, f=None):
-        with self._files.write_lock():
-            with self._lock:
-                if transaction is not self._transaction:
-                    raise StorageTransactionError(
-                        "tpc_finish called with wrong transaction")
-                try:
-                    tid = self._tid
-                    if f is not None:
-                        f(tid)
+        # Readers of the data file only see committed data, so only
+        # those wanting data from this transaction wait for it.
+        entry = None
+        with self._lock:
+            if transaction is not self._transaction:
+                raise StorageTransactionError(
+                    "tpc_finish called with wrong transaction")
+            try:
+                tid = self._tid
+                if self._group_sync is None:
+                    with self._files.finish(tid):
+                        if f is not None:
+                            f(tid)
+                        self._finish(tid, *self._ude)
+                        self._clear_temp()
+                else:
+                    # The transaction is published once its data are
+                    # synced, after the commit lock is released, so
+                    # later transactions can be written meanwhile.
+                    tpos = self._pos
                     self._finish(tid, *self._ude)
+                    end = self._pos if self._nextpos else None
+                    entry = tid, f, tpos, end, dict(self._tindex)
+                    self._unpublished.append(entry)
                     self._clear_temp()
-                finally:
-                    self._ude = None
-                    self._transaction = None
-                    self._commit_lock.release()
+            finally:
+                self._ude = None
+                self._transaction = None
+                self._commit_lock.release()
+
+        if entry is not None:
+            self._publish_synced(entry)
         return tid
 
     def _finish(self, tid, u, d, e):
@@ -850,18 +1323,101 @@ class FileStorage(
         # something broken. :)
 
         self._file.flush()
-        if fsync is not None:
+        if fsync is not None and self._group_sync is None:
             fsync(self._file.fileno())
 
+        tpos = self._pos
         self._pos = self._nextpos
-        self._index.update(self._tindex)
-        self._ltid = tid
+        if self._group_sync is None:
+            self._publish(tid, tpos, self._pos, self._tindex)
         self._blob_tpc_finish()
 
+    def _publish(self, tid, tpos, end, tindex):
+        # Make a transaction's data visible to readers.  The storage
+        # lock must be held.
+        self._files.set_size(end)
+        self._index.update(tindex)
+        self._ltid = tid
+        if self._tids is not None:
+            self._tids.append(tid, tpos)
+        if self._revisions is not None:
+            self._revisions.committed(tid, tindex)
+        if self._refs is not None:
+            # The references are extracted in the background, so
+            # commits don't wait for the records to be unpickled.
+            self._refs_appender.write(tpos, end)
+        if self._prefetched.size:
+            # Also discards records being prefetched.
+            self._prefetched.invalidate(tindex)
+        if self._checkpoint_transactions or self._checkpoint_size:
+            self._checkpoint(tindex, end)
+
+    def _publish_synced(self, entry):
+        # Wait for a transaction's data to be synced, along with those
+        # of any others written meanwhile, and for the transactions
+        # before it to be published, then publish it.  Nothing is
+        # visible, and no invalidations are sent, before the sync.
+        tid, f, tpos, end, tindex = entry
+        if end is not None:
+            try:
+                self._group_sync.sync()
+            except:
+                logger.critical("Failure syncing data file. Closing.",
+                                exc_info=True)
+                self._unpublished_failed()
+                raise
+
+        cond = self._unpublished_cond
+        with cond:
+            while self._unpublished and self._unpublished[0] is not entry:
+                cond.wait()
+        with self._lock:
+            if not self._unpublished or self._unpublished[0] is not entry:
+                raise FileStorageError(
+                    "The storage was closed before a transaction was "
+                    "published")
+            # The next transaction waits for the storage lock.
+            with cond:
+                self._unpublished.pop(0)
+                cond.notify_all()
+            try:
+                with self._files.finish(tid):
+                    if f is not None:
+                        f(tid)
+                    if end is not None:
+                        self._publish(tid, tpos, end, tindex)
+            except:
+                logger.critical("Failure publishing transaction. Closing.",
+                                exc_info=True)
+                self._unpublished_failed()
+                raise
+
+    def _wait_published(self):
+        # Wait for the transactions written to be published.  The
+        # commit lock must be held, so no more are written.
+        cond = self._unpublished_cond
+        while 1:
+            with cond:
+                while self._unpublished:
+                    cond.wait()
+            with self._lock:
+                # Transactions are published with the lock held.
+                if not self._unpublished:
+                    return
+
+    def _unpublished_failed(self):
+        # Close the storage, so that transactions waiting to be
+        # published aren't.
+        with self._lock:
+            cond = self._unpublished_cond
+            with cond:
+                del self._unpublished[:]
+                cond.notify_all()
+            self.close()
+
     def _abort(self):
         if self._nextpos:
             self._file.truncate(self._pos)
-            self._files.flush()
             self._nextpos=0
             self._blob_tpc_abort()
 
@@ -893,9 +1449,9 @@ class FileStorage(
         return h.tid, pos, data
 
     def getTid(self, oid):
-        with self._lock:
+        with self._files.get(maxtid) as _file:
             pos = self._lookup_pos(oid)
-            h = self._read_data_header(pos, oid)
+            h = self._read_data_header(pos, oid, _file)
             if h.plen == 0 and h.back == 0:
                 # Undone creation
                 raise POSKeyError(oid)
@@ -918,7 +1474,7 @@ class FileStorage(
 
         # First check if it is possible to undo this record.
         tpos = self._tindex.get(oid, 0)
-        ipos = self._index.get(oid, 0)
+        ipos = self._written_pos(oid)
         tipos = tpos or ipos
 
         if tipos != pos:
@@ -1009,7 +1565,8 @@ class FileStorage(
             if self._pack_is_in_progress:
                 raise UndoError(
                     'Undo is currently disabled for database maintenance.<p>')
-            us = UndoSearch(self._file, self._pos, first, last, filter)
+            us = UndoSearch(self._file, self._published_pos(),
+                            first, last, filter)
             while not us.finished():
                 # Hold lock for batches of 20 searches, so default search
                 # parameters will finish without letting another thread run.
@@ -1050,6 +1607,16 @@ class FileStorage(
           return self._tid, tindex.keys()
 
     def _txn_find(self, tid, stop_at_pack):
+        tids = self._tid_index()
+        pos = tids.get(tid)
+        if pos is not None:
+            self._file.seek(pos)
+            if self._file.read(8) == tid:
+                if stop_at_pack and pos < tids.packed:
+                    raise UndoError("Invalid transaction id")
+                return pos
+
+        # Transactions with out-of-order ids aren't in the index.
         pos = self._pos
         while pos > 39:
             self._file.seek(pos - 8)
@@ -1061,7 +1628,7 @@ class FileStorage(
                 return pos
             if stop_at_pack:
                 # check the status field of the transaction header
-                if h[16] == b'p':
+                if h[16:17] == b'p':
                     break
         raise UndoError("Invalid transaction id")
 
@@ -1137,15 +1704,15 @@ class FileStorage(
         return tindex
 
     def history(self, oid, size=1, filter=None):
-        with self._lock:
+        with self._files.get(maxtid) as _file:
             r = []
             pos = self._lookup_pos(oid)
 
             while 1:
                 if len(r) >= size: return r
-                h = self._read_data_header(pos)
+                h = self._read_data_header(pos, _file=_file)
 
-                th = self._read_txn_header(h.tloc)
+                th = self._read_txn_header(h.tloc, _file=_file)
                 if th.ext:
                     d = loads(th.ext)
                 else:
@@ -1235,7 +1802,14 @@ class FileStorage(
                 return
             have_commit_lock = True
             opos, index = pack_result
-            with self._files.write_lock():
+            # Commits are blocked, so wait for those written to be
+            # published before the file and index are replaced.
+            self._wait_published()
+            if self._refs is not None:
+                # Commits are blocked, so nothing is appended for the
+                # old file after this.
+                self._refs_appender.flush()
+            with self._files.write_lock(), self._swap_lock():
                 with self._lock:
                     self._files.empty()
                     self._file.close()
@@ -1247,9 +1821,19 @@ class FileStorage(
 
                     # OK, we're beyond the point of no return
                     os.rename(self._file_name + '.pack', self._file_name)
+                    self._pack_references()
                     self._file = open(self._file_name, 'r+b')
                     self._initIndex(index, self._tindex)
                     self._pos = opos
+                    self._files.set_size(opos)
+                    self._prefetched.clear()
+                    if self._revisions is not None:
+                        self._revisions.clear()
+                    # Rebuilt when it's needed.
+                    self._tids = None
+                    # Positions have changed. Don't checkpoint until
+                    # the packed index has been saved.
+                    self._checkpoint_pos = None
 
             # We're basically done.  Now we need to deal with removed
             # blobs and removing the .old file (see further down).
@@ -1271,6 +1855,38 @@ class FileStorage(
         with self._lock:
             self._save_index()
 
+    @contextlib.contextmanager
+    def _swap_lock(self):
+        # Keep syncs from using the data file while it's replaced.
+        if self._group_sync is None:
+            yield
+        else:
+            with self._group_sync.lock:
+                yield
+
+    def _loaded_references(self):
+        """Return the loaded references file, or None if not used
+        """
+        if self._refs is None:
+            return None
+        with self._files.get() as file:
+            self._refs.load(file)
+        return self._refs
+
+    def _pack_references(self):
+        # Replace the references with the ones written by the packer
+        # for the packed file, if any.
+        refs_name = self._file_name + '.refs'
+        pack_refs_name = self._file_name + '.pack.refs'
+        if self._refs is not None:
+            self._refs.close()
+        if os.path.exists(pack_refs_name):
+            if os.path.exists(refs_name):
+                os.remove(refs_name)
+            os.rename(pack_refs_name, refs_name)
+        elif os.path.exists(refs_name):
+            os.remove(refs_name)
+
     def _remove_blob_files_tagged_for_removal_during_pack(self):
         lblob_dir = len(self.blob_dir)
         fshelper = self.fshelper
@@ -1372,6 +1988,12 @@ class FileStorage(
                 link_or_copy(file_path, old+file_path[lblob_dir:])
 
     def iterator(self, start=None, stop=None):
+        if start:
+            with self._lock:
+                pos = self._tids.find(start) if self._tids else None
+            if pos is not None:
+                # Start at the first transaction at or after start.
+                return FileIterator(self._file_name, None, stop, pos)
         return FileIterator(self._file_name, start, stop)
 
     def lastInvalidations(self, count):
@@ -1379,7 +2001,7 @@ class FileStorage(
         seek = file.seek
         read = file.read
         with self._lock:
-            pos = self._pos
+            pos = self._published_pos()
             while count > 0 and pos > 4:
                 count -= 1
                 seek(pos-8)
@@ -1402,7 +2024,8 @@ class FileStorage(
 
     def cleanup(self):
         """Remove all files created by this storage."""
-        for ext in '', '.old', '.tmp', '.lock', '.index', '.pack':
+        for ext in ('', '.old', '.tmp', '.lock', '.index', '.tindex',
+                    '.pack'):
             try:
                 os.remove(self._file_name + ext)
             except OSError as e:
@@ -1573,7 +2196,8 @@ def recover(file_name):
 
 
 def read_index(file, name, index, tindex, stop=b'\377'*8,
-               ltid=z64, start=4, maxoid=z64, recover=0, read_only=0):
+               ltid=z64, start=4, maxoid=z64, recover=0, read_only=0,
+               processes=0, tids=None):
     """Scan the file storage and update the index.
 
     Returns file position, max oid, and last transaction id.  It also
@@ -1598,6 +2222,12 @@ def read_index(file, name, index, tindex, stop=b'\377'*8,
     maxoid -- ignored (it meant something prior to ZODB 3.2.6; the argument
               still exists just so the signature of read_index() stayed the
               same)
+    processes -- if greater than 1, and there's more than
+              index_rebuild_chunk_size of data to scan, the data records
+              are read by this many processes, each scanning a range of
+              transactions.  The resulting index is the same.
+    tids -- a TidIndex, or None.  The ids and positions of the
+              transactions read are added to it.
 
     The file position returned is the position just after the last
     valid transaction record.  The oid returned is the maximum object
@@ -1622,6 +2252,11 @@ def read_index(file, name, index, tindex, stop=b'\377'*8,
             file.write(packed_version)
         return 4, z64, ltid
 
+    if (processes > 1 and not recover and
+            file_size - start > index_rebuild_chunk_size):
+        start, ltid = _read_index_parallel(
+            file, name, index, stop, ltid, start, file_size, processes, tids)
+
     index_get = index.get
 
     pos = start
@@ -1702,6 +2337,8 @@ def read_index(file, name, index, tindex, stop=b'\377'*8,
                 panic('%s has inconsistent transaction length at %s',
                       name, pos)
             pos = tend + 8
+            if tids is not None:
+                tids.append(tid, tpos, status)
             continue
 
         pos = tpos + TRANS_HDR_LEN + ul + dl + el
@@ -1745,6 +2382,8 @@ def read_index(file, name, index, tindex, stop=b'\377'*8,
         pos += 8
 
         index.update(tindex)
+        if tids is not None:
+            tids.append(tid, tpos, status)
         tindex.clear()
 
     # Caution:  fsIndex doesn't have an efficient __nonzero__ or __len__.
@@ -1758,6 +2397,124 @@ def read_index(file, name, index, tindex, stop=b'\377'*8,
     return pos, maxoid, ltid
 
 
+# The minimum amount of data scanned by each process in a parallel
+# index rebuild.
+index_rebuild_chunk_size = 1 << 26
+
+def _read_index_parallel(file, name, index, stop, ltid, start, file_size,
+                         processes, tids=None):
+    """Update the index from transactions read by several processes
+
+    Transaction boundaries are found by reading just the transaction
+    headers.  The data records in ranges of transactions are then read
+    by a pool of processes and their positions are added to the index
+    in file order.  We stop at the first sign of trouble, returning the
+    position and previous transaction id from which read_index should
+    continue, so damaged data is handled as usual.
+    """
+    read = file.read
+    seek = file.seek
+    chunk_size = max((file_size - start) // (processes * 4),
+                     index_rebuild_chunk_size)
+    ranges = []
+    headers = [] # [(tid, pos, status)]
+    range_start = pos = start
+    range_ltid = ltid
+    while 1:
+        seek(pos)
+        h = read(TRANS_HDR_LEN)
+        if len(h) != TRANS_HDR_LEN:
+            break
+        tid, tl, status, ul, dl, el = unpack(TRANS_HDR, h)
+        if (tid >= stop or pos + tl + 8 > file_size or
+                status not in b' up' or tl < TRANS_HDR_LEN + ul + dl + el):
+            break
+        if tid <= ltid:
+            logger.warning("%s time-stamp reduction at %s", name, pos)
+        ltid = tid
+        if tids is not None:
+            headers.append((tid, pos, as_text(status)))
+        pos += tl + 8
+        if pos - range_start >= chunk_size:
+            ranges.append((range_start, pos, range_ltid))
+            range_start = pos
+            range_ltid = ltid
+    if pos > range_start:
+        ranges.append((range_start, pos, range_ltid))
+
+    if len(ranges) < 2:
+        return start, ranges[0][2] if ranges else ltid
+
+    pool = multiprocessing.Pool(min(processes, len(ranges)))
+    try:
+        results = pool.imap(
+            _read_index_range, [(name, s, e) for (s, e, _) in ranges])
+        index_get = index.get
+        i = 0
+        for (range_start, range_end, range_ltid), r in zip(ranges, results):
+            if r is None:
+                return range_start, range_ltid
+            positions, prevs = r
+            # Check the back pointers of the first records for each
+            # object in the range, as read_index does.
+            for oid, (pos, prev) in prevs.items():
+                if index_get(oid, 0) != prev:
+                    if prev:
+                        logger.error("%s incorrect previous pointer at %s",
+                                     name, pos)
+                    else:
+                        logger.warning("%s incorrect previous pointer at %s",
+                                       name, pos)
+            index.update(positions)
+            while i < len(headers) and headers[i][1] < range_end:
+                tids.append(*headers[i])
+                i += 1
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return range_end, ltid
+
+def _read_index_range(args):
+    # Read the data records for the transactions in a range of a file.
+    # Return a mapping from oid to position of the last record for each
+    # object and a mapping from oid to the position and previous-record
+    # pointer of its first record, or None if there's a problem.
+    name, pos, end = args
+    positions = {}
+    prevs = {}
+    with open(name, 'rb', 1 << 20) as f:
+        read = f.read
+        f.seek(pos)
+        while pos < end:
+            tid, tl, status, ul, dl, el = unpack(TRANS_HDR, read(TRANS_HDR_LEN))
+            tpos = pos
+            tend = tpos + tl
+            if status != b'u':
+                pos = tpos + TRANS_HDR_LEN + ul + dl + el
+                f.seek(pos)
+                while pos < tend:
+                    oid, serial, prev, tloc, vlen, plen = unpack(
+                        DATA_HDR, read(DATA_HDR_LEN))
+                    dlen = DATA_HDR_LEN + (plen or 8)
+                    if vlen or pos + dlen > tend or tloc != tpos:
+                        return None
+                    last = positions.get(oid)
+                    if last is None:
+                        prevs[oid] = pos, prev
+                    elif last != prev:
+                        return None
+                    positions[oid] = pos
+                    pos += dlen
+                    f.seek(pos)
+                if pos != tend:
+                    return None
+            f.seek(tend)
+            if u64(read(8)) != tl:
+                return None
+            pos = tend + 8
+    return positions, prevs
+
 def _truncate(file, name, pos):
     file.seek(0, 2)
     file_size = file.tell()
@@ -1789,9 +2546,12 @@ class FileIterator(FileStorageFormatter):
     _ltid = z64
     _file = None
 
+    # The amount of data read at a time.
+    read_window = 1 << 22
+
     def __init__(self, filename, start=None, stop=None, pos=4):
         assert isinstance(filename, STRING_TYPES)
-        file = open(filename, 'rb')
+        file = WindowedFile(open(filename, 'rb'), self.read_window)
         self._file = file
         self._file_name = filename
         if file.read(4) != packed_version:
@@ -2144,14 +2904,342 @@ class UndoSearch(object):
         d.update(e)
         return d
 
+class RevisionIndex(object):
+    """The revisions of objects with many of them
+
+    For each object indexed, the ids of the transactions that wrote
+    its revisions and the positions of their data records are kept in
+    lists, oldest first, so the revision current at a transaction can
+    be found with a binary search.  Objects are indexed when loading
+    one of their revisions follows at least ``threshold`` back
+    pointers.  The least recently used objects are discarded when
+    more than ``size`` revisions are indexed.
+    """
+
+    def __init__(self, threshold, size=100000):
+        self.threshold = threshold
+        self.size = size
+        self.revisions = 0 # The number of revisions indexed
+        self._lock = utils.Lock()
+        self._data = OrderedDict() # {oid -> ([tid], [pos])}
+
+    def __len__(self):
+        return len(self._data)
+
+    def _get(self, oid):
+        # Get an object's revisions, marking it as recently used.
+        r = self._data.pop(oid, None)
+        if r is not None:
+            self._data[oid] = r
+        return r
+
+    def _reduce(self):
+        while self.revisions > self.size and self._data:
+            _, (tids, _) = self._data.popitem(False)
+            self.revisions -= len(tids)
+
+    def before(self, oid, tid):
+        """Find the revision of an object before a transaction
+
+        Return the position of its data record and the id of the
+        transaction that wrote the next revision, or None if it's
+        current.  The position is 0 if there's no revision before the
+        transaction.  None is returned if the object isn't indexed.
+        """
+        with self._lock:
+            r = self._get(oid)
+            if r is None:
+                return None
+            tids, positions = r
+            i = bisect.bisect_left(tids, tid)
+            return (positions[i - 1] if i else 0,
+                    tids[i] if i < len(tids) else None)
+
+    def serial(self, oid, tid):
+        """Return the position of the revision written by a transaction
+
+        0 is returned if there isn't one, and None if the object isn't
+        indexed.
+        """
+        with self._lock:
+            r = self._get(oid)
+            if r is None:
+                return None
+            tids, positions = r
+            i = bisect.bisect_left(tids, tid)
+            if i < len(tids) and tids[i] == tid:
+                return positions[i]
+            return 0
+
+    def add(self, oid, tids, positions, index_get):
+        """Index an object's revisions
+
+        They're discarded if a revision was committed after the
+        revisions were read.
+        """
+        with self._lock:
+            if positions and index_get(oid, 0) == positions[-1]:
+                old = self._data.pop(oid, None)
+                if old is not None:
+                    self.revisions -= len(old[0])
+                self._data[oid] = tids, positions
+                self.revisions += len(tids)
+                self._reduce()
+
+    def committed(self, tid, tindex):
+        """Add the revisions written by a transaction
+
+        Objects indexed after the transaction was committed already
+        have its revisions.
+        """
+        data = self._data
+        with self._lock:
+            for oid, pos in tindex.items():
+                r = data.get(oid)
+                if r is not None and tid > r[0][-1]:
+                    r[0].append(tid)
+                    r[1].append(pos)
+                    self.revisions += 1
+            self._reduce()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.revisions = 0
+
+
+class PrefetchCache(object):
+    """Records read by FileStorage.prefetch, waiting to be loaded
+
+    Entries are keyed by oid and the tid passed to loadBefore.  They
+    are removed when loaded and the oldest entries are discarded when
+    the total data size exceeds the cache size.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.bytes = 0
+        self.generation = 0 # incremented when entries are invalidated
+        self._data = OrderedDict()
+        self._tids = {} # {oid -> set of tids}
+        self._lock = utils.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def store(self, oid, tid, r, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return # Read before an invalidation
+            self._pop(oid, tid)
+            self._data[oid, tid] = r
+            self._tids.setdefault(oid, set()).add(tid)
+            self.bytes += len(r[0])
+            while self.bytes > self.size and self._data:
+                oid, tid = next(iter(self._data))
+                self._pop(oid, tid)
+
+    def _pop(self, oid, tid):
+        r = self._data.pop((oid, tid), None)
+        if r is not None:
+            self.bytes -= len(r[0])
+            tids = self._tids[oid]
+            tids.discard(tid)
+            if not tids:
+                del self._tids[oid]
+        return r
+
+    def pop(self, oid, tid):
+        with self._lock:
+            return self._pop(oid, tid)
+
+    def invalidate(self, oids):
+        # Committing an object gives its cached records an end tid.
+        with self._lock:
+            self.generation += 1
+            for oid in oids:
+                for tid in self._tids.pop(oid, ()):
+                    self.bytes -= len(self._data.pop((oid, tid))[0])
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+            self._tids.clear()
+            self.bytes = 0
+
+
+class IndexCheckpointer(object):
+    """Append index changes to a delta file in a background thread
+    """
+
+    _thread = None
+
+    def __init__(self, file_name):
+        self.name = file_name
+        self._queue = Queue()
+
+    def write(self, start, end, changes):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='index checkpoints for ' + self.name)
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put((start, end, changes))
+
+    def _run(self):
+        queue = self._queue
+        while 1:
+            item = queue.get()
+            try:
+                if item is None:
+                    break
+                with open(self.name, 'ab') as f:
+                    write_delta(f, *item)
+                    f.flush()
+                    if fsync is not None:
+                        fsync(f.fileno())
+            except Exception:
+                logger.exception("Error writing index checkpoint")
+            finally:
+                queue.task_done()
+
+    def flush(self):
+        """Wait for pending changes to be written."""
+        self._queue.join()
+
+    def remove(self):
+        self.flush()
+        if os.path.exists(self.name):
+            os.remove(self.name)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+class ReferencesAppender(object):
+    """Append references for committed transactions in a background thread
+
+    Transactions are read back from the data file with files from the
+    storage's file pool, in the order they were committed.  If their
+    references can't be written, they're extracted again when they're
+    needed.
+    """
+
+    _thread = None
+
+    def __init__(self, references, files):
+        self.references = references
+        self._files = files
+        self._queue = Queue()
+
+    def write(self, start, end):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run,
+                name='references for ' + self.references.name)
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put((start, end))
+
+    def _run(self):
+        queue = self._queue
+        while 1:
+            item = queue.get()
+            try:
+                if item is None:
+                    break
+                start, end = item
+                with self._files.get() as file:
+                    for record in iter_refs(file, start, end, referencesf):
+                        self.references.append(*record)
+            except Exception:
+                logger.exception("Error writing references")
+            finally:
+                queue.task_done()
+
+    def flush(self):
+        """Wait for pending references to be written."""
+        self._queue.join()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+class GroupSync(object):
+    """Sync a file for a group of committers at once
+
+    Committers call :meth:`sync` after flushing their writes.  If a
+    sync is in progress, they wait for it to finish and then one of
+    them syncs the file for all of the committers that were waiting.
+    The ``lock`` is held while syncing, so the file can be replaced
+    while it's held.
+    """
+
+    def __init__(self, get_file):
+        self._get_file = get_file
+        self.lock = utils.Lock()
+        self._cond = utils.Condition()
+        self._requested = 0 # Number of sync requests
+        self._synced = 0 # Number of requests satisfied
+        self._syncing = False
+        self.syncs = 0 # Number of syncs made, for testing
+
+    def sync(self):
+        with self._cond:
+            self._requested += 1
+            request = self._requested
+            while self._synced < request:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+
+                # Sync for all of the requests made so far.
+                self._syncing = True
+                requested = self._requested
+                self._cond.release()
+                try:
+                    with self.lock:
+                        fsync(self._get_file().fileno())
+                        self.syncs += 1
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                    self._cond.notify_all()
+                self._synced = requested
+
+
 class FilePool(object):
+    """Files for reading the committed part of a data file
+
+    Readers only see data below `size`, either through buffers that
+    never extend past it or through a memory map of it, and committed
+    data aren't changed until the file is replaced by packing.  So
+    commits and aborts only need to update the size and don't wait
+    for readers.  `write_lock` is only needed to replace the file, and
+    waits for all readers to be returned.
+
+    While a transaction is being finished, readers that want data
+    committed before later transaction ids wait for it, so that they
+    see its data.
+    """
 
     closed = False
     writing = False
     writers = 0
+    finishing = None
+    size = 0
+    _map = None
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, use_mmap=False):
         self.name = file_name
+        self.use_mmap = use_mmap
         self._files = []
         self._out = []
         self._cond = utils.Condition()
@@ -2176,42 +3264,96 @@ class FilePool(object):
                 self._cond.notifyAll()
 
     @contextlib.contextmanager
-    def get(self):
+    def finish(self, tid):
+        """Mark the transaction with the given id as being finished
+        """
+        with self._cond:
+            self.finishing = tid
+        try:
+            yield None
+        finally:
+            with self._cond:
+                self.finishing = None
+                self._cond.notifyAll()
+
+    @contextlib.contextmanager
+    def get(self, before=None):
+        """Get a file for reading committed data
+
+        If ``before`` is given, data committed before it are wanted,
+        and we wait for a transaction with a lower id being finished.
+        """
         with self._cond:
-            while self.writers:
+            while self.writers or (before is not None and
+                                   self.finishing is not None and
+                                   before > self.finishing):
                 self._cond.wait()
             assert not self.writing
             if self.closed:
                 raise ValueError('closed')
 
-            try:
-                f = self._files.pop()
-            except IndexError:
-                f = open(self.name, 'rb')
+            if self.use_mmap:
+                f = MappedFile(self._mapping(), self)
+            else:
+                try:
+                    f = self._files.pop()
+                except IndexError:
+                    f = CommittedFile(self.name, self)
             self._out.append(f)
 
         try:
             yield f
         finally:
             self._out.remove(f)
-            self._files.append(f)
+            if not self.use_mmap:
+                self._files.append(f)
             if not self._out:
                 with self._cond:
                     if self.writers and not self._out:
                         self._cond.notifyAll()
 
+    def mapping(self):
+        """Return a mapping of the committed part of the file
+        """
+        with self._cond:
+            return self._mapping()
+
+    def _mapping(self):
+        # Map the committed part of the file.  Must be called with
+        # the condition held.
+        if self._map is None:
+            if self.size:
+                with open(self.name, 'rb') as f:
+                    self._map = mmap.mmap(
+                        f.fileno(), self.size, access=mmap.ACCESS_READ)
+            else:
+                self._map = b''
+        return self._map
+
+    def set_size(self, size):
+        """Set the size of the committed part of the file.
+
+        When using a memory map, the file is remapped the next time
+        a reader is requested.  Readers that are out keep using the
+        mapping they have until they need data past its end.
+        """
+        with self._cond:
+            if size != self.size:
+                self.size = size
+                self._map = None
+
     def empty(self):
         while self._files:
             self._files.pop().close()
+        self._map = None
 
 
     def flush(self):
         """Empty read buffers.
 
-        This is required if they contain data of rolled back transactions.
+        Buffers never contain uncommitted data, so this isn't needed
+        when transactions are rolled back.
         """
-        # Unfortunately, Python 3.x has no API to flush read buffers, and
-        # the API is ineffective in Python 2 on Mac OS X.
         with self.write_lock():
             self.empty()
 
@@ -84,6 +84,7 @@
 #   data.  Instead, we write records with back pointers.
 
 import logging
+import os
 import struct
 
 from ZODB.POSException import POSKeyError
@@ -143,6 +144,9 @@ class FileStorageFormatter(object):
         if _file is None:
             _file = self._file
 
+        if _file.__class__ is MappedFile:
+            return _file.read_data_header(pos, oid)
+
         _file.seek(pos)
         s = _file.read(DATA_HDR_LEN)
         if len(s) != DATA_HDR_LEN:
@@ -154,17 +158,19 @@ class FileStorageFormatter(object):
             h.back = u64(_file.read(8))
         return h
 
-    def _read_txn_header(self, pos, tid=None):
-        self._file.seek(pos)
-        s = self._file.read(TRANS_HDR_LEN)
+    def _read_txn_header(self, pos, tid=None, _file=None):
+        if _file is None:
+            _file = self._file
+        _file.seek(pos)
+        s = _file.read(TRANS_HDR_LEN)
         if len(s) != TRANS_HDR_LEN:
             raise CorruptedDataError(tid, s, pos)
         h = TxnHeaderFromString(s)
         if tid is not None and tid != h.tid:
             raise CorruptedDataError(tid, s, pos)
-        h.user = self._file.read(h.ulen)
-        h.descr = self._file.read(h.dlen)
-        h.ext = self._file.read(h.elen)
+        h.user = _file.read(h.ulen)
+        h.descr = _file.read(h.dlen)
+        h.ext = _file.read(h.elen)
         return h
 
     def _loadBack_impl(self, oid, back, fail=True, _file=None):
@@ -232,6 +238,208 @@ class FileStorageFormatter(object):
             if dh.plen:
                 self.fail(pos, "data record has back pointer and data")
 
+class MappedFile(object):
+    """Read-only file-like view of a memory-mapped data file
+
+    Each reader gets its own view, with its own position, of a shared
+    mapping.  Data may be committed after the mapping is made, so when
+    reads go past its end and more data have been committed, the view
+    switches to a mapping of the committed data from ``committed``, a
+    file pool.  Reads past the end of the committed data return short
+    data, as they would at the end of a file.
+    """
+
+    __slots__ = ("buf", "size", "pos", "committed")
+
+    def __init__(self, buf, committed=None):
+        self.buf = buf
+        self.size = len(buf)
+        self.pos = 0
+        self.committed = committed
+
+    def _extend(self, end):
+        # Use a mapping of data committed since ours was made, if we
+        # need them.
+        committed = self.committed
+        if (committed is not None and end > self.size and
+                committed.size > self.size):
+            self.buf = committed.mapping()
+            self.size = len(self.buf)
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.size
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.buf = b''
+        self.size = self.pos = 0
+
+    def read(self, size=-1):
+        pos = self.pos
+        if size < 0:
+            end = self.size
+        else:
+            if pos + size > self.size:
+                self._extend(pos + size)
+            end = min(pos + size, self.size)
+        self.pos = max(end, pos)
+        return self.buf[pos:end]
+
+    def read_data_header(self, pos, oid=None):
+        """Return a DataHeader object for data record at pos.
+
+        This parses the header in place rather than copying it out
+        of the mapping first.
+        """
+        if pos + DATA_HDR_LEN + 8 > self.size:
+            self._extend(pos + DATA_HDR_LEN + 8)
+        buf = self.buf
+        if pos + DATA_HDR_LEN > self.size:
+            self.pos = self.size
+            raise CorruptedDataError(oid, buf[pos:pos+DATA_HDR_LEN], pos)
+        h = DataHeader(*struct.unpack_from(DATA_HDR, buf, pos))
+        if oid is not None and oid != h.oid:
+            raise CorruptedDataError(oid, buf[pos:pos+DATA_HDR_LEN], pos)
+        pos += DATA_HDR_LEN
+        if not h.plen:
+            if pos + 8 > self.size:
+                raise CorruptedDataError(oid, buf[pos:pos+8], pos)
+            h.back, = struct.unpack_from(">Q", buf, pos)
+            pos += 8
+        self.pos = pos
+        return h
+
+class CommittedFile(object):
+    """Read-only file wrapper that only buffers committed data
+
+    Reads are buffered, but the buffer never extends past the size of
+    the committed part of the file, given by the size attribute of
+    ``committed``, so it can't hold data that's later overwritten, as
+    when a transaction is aborted.  Data past the committed size are
+    read without buffering.
+    """
+
+    def __init__(self, file_name, committed, buffer_size=8192):
+        self._file = open(file_name, 'rb', 0)
+        self._committed = committed
+        self.buffer_size = buffer_size
+        self._buf = b''
+        self._start = 0
+        self._pos = 0
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self._committed.size
+        self._pos = pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._file.close()
+        self._buf = b''
+
+    def read(self, size=-1):
+        pos = self._pos
+        committed = self._committed.size
+        if size < 0:
+            size = max(committed - pos, 0)
+        offset = pos - self._start
+        if offset >= 0 and offset + size <= len(self._buf):
+            data = self._buf[offset:offset + size]
+        else:
+            self._file.seek(pos)
+            if pos + size <= committed:
+                self._buf = self._file.read(
+                    max(size, min(self.buffer_size, committed - pos)))
+                self._start = pos
+                data = self._buf[:size]
+            else:
+                data = self._file.read(size)
+        self._pos = pos + len(data)
+        return data
+
+posix_fadvise = getattr(os, 'posix_fadvise', None)
+
+class WindowedFile(object):
+    """Read-only file wrapper for reading a file front to back
+
+    Data are read in large windows, so seeks and reads within the
+    current window don't need system calls.  Where the platform
+    supports it, the kernel is told that the file will be read
+    sequentially and asked to start reading each next window while the
+    current one is used.  Reads before the current window, as when
+    following back pointers, are made directly, so they don't discard
+    the window.
+    """
+
+    def __init__(self, file, window=1<<22):
+        self._file = file
+        self.name = file.name
+        self.window = window
+        self._buf = b''
+        self._start = 0
+        self._pos = file.tell()
+        if posix_fadvise is not None:
+            try:
+                posix_fadvise(file.fileno(), 0, 0,
+                              os.POSIX_FADV_SEQUENTIAL)
+            except (OSError, AttributeError):
+                pass
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            self._file.seek(0, 2)
+            pos += self._file.tell()
+        self._pos = pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._buf = b''
+        self._file.close()
+
+    def read(self, size=-1):
+        pos = self._pos
+        offset = pos - self._start
+        if size < 0 or pos < self._start:
+            self._file.seek(pos)
+            data = self._file.read(size)
+        elif offset + size <= len(self._buf):
+            data = self._buf[offset:offset+size]
+        else:
+            self._fill(pos, size)
+            data = self._buf[:size]
+        self._pos = pos + len(data)
+        return data
+
+    def _fill(self, pos, size):
+        size = max(size, self.window)
+        self._buf = b''
+        self._file.seek(pos)
+        self._buf = self._file.read(size)
+        self._start = pos
+        if posix_fadvise is not None and len(self._buf) == size:
+            try:
+                posix_fadvise(self._file.fileno(), pos + size, size,
+                              os.POSIX_FADV_WILLNEED)
+            except (OSError, AttributeError):
+                pass
+
 def DataHeaderFromString(s):
     return DataHeader(*struct.unpack(DATA_HDR, s))
 
@@ -26,13 +26,17 @@ a backpointer after that time.
 
 from ZODB.FileStorage.format import DataHeader, TRANS_HDR_LEN
 from ZODB.FileStorage.format import FileStorageFormatter, CorruptedDataError
+from ZODB.FileStorage.references import ReferencesFile, datapos
 from ZODB.utils import p64, u64, z64
 
 import binascii
+import collections
 import logging
+import multiprocessing
 import os
 import ZODB.fsIndex
 import ZODB.POSException
+import ZODB.serialize
 
 logger = logging.getLogger(__name__)
 
@@ -146,7 +150,8 @@ class PackCopier(FileStorageFormatter):
 
 class GC(FileStorageFormatter):
 
-    def __init__(self, file, eof, packtime, gc, referencesf):
+    def __init__(self, file, eof, packtime, gc, referencesf, processes=0,
+                 references=None):
         self._file = file
         self._name = file.name
         self.eof = eof
@@ -175,6 +180,14 @@ class GC(FileStorageFormatter):
 
         self.referencesf = referencesf
 
+        # If greater than 1, the number of processes used to extract
+        # references from object records.
+        self.processes = processes
+        self._pool = None
+
+        # A loaded ReferencesFile to look up references in, if any.
+        self.references = references
+
     def isReachable(self, oid, pos):
         """Return 1 if revision of `oid` at `pos` is reachable."""
 
@@ -188,8 +201,16 @@ class GC(FileStorageFormatter):
     def findReachable(self):
         self.buildPackIndex()
         if self.gc:
-            self.findReachableAtPacktime([z64])
-            self.findReachableFromFuture()
+            if self.processes > 1:
+                self._pool = multiprocessing.Pool(self.processes)
+            try:
+                self.findReachableAtPacktime([z64])
+                self.findReachableFromFuture()
+            finally:
+                if self._pool is not None:
+                    self._pool.terminate()
+                    self._pool.join()
+                    self._pool = None
             # These mappings are no longer needed and may consume a lot of
             # space.
             del self.oid2curpos
@@ -255,6 +276,9 @@ class GC(FileStorageFormatter):
 
     def findReachableAtPacktime(self, roots):
         """Mark all objects reachable from the oids in roots as reachable."""
+        if self._pool is not None:
+            return self._findReachableAtPacktimeBatched(roots)
+
         reachable = self.reachable
         oid2curpos = self.oid2curpos
 
@@ -315,20 +339,99 @@ class GC(FileStorageFormatter):
                           tlen, th.tlen)
             pos += 8
 
-        for pos in extra_roots:
-            refs = self.findrefs(pos)
+        if self._pool is not None:
+            refs = []
+            for oids in self._findrefsBatched(sorted(extra_roots)):
+                refs.extend(oids)
             self.findReachableAtPacktime(refs)
+        else:
+            for pos in extra_roots:
+                refs = self.findrefs(pos)
+                self.findReachableAtPacktime(refs)
 
     def findrefs(self, pos):
         """Return a list of oids referenced as of packtime."""
+        refs, data = self._readrefs(pos)
+        if refs is None:
+            refs = self.referencesf(data)
+        return refs
+
+    def _readrefs(self, pos):
+        # Return the references for the record at pos if they're
+        # recorded, otherwise None and the pickle to get them from.
+        pos = datapos(self, pos)
+        if not pos:
+            return [], None
+        if self.references is not None:
+            refs = self.references.get(pos)
+            if refs is not None:
+                return refs, None
         dh = self._read_data_header(pos)
-        # Chase backpointers until we get to the record with the refs
-        while dh.back:
-            dh = self._read_data_header(dh.back)
-        if dh.plen:
-            return self.referencesf(self._file.read(dh.plen))
-        else:
-            return []
+        return None, self._file.read(dh.plen)
+
+    def _findReachableAtPacktimeBatched(self, roots):
+        # Explore the object graph a level at a time.  Each level's
+        # records are read in file order and their references are
+        # extracted by the process pool.  Reachability doesn't depend
+        # on the order in which objects are visited, so the result is
+        # the same as a depth-first walk.
+        reachable = self.reachable
+        oid2curpos = self.oid2curpos
+
+        todo = list(roots)
+        while todo:
+            positions = []
+            for oid in todo:
+                if oid in reachable:
+                    continue
+                try:
+                    pos = oid2curpos[oid]
+                except KeyError:
+                    if oid == z64 and len(oid2curpos) == 0:
+                        # special case, pack to before creation time
+                        continue
+                    raise
+                reachable[oid] = pos
+                positions.append(pos)
+
+            positions.sort()
+            todo = []
+            for oids in self._findrefsBatched(positions):
+                for oid in oids:
+                    if oid not in reachable:
+                        todo.append(oid)
+
+    def _findrefsBatched(self, positions):
+        # Return lists of the oids referenced by the records at the
+        # given positions.  Records are read in batches, which are
+        # handed to the pool as they're read, so reading overlaps
+        # reference extraction.  To limit memory use, we wait for the
+        # oldest batch when there are two per process outstanding.
+        pending = collections.deque()
+        for i in range(0, len(positions), pack_gc_batch_size):
+            if len(pending) >= 2 * self.processes:
+                for oids in pending.popleft().get():
+                    yield oids
+            batch = []
+            for pos in positions[i:i+pack_gc_batch_size]:
+                refs, data = self._readrefs(pos)
+                if refs is None:
+                    batch.append(data)
+                else:
+                    yield refs
+            if batch:
+                pending.append(self._pool.apply_async(
+                    _findrefs, (self.referencesf, batch)))
+        while pending:
+            for oids in pending.popleft().get():
+                yield oids
+
+# The number of records whose references are extracted by each
+# process-pool task when pack garbage collection uses several processes.
+pack_gc_batch_size = 1000
+
+def _findrefs(referencesf, batch):
+    return [referencesf(data) for data in batch]
 
 class FileStoragePacker(FileStorageFormatter):
 
@@ -359,8 +462,21 @@ class FileStoragePacker(FileStorageFormatter):
         self._stop = stop
         self.locked = False
         self.file_end = storage.getSize()
+        self.referencesf = referencesf
+
+        # If the storage records references, and they're the ones
+        # we'd extract, we use them and write references for the
+        # packed file.
+        self.references = self._pack_references = None
+        if (storage._refs is not None and
+                referencesf is ZODB.serialize.referencesf):
+            self.references = storage._refs
+            self._pack_references = ReferencesFile(path + '.pack.refs')
+            self._pack_references.remove()
+        self._trefs = []
 
-        self.gc = GC(self._file, self.file_end, self._stop, gc, referencesf)
+        self.gc = GC(self._file, self.file_end, self._stop, gc, referencesf,
+                     getattr(storage, 'pack_gc_processes', 0), self.references)
 
         # The packer needs to acquire the parent's commit lock
         # during the copying stage, so the two sets of lock acquire
@@ -385,6 +501,10 @@ class FileStoragePacker(FileStorageFormatter):
         self._file.close()
         if self._tfile is not None:
             self._tfile.close()
+        if self.references is not None:
+            # Release the loaded references.
+            self.references.close()
+            self._pack_references.close()
         if self.blob_removed is not None:
             self.blob_removed.close()
 
@@ -402,6 +522,9 @@ class FileStoragePacker(FileStorageFormatter):
 
         # TODO:  Should add sanity checking to pack.
 
+        if self.references is not None:
+            self.updateReferences()
+
         self.gc.findReachable()
 
         def close_files_remove():
@@ -419,6 +542,11 @@ class FileStoragePacker(FileStorageFormatter):
                 os.remove(self._name + ".pack")
             except:
                 pass
+            if self._pack_references is not None:
+                try:
+                    self._pack_references.remove()
+                except:
+                    pass
             if self.blob_removed is not None:
                 self.blob_removed.close()
 
@@ -472,6 +600,8 @@ class FileStoragePacker(FileStorageFormatter):
             pos = self._tfile.tell()
             self._tfile.flush()
             self._tfile.close()
+            if self._pack_references is not None:
+                self._pack_references.close()
             self._file.close()
             if self.blob_removed is not None:
                 self.blob_removed.close()
@@ -484,10 +614,34 @@ class FileStoragePacker(FileStorageFormatter):
                 self._commit_lock.release()
             raise  # don't succeed silently
         except:
+            if self._pack_references is not None:
+                self._pack_references.remove()
             if self.locked:
                 self._commit_lock.release()
             raise
 
+    def updateReferences(self):
+        # Add references for the transactions that aren't covered by
+        # the storage's references file.
+        references = self.references
+        references.update(self._file, self.file_end, self.referencesf)
+        # Catch up with transactions committed since the pack started
+        # while commits are blocked, once the references being
+        # appended for them have been written, so the references
+        # commits add are used from now on.
+        with self._lock:
+            self._storage._refs_appender.flush()
+            with open(self._path, 'rb') as f:
+                references.update(f, self._storage._pos, self.referencesf)
+
+    def _references(self, pos, data):
+        # Return the oids referenced by data, the data for the record
+        # at pos.
+        refs = self.references.get(datapos(self, pos))
+        if refs is None:
+            refs = self.referencesf(data)
+        return refs
+
     def copyToPacktime(self):
         offset = 0  # the amount of space freed by packing
         pos = self._metadata_size
@@ -505,7 +659,10 @@ class FileStoragePacker(FileStorageFormatter):
                 self._tfile.write(p64(tlen))
                 self._tfile.seek(new_pos - 8)
                 self._tfile.write(p64(tlen))
-
+                if self._pack_references is not None:
+                    self._pack_references.append(
+                        new_tpos, new_pos, th.tid, self._trefs)
+                    self._trefs = []
 
             tlen = self._read_num(pos)
             if tlen != th.tlen:
@@ -530,6 +687,7 @@ class FileStoragePacker(FileStorageFormatter):
         pos += th.headerlen()
         while pos < tend:
             h = self._read_data_header(pos)
+            rpos = pos
             if not self.gc.isReachable(h.oid, pos):
                 if self.pack_blobs:
                     # We need to find out if this is a blob, so get the data:
@@ -577,6 +735,9 @@ class FileStoragePacker(FileStorageFormatter):
             else:
                 data = self.fetchDataViaBackpointer(h.oid, h.back)
 
+            if data and self._pack_references is not None:
+                self._trefs.append(
+                    (self._tfile.tell(), self._references(rpos, data)))
             self.writePackedDataRecord(h, data, new_tpos)
             new_pos = self._tfile.tell()
 
@@ -644,6 +805,7 @@ class FileStoragePacker(FileStorageFormatter):
 
         while ipos < tend:
             h = self._read_data_header(ipos)
+            rpos = ipos
             ipos += h.recordlen()
             prev_txn = None
             if h.plen:
@@ -653,6 +815,9 @@ class FileStoragePacker(FileStorageFormatter):
                 if h.back:
                     prev_txn = self.getTxnFromData(h.oid, h.back)
 
+            if data and self._pack_references is not None:
+                self._trefs.append(
+                    (self._tfile.tell(), self._references(rpos, data)))
             self._copier.copy(h.oid, h.tid, data, prev_txn,
                               pos, self._tfile.tell())
 
@@ -660,6 +825,10 @@ class FileStoragePacker(FileStorageFormatter):
         assert tlen == th.tlen
         self._tfile.write(p64(tlen))
         ipos += 8
+        if self._pack_references is not None:
+            self._pack_references.append(
+                pos, pos + tlen + 8, th.tid, self._trefs)
+            self._trefs = []
 
         self.index.update(self.tindex)
         self.tindex.clear()
@@ -0,0 +1,293 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Record the oids referenced by FileStorage data records.
+
+Extracting references from a pickle means unpickling it.  To avoid
+doing that for every reachable record on every pack, a file storage
+can keep a sidecar file, with the same name as the data file and a
+``.refs`` suffix, mapping data record positions to the oids that the
+records' pickles reference.
+
+The file is a series of blocks, each covering a range of whole
+transactions in the data file and made of:
+
+  - A 32-byte header: the magic string, "ZFSR", the file positions of
+    the start and end of the range of transactions, the id of the last
+    transaction in the range and the number of bytes of entries.
+
+  - The entries, each an 8-byte data record position, a 4-byte number
+    of oids and the 8-byte oids.
+
+  - A 4-byte CRC-32 checksum of the header and entries.
+
+Blocks are only used if they continue from the end of the previous
+block used, so blocks written for some other version of the data file,
+or after a gap, are ignored.  A block that's partially written ends
+the file.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from ZODB.FileStorage.format import DATA_HDR
+from ZODB.FileStorage.format import DATA_HDR_LEN
+from ZODB.FileStorage.format import TRANS_HDR
+from ZODB.FileStorage.format import TRANS_HDR_LEN
+from ZODB.fsIndex import fsIndex
+from ZODB.utils import p64
+from ZODB.utils import u64
+
+logger = logging.getLogger(__name__)
+
+REFS_MAGIC = b'ZFSR'
+REFS_HEADER = ">4sQQ8sI"
+REFS_HEADER_LEN = 32
+REFS_ENTRY = ">QI"
+REFS_ENTRY_LEN = 12
+
+def refs_block(start, end, tid, records):
+    """Return a block for ``records``, a sequence of (pos, oids)
+    """
+    entries = b''.join(
+        struct.pack(REFS_ENTRY, pos, len(oids)) + b''.join(oids)
+        for (pos, oids) in records)
+    header = struct.pack(REFS_HEADER, REFS_MAGIC, start, end, tid,
+                         len(entries))
+    crc = zlib.crc32(entries, zlib.crc32(header)) & 0xffffffff
+    return header + entries + struct.pack(">I", crc)
+
+def iter_refs(file, pos, end, referencesf):
+    """Extract references from the transactions between pos and end
+
+    Yield the start and end position and id of each transaction, and
+    a list of the positions of its data records with pickles and the
+    oids they reference.  Records whose references can't be extracted
+    are left out, so they're extracted again when they're needed.
+    """
+    read = file.read
+    seek = file.seek
+    while pos < end:
+        seek(pos)
+        tid, tl, status, ul, dl, el = struct.unpack(
+            TRANS_HDR, read(TRANS_HDR_LEN))
+        tend = pos + tl
+        records = []
+        dpos = pos + TRANS_HDR_LEN + ul + dl + el
+        while dpos < tend:
+            seek(dpos)
+            oid, serial, prev, tloc, vlen, plen = struct.unpack(
+                DATA_HDR, read(DATA_HDR_LEN))
+            if plen:
+                try:
+                    records.append((dpos, referencesf(read(plen))))
+                except Exception:
+                    pass
+                dpos += DATA_HDR_LEN + plen
+            else:
+                dpos += DATA_HDR_LEN + 8
+        yield pos, tend + 8, tid, records
+        pos = tend + 8
+
+
+class ReferencesFile(object):
+    """A refs sidecar file
+
+    Blocks can be appended at any time.  To look up references, the
+    file must be loaded with `load`, which indexes the usable blocks.
+    """
+
+    _file = None
+    _map = None
+    _index = None
+    end = 4
+    tid = None
+    size = 0
+
+    def __init__(self, file_name):
+        self.name = file_name
+        self._lock = threading.Lock()
+
+    def append(self, start, end, tid, records):
+        """Append a block covering the transactions from start to end
+        """
+        block = refs_block(start, end, tid, records)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.name, 'ab')
+            offset = self._file.tell()
+            self._file.write(block)
+            self._file.flush()
+            self.size = offset + len(block)
+            if self._index is not None and start == self.end:
+                self._add(block, offset)
+
+    def _add(self, block, offset):
+        # Index the entries of a block at offset that continues from
+        # the end of the blocks used so far.
+        _, start, end, tid, size = struct.unpack_from(
+            REFS_HEADER, block, 0)
+        index = self._index
+        pos = REFS_HEADER_LEN
+        stop = REFS_HEADER_LEN + size
+        while pos < stop:
+            dpos, n = struct.unpack_from(REFS_ENTRY, block, pos)
+            index[p64(dpos)] = offset + pos
+            pos += REFS_ENTRY_LEN + 8 * n
+        self.end = end
+        self.tid = tid
+
+    def load(self, file):
+        """Index the blocks that can be used with a data file
+
+        If the blocks don't describe the data file, as when it's been
+        packed without updating the references, they're discarded.
+        """
+        with self._lock:
+            self._close()
+            self._index = fsIndex()
+            self.end = 4
+            self.tid = None
+            self.size = 0
+            if not os.path.exists(self.name):
+                return
+            with open(self.name, 'rb') as f:
+                offset = 0
+                while 1:
+                    header = f.read(REFS_HEADER_LEN)
+                    if len(header) < REFS_HEADER_LEN:
+                        break
+                    magic, start, end, tid, size = struct.unpack(
+                        REFS_HEADER, header)
+                    if magic != REFS_MAGIC:
+                        break
+                    entries = f.read(size)
+                    crc = f.read(4)
+                    if len(crc) < 4 or (struct.unpack(">I", crc)[0] !=
+                                        zlib.crc32(entries,
+                                                   zlib.crc32(header))
+                                        & 0xffffffff):
+                        break # Partially written
+                    if start == self.end:
+                        self._add(header + entries, offset)
+                    offset += REFS_HEADER_LEN + size + 4
+                self.size = offset
+
+            if self.tid is not None and not _ends_with(file, self.end,
+                                                       self.tid):
+                logger.warning("Ignoring out-of-date references in %s",
+                               self.name)
+                self._index = fsIndex()
+                self.end = 4
+                self.tid = None
+                self.size = 0
+
+    def update(self, file, end, referencesf):
+        """Add blocks for transactions from the end of the loaded ones
+
+        Transactions up to end are read from the data file and their
+        references are extracted with referencesf.
+        """
+        if self._index is None:
+            self.load(file)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.name, 'ab')
+            if self._file.tell() != self.size:
+                # Discard anything partially written or unusable.
+                self._file.truncate(self.size)
+                self._file.seek(self.size)
+        for record in iter_refs(file, self.end, end, referencesf):
+            self.append(*record)
+
+    def get(self, pos):
+        """Return the oids referenced by the record at pos
+
+        None is returned if the record isn't covered by loaded blocks.
+        """
+        with self._lock:
+            if self._index is None:
+                return None
+            offset = self._index.get(p64(pos))
+            if offset is None:
+                return None
+            if self._map is None or offset + REFS_ENTRY_LEN > len(self._map):
+                self._remap()
+            _, n = struct.unpack_from(REFS_ENTRY, self._map, offset)
+            if offset + REFS_ENTRY_LEN + 8 * n > len(self._map):
+                self._remap()
+            start = offset + REFS_ENTRY_LEN
+            data = self._map[start:start + 8 * n]
+        return [data[i:i+8] for i in range(0, len(data), 8)]
+
+    def _remap(self):
+        if self._file is not None:
+            self._file.flush()
+        if self._map is not None:
+            self._map.close()
+        with open(self.name, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._index = None
+
+    def close(self):
+        """Close the file and discard loaded blocks
+
+        Blocks can still be appended.  The file is reopened as needed.
+        """
+        with self._lock:
+            self._close()
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.name):
+            os.remove(self.name)
+
+
+def datapos(formatter, pos):
+    """Return the position of the record with the data for pos
+
+    Back pointers are followed from the data record at pos, which is
+    read with a FileStorageFormatter.  0 is returned if the record
+    found has no data.
+    """
+    dh = formatter._read_data_header(pos)
+    while dh.back:
+        pos = dh.back
+        dh = formatter._read_data_header(pos)
+    if dh.plen:
+        return pos
+    else:
+        return 0
+
+def _ends_with(file, end, tid):
+    # Check whether the transaction ending at end has the given id.
+    file.seek(0, 2)
+    if end > file.tell():
+        return False
+    file.seek(end - 8)
+    tl = u64(file.read(8))
+    if tl > end - 12:
+        return False
+    file.seek(end - 8 - tl)
+    return file.read(8) == tid
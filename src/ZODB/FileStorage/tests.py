@@ -31,6 +31,8 @@ checker = renormalizing.RENormalizing([
     (re.compile("ZODB.FileStorage.FileStorage.FileStorageQuotaError"),
                 "FileStorageQuotaError"),
     (re.compile('data.fs:[0-9]+'), 'data.fs:<OFFSET>'),
+    (re.compile("ZODB.FileStorage.FileStorage.CorruptedTransactionError"),
+                "CorruptedTransactionError"),
 ])
 
 def pack_keep_old():
@@ -187,6 +189,288 @@ cleanup
 
     """
 
+def parallel_index_rebuild():
+    """
+When there's no usable index, several processes can be used to read
+the data file.  The index is the same as one read by a single process.
+
+    >>> import sys
+    >>> from ZODB.fsIndex import fsIndex
+    >>> from ZODB.FileStorage.tidindex import TidIndex
+    >>> from ZODB.utils import p64, z64
+    >>> module = sys.modules['ZODB.FileStorage.FileStorage']
+    >>> fs = ZODB.FileStorage.FileStorage('data.fs')
+    >>> serials = {}
+    >>> for i in range(100):
+    ...     if i == 50:
+    ...         middle = fs._pos
+    ...     t = TransactionMetaData()
+    ...     fs.tpc_begin(t)
+    ...     for oid in map(p64, range(i % 7, 50, 3)):
+    ...         fs.store(oid, serials.get(oid, z64), b'x' * (i + 1), '', t)
+    ...     _ = fs.tpc_vote(t)
+    ...     tid = fs.tpc_finish(t)
+    ...     for oid in map(p64, range(i % 7, 50, 3)):
+    ...         serials[oid] = tid
+    ...     if i == 50:
+    ...         record = fs._lookup_pos(p64(1))
+    >>> fs.close()
+
+    >>> def rebuild(processes):
+    ...     index = fsIndex()
+    ...     tids = TidIndex()
+    ...     with open('data.fs', 'rb') as f:
+    ...         try:
+    ...             r = module.read_index(f, 'data.fs', index, {},
+    ...                                   read_only=1, processes=processes,
+    ...                                   tids=tids)
+    ...         except module.CorruptedTransactionError as e:
+    ...             return str(e)
+    ...     return r, index.items(), bytes(tids._data)
+
+    >>> old_chunk_size = module.index_rebuild_chunk_size
+    >>> module.index_rebuild_chunk_size = 10000
+    >>> rebuild(3) == rebuild(0)
+    True
+    >>> rebuild(3)[0][2] == tid
+    True
+    >>> len(rebuild(3)[2]) // 16
+    100
+
+Damaged data is handled as usual:
+
+    >>> with open('data.fs', 'r+b') as f:
+    ...     _ = f.seek(record + 24)
+    ...     _ = f.write(b'\\xff' * 8)
+    >>> rebuild(3) == rebuild(0)
+    True
+    >>> rebuild(3) == ('data.fs data record exceeds transaction record at %s'
+    ...                % record)
+    True
+
+    >>> with open('data.fs', 'r+b') as f:
+    ...     _ = f.seek(middle + 8)
+    ...     _ = f.write(b'\\xff' * 8)
+    >>> rebuild(3) == rebuild(0)
+    True
+    >>> rebuild(3)[0][0] == middle
+    True
+
+    >>> module.index_rebuild_chunk_size = old_chunk_size
+    """
+
+def iterate_with_small_read_window():
+    """
+FileIterator reads data files in large windows.  The records it
+returns are the same whatever the window size:
+
+    >>> from ZODB.utils import p64, z64
+    >>> fs = ZODB.FileStorage.FileStorage('data.fs')
+    >>> db = ZODB.DB(fs)
+    >>> conn = db.open()
+    >>> for i in range(20):
+    ...     conn.root()[i % 3] = 'x' * (i * 100)
+    ...     transaction.commit()
+    >>> db.undo(db.undoLog(0, 1)[0]['id'])
+    >>> transaction.commit()
+
+    >>> class Iterator(ZODB.FileStorage.FileIterator):
+    ...     pass
+    >>> def records(window):
+    ...     Iterator.read_window = window
+    ...     return [(t.tid, t.status, [(r.oid, r.tid, r.data, r.data_txn)
+    ...                                for r in t])
+    ...             for t in Iterator('data.fs')]
+    >>> expected = records(1 << 22)
+    >>> len(expected)
+    22
+    >>> [r[3] is not None for r in expected[-1][2]]
+    [True]
+    >>> records(50) == records(1000) == expected
+    True
+    >>> db.close()
+
+The underlying file wrapper reads like a file:
+
+    >>> from ZODB.FileStorage.format import WindowedFile
+    >>> with open('data.fs', 'rb') as f:
+    ...     data = f.read()
+    >>> f = WindowedFile(open('data.fs', 'rb'), 100)
+    >>> f.read(4) == data[:4]
+    True
+    >>> import random
+    >>> for i in range(1000):
+    ...     pos = random.randrange(len(data) + 10)
+    ...     size = random.randrange(300)
+    ...     f.seek(pos)
+    ...     if f.read(size) != data[pos:pos+size]:
+    ...         print(pos, size)
+    ...     if f.tell() != min(pos + size, max(pos, len(data))):
+    ...         print(pos, size, f.tell())
+    >>> f.seek(-8, 2)
+    >>> f.read() == data[-8:]
+    True
+    >>> f.close()
+    """
+
+def pack_gc_with_several_processes():
+    """
+Pack garbage collection can extract references using several
+processes.  The packed file is the same as when using one:
+
+    >>> import shutil
+    >>> from persistent.mapping import PersistentMapping
+    >>> from ZODB.FileStorage import fspack
+    >>> db = ZODB.DB('data.fs')
+    >>> conn = db.open()
+    >>> root = conn.root()
+    >>> for i in range(30):
+    ...     root[i] = PersistentMapping()
+    ...     root[i]['child'] = PersistentMapping(x=i)
+    ...     if i:
+    ...         root[i]['sibling'] = root[i-1]
+    ...     transaction.commit()
+    >>> for i in range(0, 30, 3):
+    ...     del root[i]
+    ...     transaction.commit()
+    >>> time.sleep(.01)
+    >>> packtime = time.time()
+    >>> time.sleep(.01)
+
+Undoing after the pack time makes back pointers to records that were
+garbage at the pack time:
+
+    >>> db.undo(db.undoLog(0, 1)[0]['id'])
+    >>> transaction.commit()
+    >>> db.close()
+
+    >>> def pack(processes):
+    ...     shutil.copyfile('data.fs', 'pack.fs')
+    ...     fs = ZODB.FileStorage.FileStorage(
+    ...         'pack.fs', pack_gc_processes=processes)
+    ...     fs.pack(packtime, ZODB.serialize.referencesf)
+    ...     fs.close()
+    ...     with open('pack.fs', 'rb') as f:
+    ...         return f.read()
+
+    >>> old_batch_size = fspack.pack_gc_batch_size
+    >>> fspack.pack_gc_batch_size = 3
+    >>> serial = pack(0)
+    >>> len(serial) < os.path.getsize('data.fs')
+    True
+    >>> pack(3) == serial
+    True
+    >>> fspack.pack_gc_batch_size = old_batch_size
+    """
+
+def pack_with_refs_sidecar():
+    """
+A file storage can record the references of the records it commits,
+so pack doesn't have to unpickle them:
+
+    >>> import shutil
+    >>> from persistent.mapping import PersistentMapping
+    >>> from ZODB.FileStorage.references import ReferencesFile
+    >>> fs = ZODB.FileStorage.FileStorage('data.fs', refs_sidecar=True)
+    >>> db = ZODB.DB(fs)
+    >>> conn = db.open()
+    >>> root = conn.root()
+    >>> for i in range(20):
+    ...     root[i] = PersistentMapping(child=PersistentMapping(x=i))
+    ...     transaction.commit()
+    >>> for i in range(0, 20, 3):
+    ...     del root[i]
+    ...     transaction.commit()
+    >>> time.sleep(.01)
+    >>> packtime = time.time()
+    >>> time.sleep(.01)
+    >>> db.undo(db.undoLog(0, 1)[0]['id'])
+    >>> transaction.commit()
+
+References are extracted in a background thread after transactions
+are committed, so commits don't wait for records to be unpickled:
+
+    >>> fs._refs_appender.flush()
+
+    >>> def check_references(name):
+    ...     refs = ReferencesFile(name + '.refs')
+    ...     with open(name, 'rb') as f:
+    ...         refs.load(f)
+    ...     it = ZODB.FileStorage.FileIterator(name)
+    ...     for t in it:
+    ...         for r in t:
+    ...             oids = refs.get(r.pos)
+    ...             if (oids is not None and
+    ...                     oids != ZODB.serialize.referencesf(r.data)):
+    ...                 print(r.pos, oids)
+    ...     it.close()
+    ...     refs.close()
+    ...     return refs.end == os.path.getsize(name)
+    >>> check_references('data.fs')
+    True
+
+Records are only unpickled if their references are missing:
+
+    >>> referencesf = ZODB.serialize.referencesf
+    >>> unpickled = []
+    >>> def counting_referencesf(data):
+    ...     unpickled.append(data)
+    ...     return referencesf(data)
+    >>> ZODB.serialize.referencesf = counting_referencesf
+
+    >>> _ = shutil.copyfile('data.fs', 'serial.fs')
+    >>> serial = ZODB.FileStorage.FileStorage('serial.fs')
+    >>> serial.pack(packtime, referencesf)
+    >>> serial.close()
+
+    >>> fs.pack(packtime, counting_referencesf)
+    >>> unpickled
+    []
+    >>> with open('data.fs', 'rb') as f, open('serial.fs', 'rb') as g:
+    ...     f.read() == g.read()
+    True
+
+The packer wrote references for the packed file, and later commits
+add to them:
+
+    >>> check_references('data.fs')
+    True
+    >>> root['new'] = PersistentMapping()
+    >>> transaction.commit()
+    >>> fs._refs_appender.flush()
+    >>> check_references('data.fs')
+    True
+
+Missing references are added when packing:
+
+    >>> db.close()
+    >>> os.remove('data.fs.refs')
+    >>> fs = ZODB.FileStorage.FileStorage('data.fs', refs_sidecar=True)
+    >>> fs.pack(time.time(), counting_referencesf)
+    >>> len(unpickled) > 0
+    True
+    >>> check_references('data.fs')
+    True
+    >>> del unpickled[:]
+    >>> fs.pack(time.time(), counting_referencesf)
+    >>> unpickled
+    []
+    >>> fs.close()
+
+Packing without recording references removes the out-of-date file:
+
+    >>> fs = ZODB.FileStorage.FileStorage('data.fs')
+    >>> db = ZODB.DB(fs)
+    >>> del db.open().root()['new']
+    >>> transaction.commit()
+    >>> db.pack()
+    >>> os.path.exists('data.fs.refs')
+    False
+    >>> db.close()
+
+    >>> ZODB.serialize.referencesf = referencesf
+    """
+
 def pack_disk_full_copyToPacktime():
     """Recover from a disk full situation by removing the `.pack` file
 
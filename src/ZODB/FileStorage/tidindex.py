@@ -0,0 +1,182 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Map transaction ids to FileStorage transaction positions.
+
+Transactions are appended to a data file in transaction id order, so
+a sorted index of their ids and positions can be kept by appending to
+it, and searched to find a transaction without reading the file.
+
+The index is kept in memory as 16-byte entries, an 8-byte transaction
+id and an 8-byte position.  It's saved alongside the ``.index`` file
+with a ``.tindex`` suffix, in a file made of:
+
+  - A 24-byte header: the magic string, "ZFST", the position in the
+    data file up to which the index is complete, the position of the
+    last transaction copied by a pack, or 0, and the number of
+    entries.
+
+  - The entries.
+
+  - A 4-byte CRC-32 checksum of the header and entries.
+"""
+import logging
+import os
+import struct
+import zlib
+
+from ZODB.FileStorage.format import TRANS_HDR
+from ZODB.FileStorage.format import TRANS_HDR_LEN
+from ZODB.utils import p64
+from ZODB.utils import u64
+
+logger = logging.getLogger(__name__)
+
+TIDS_MAGIC = b'ZFST'
+TIDS_HEADER = ">4sQQI"
+TIDS_HEADER_LEN = 24
+ENTRY_LEN = 16
+
+class TidIndex(object):
+    """A sorted index of transaction ids and positions
+
+    ``packed`` is the position of the last transaction with a packed
+    status, or 0.  Transactions before it can't be undone.
+    """
+
+    def __init__(self, data=b'', packed=0):
+        self._data = bytearray(data)
+        self.packed = packed
+
+    def __len__(self):
+        return len(self._data) // ENTRY_LEN
+
+    def append(self, tid, pos, status=' '):
+        """Add a transaction after the ones already in the index
+
+        Transactions whose ids don't increase aren't added, so they
+        have to be found by reading the file.
+        """
+        data = self._data
+        if data and tid <= data[-ENTRY_LEN:-8]:
+            return
+        data += tid + p64(pos)
+        if status == 'p':
+            self.packed = pos
+
+    def _bisect(self, tid):
+        # Return the number of the first entry with a transaction id
+        # greater than or equal to the given one.
+        data = self._data
+        lo = 0
+        hi = len(data) // ENTRY_LEN
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = mid * ENTRY_LEN
+            if data[i:i+8] < tid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, tid):
+        """Return the position of the given transaction, or None
+        """
+        i = self._bisect(tid) * ENTRY_LEN
+        data = self._data
+        if data[i:i+8] == tid:
+            return u64(data[i+8:i+ENTRY_LEN])
+
+    def find(self, tid):
+        """Return the position of the first transaction at or after tid
+
+        None is returned if there isn't one.
+        """
+        i = self._bisect(tid) * ENTRY_LEN
+        if i < len(self._data):
+            return u64(self._data[i+8:i+ENTRY_LEN])
+
+    def last(self):
+        """Return the id and position of the last transaction, or None
+        """
+        data = self._data
+        if data:
+            return bytes(data[-ENTRY_LEN:-8]), u64(data[-8:])
+
+    def truncate(self, pos):
+        """Remove the transactions at or after a file position
+        """
+        data = self._data
+        lo = 0
+        hi = len(data) // ENTRY_LEN
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = mid * ENTRY_LEN
+            if u64(data[i+8:i+ENTRY_LEN]) < pos:
+                lo = mid + 1
+            else:
+                hi = mid
+        del data[lo * ENTRY_LEN:]
+        if self.packed >= pos:
+            self.packed = 0
+
+    def scan(self, file, pos, end):
+        """Add the transactions in a file between two positions
+
+        Only the transaction headers are read.
+        """
+        while pos < end:
+            file.seek(pos)
+            h = file.read(TRANS_HDR_LEN)
+            tid, tl, status = struct.unpack(TRANS_HDR, h)[:3]
+            self.append(tid, pos, status.decode('ascii'))
+            pos += tl + 8
+
+    def save(self, name, pos):
+        """Save the index, complete up to a data file position
+        """
+        header = struct.pack(
+            TIDS_HEADER, TIDS_MAGIC, pos, self.packed, len(self))
+        checksum = zlib.crc32(header)
+        checksum = zlib.crc32(bytes(self._data), checksum) & 0xffffffff
+        tmp_name = name + '_tmp'
+        with open(tmp_name, 'wb') as f:
+            f.write(header)
+            f.write(self._data)
+            f.write(struct.pack(">I", checksum))
+        if os.path.exists(name):
+            os.remove(name)
+        os.rename(tmp_name, name)
+
+    @classmethod
+    def load(class_, name):
+        """Load a saved index
+
+        Return the index and the data file position it's complete up
+        to, or None if the file doesn't exist or is damaged.
+        """
+        if not os.path.exists(name):
+            return None
+        with open(name, 'rb') as f:
+            data = f.read()
+        if len(data) < TIDS_HEADER_LEN + 4:
+            return None
+        magic, pos, packed, count = struct.unpack(
+            TIDS_HEADER, data[:TIDS_HEADER_LEN])
+        end = TIDS_HEADER_LEN + count * ENTRY_LEN
+        if (magic != TIDS_MAGIC or len(data) != end + 4 or
+                zlib.crc32(data[:end]) & 0xffffffff !=
+                struct.unpack(">I", data[end:])[0]):
+            logger.warning("Ignoring damaged transaction index %s", name)
+            return None
+        return class_(data[TIDS_HEADER_LEN:end], packed), pos
@@ -30,6 +30,7 @@ import zope.interface
 @zope.interface.implementer(
         ZODB.interfaces.IStorage,
         ZODB.interfaces.IStorageIteration,
+        ZODB.interfaces.IMultiLoadStorage,
         )
 class MappingStorage(object):
     """In-memory storage implementation
@@ -151,6 +152,14 @@ class MappingStorage(object):
     # ZODB.interfaces.IStorage
     @ZODB.utils.locked(opened)
     def loadBefore(self, oid, tid):
+        return self._loadBefore(oid, tid)
+
+    # ZODB.interfaces.IMultiLoadStorage
+    @ZODB.utils.locked(opened)
+    def loadBeforeMany(self, oids, tid):
+        return [self._loadBefore(oid, tid) for oid in oids]
+
+    def _loadBefore(self, oid, tid):
         tid_data = self._data.get(oid)
         if tid_data:
             before = ZODB.utils.u64(tid)
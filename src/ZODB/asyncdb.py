@@ -0,0 +1,168 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Use databases from asyncio applications
+
+Database and connection operations that may wait for storages are run
+in a thread pool, and asyncio futures for their results are returned,
+so they can be awaited without blocking the event loop::
+
+    adb = AsyncDB(db)
+    async with adb.transaction() as conn:
+        root = await conn.root()
+        await conn.activate_many(list(root.values()))
+
+Each connection gets its own transaction manager, so its transaction
+doesn't depend on the thread it's used in.  A connection and its
+objects must only be used by one task at a time.  Loading the states
+of ghosts by accessing them still blocks, so objects should be loaded
+with :meth:`AsyncConnection.get` or :meth:`AsyncConnection.activate_many`
+before they're used.
+
+This module requires asyncio and concurrent.futures.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import transaction
+
+from ZODB.DB import ContextManager
+from ZODB.utils import z64
+
+class AsyncDB(object):
+    """Run a database's blocking operations in a thread pool
+
+    If an executor isn't given, a thread pool with ``max_workers``
+    threads is created, and shut down when the database is closed.
+    """
+
+    def __init__(self, db, executor=None, max_workers=4, loop=None):
+        self.db = db
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers)
+        self.executor = executor
+        self._loop = loop
+
+    def run(self, func, *args):
+        """Call a function in the thread pool, returning a future
+        """
+        loop = self._loop or asyncio.get_event_loop()
+        return loop.run_in_executor(
+            self.executor, functools.partial(func, *args))
+
+    def open(self):
+        """Open a connection, returning a future :class:`AsyncConnection`
+        """
+        return self.run(self._open)
+
+    def _open(self):
+        return AsyncConnection(self, self.db.open(
+            transaction.TransactionManager()))
+
+    def transaction(self, note=None):
+        """Return an asynchronous context manager for a transaction
+
+        A connection is opened when the context is entered.  The
+        transaction is committed and the connection closed when it's
+        exited, or the transaction is aborted if there was an error.
+        """
+        return AsyncContextManager(self, note)
+
+    def close(self):
+        """Close the database and, if it was created, the thread pool
+        """
+        self.db.close()
+        if self._own_executor:
+            self.executor.shutdown()
+
+
+class AsyncConnection(object):
+    """A database connection with methods returning asyncio futures
+
+    The underlying :class:`~ZODB.Connection.Connection` is available
+    as the ``connection`` attribute.
+    """
+
+    def __init__(self, db, connection):
+        self.db = db
+        self.connection = connection
+        self.transaction_manager = connection.transaction_manager
+
+    def get(self, oid):
+        """Return a future for the loaded object with the given oid
+        """
+        return self.db.run(self._get, oid)
+
+    def _get(self, oid):
+        obj = self.connection.get(oid)
+        obj._p_activate()
+        return obj
+
+    get_async = get
+
+    def root(self):
+        """Return a future for the loaded root object
+        """
+        return self.get(z64)
+
+    def get_many(self, oids):
+        """Return a future for the loaded objects with the given oids
+
+        See :meth:`ZODB.Connection.Connection.get_many`.
+        """
+        return self.db.run(self.connection.get_many, oids)
+
+    def activate_many(self, objects):
+        """Load the states of ghosts in the thread pool
+
+        See :meth:`ZODB.Connection.Connection.activate_many`.
+        """
+        return self.db.run(self.connection.activate_many, objects)
+
+    def commit(self):
+        """Commit the connection's transaction
+
+        The two-phase commit, including ``tpc_vote`` and
+        ``tpc_finish``, is run in the thread pool.
+        """
+        return self.db.run(self.transaction_manager.commit)
+
+    def abort(self):
+        """Abort the connection's transaction
+        """
+        return self.db.run(self.transaction_manager.abort)
+
+    def close(self):
+        """Close the connection, returning it to the database's pool
+        """
+        return self.db.run(self.connection.close)
+
+
+class AsyncContextManager(object):
+    """Asynchronous context manager returned by :meth:`AsyncDB.transaction`
+    """
+
+    def __init__(self, db, note=None):
+        self.db = db
+        self._cm = ContextManager(db.db, note)
+
+    def __aenter__(self):
+        return self.db.run(self._enter)
+
+    def _enter(self):
+        return AsyncConnection(self.db, self._cm.__enter__())
+
+    def __aexit__(self, t, v, tb):
+        return self.db.run(self._cm.__exit__, t, v, tb)
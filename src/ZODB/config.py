@@ -141,6 +141,12 @@ class ZODBDatabase(BaseConfig):
         _option('pool_timeout')
         _option('allow_implicit_cross_references', 'xrefs')
         _option('large_record_size')
+        _option('record_cache_size')
+        _option('invalidation_log_size')
+        _option('serialize_early')
+        _option('cache_snapshot')
+        _option('cache_snapshot_interval')
+        _option('warm_cache')
 
         try:
             return ZODB.DB(
@@ -199,7 +205,11 @@ class FileStorage(BaseConfig):
                 options['packer'] = getattr(m, name)
 
         for name in ('blob_dir', 'create', 'read_only', 'quota', 'pack_gc',
-                     'pack_keep_old'):
+                     'pack_keep_old', 'prefetch_cache_size', 'use_mmap',
+                     'checkpoint_transactions', 'checkpoint_size',
+                     'index_rebuild_processes', 'pack_gc_processes',
+                     'refs_sidecar', 'group_commit',
+                     'revision_index_threshold', 'revision_index_size'):
             v = getattr(config, name, self)
             if v is not self:
                 options[name] = v
@@ -38,16 +38,53 @@
 # high-order bytes when saving. On loading data, we add the leading
 # bytes back before using u64 to convert the data back to (long)
 # integers.
+#
+# Indexes are saved in a binary format made of:
+#
+#   - An 8-byte header: the magic string, "ZFSI", and a 2-byte format
+#     version followed by 2 unused bytes.
+#
+#   - The bucket data: for each prefix, in prefix order, the sorted
+#     2-byte suffixes followed by the 6-byte values, as produced by
+#     fsBucket.toString().
+#
+#   - The directory: for each prefix, in prefix order, the 6-byte
+#     prefix, the 4-byte number of entries and the 8-byte offset of the
+#     bucket data.
+#
+#   - A 36-byte trailer: the saved file position, the number of
+#     prefixes, the number of entries, the offset of the directory and
+#     a CRC-32 checksum of everything that precedes it.
+#
+# Because the suffixes and directory entries are fixed-width and sorted,
+# saved indexes can be memory mapped and searched without loading them.
+# Indexes saved as a stream of pickles, or as a single pickle by very old
+# versions, can still be loaded.
+#
+# Changes made to an index since it was saved can be appended to a
+# separate delta file as a series of records, each made of:
+#
+#   - A 24-byte header: the magic string, "ZFSD", the file positions the
+#     index was valid for before and after the changes, and the number
+#     of changes.
+#
+#   - The changes, each an 8-byte oid followed by a 6-byte value.
+#
+#   - A 4-byte CRC-32 checksum of the header and changes.
+#
+# Records are only applied if they continue from the position of the
+# index, or of the previous record, so stale or partially-written
+# records are ignored.
+import mmap
 import struct
+import zlib
 
 from BTrees.fsBTree import fsBucket
 from BTrees.OOBTree import OOBTree
 import six
 
 from ZODB._compat import INT_TYPES
-from ZODB._compat import Pickler
 from ZODB._compat import Unpickler
-from ZODB._compat import _protocol
 
 
 # convert between numbers and six-byte strings
@@ -66,6 +103,19 @@ def prefix_minus_one(s):
     num = str2num(s)
     return num2str(num - 1)
 
+BINARY_MAGIC = b'ZFSI'
+BINARY_VERSION = 1
+BINARY_HEADER = ">4sHH"
+BINARY_HEADER_LEN = 8
+DIRECTORY_ENTRY = ">6sIQ"
+DIRECTORY_ENTRY_LEN = 18
+BINARY_TRAILER = ">QQQQI"
+BINARY_TRAILER_LEN = 36
+DELTA_MAGIC = b'ZFSD'
+DELTA_HEADER = ">4sQQI"
+DELTA_HEADER_LEN = 24
+DELTA_ENTRY_LEN = 14
+
 def ensure_bytes(s):
     # on Python 3 we might pickle bytes and unpickle unicode strings
     return s.encode('ascii') if not isinstance(s, bytes) else s
@@ -108,18 +158,60 @@ class fsIndex(object):
         assert isinstance(key, bytes)
         return str2num(self._data[key[:6]][key[6:]])
 
+    def _iterbuckets(self):
+        # Return an iterator of (prefix, bucket string) in prefix order.
+        items = six.iteritems(self._data)
+        if isinstance(self._data, dict):
+            items = sorted(items)
+        for prefix, tree in items:
+            yield prefix, tree.toString()
+
     def save(self, pos, fname):
         with open(fname, 'wb') as f:
-            pickler = Pickler(f, _protocol)
-            pickler.fast = True
-            pickler.dump(pos)
-            for k, v in six.iteritems(self._data):
-                pickler.dump((k, v.toString()))
-            pickler.dump(None)
+            out = _ChecksummingWriter(f)
+            out.write(struct.pack(
+                BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION, 0))
+            directory = []
+            nentries = 0
+            for prefix, data in self._iterbuckets():
+                if not data:
+                    continue
+                n = len(data) // 8
+                directory.append(
+                    struct.pack(DIRECTORY_ENTRY, prefix, n, out.offset))
+                out.write(data)
+                nentries += n
+
+            diroffset = out.offset
+            for i in range(0, len(directory), 4096):
+                out.write(b''.join(directory[i:i+4096]))
+            out.write(struct.pack(BINARY_TRAILER[:-1],
+                                  pos, len(directory), nentries, diroffset))
+            f.write(struct.pack(">I", out.crc))
 
     @classmethod
-    def load(class_, fname):
+    def load(class_, fname, mapped=False):
+        """Load an index saved with save
+
+        Return a dictionary with the saved file position, ``pos``, and
+        the ``index``.  If ``mapped`` is true and the index was saved in
+        the binary format, the index returned is a
+        :class:`MappedfsIndex` that searches the memory-mapped file and
+        keeps changes in memory.
+        """
         with open(fname, 'rb') as f:
+            if f.read(4) == BINARY_MAGIC:
+                index_file = fsIndexFile(f)
+                if mapped:
+                    index = MappedfsIndex(index_file)
+                else:
+                    index = class_()
+                    data = index._data
+                    for prefix, bucket in index_file.iterbuckets():
+                        data[prefix] = fsBucket().fromString(bucket)
+                return dict(pos=index_file.pos, index=index)
+            f.seek(0)
+
             unpickler = Unpickler(f)
             pos = unpickler.load()
             if not isinstance(pos, INT_TYPES):
@@ -241,12 +333,14 @@ class fsIndex(object):
 
         assert tree
 
-        if key is None:
+        if key is None or smallest_prefix != key[:6]:
             smallest_suffix = tree.minKey()
         else:
             try:
                 smallest_suffix = tree.minKey(key[6:])
             except ValueError: # 'empty tree' (no suffix >= arg)
+                if smallest_prefix == b'\xff' * 6:
+                    raise
                 next_prefix = prefix_plus_one(smallest_prefix)
                 smallest_prefix = self._data.minKey(next_prefix)
                 tree = self._data[smallest_prefix]
@@ -265,12 +359,14 @@ class fsIndex(object):
 
         assert tree
 
-        if key is None:
+        if key is None or biggest_prefix != key[:6]:
             biggest_suffix = tree.maxKey()
         else:
             try:
                 biggest_suffix = tree.maxKey(key[6:])
             except ValueError: # 'empty tree' (no suffix <= arg)
+                if biggest_prefix == b'\0' * 6:
+                    raise
                 next_prefix = prefix_minus_one(biggest_prefix)
                 biggest_prefix = self._data.maxKey(next_prefix)
                 tree = self._data[biggest_prefix]
@@ -278,3 +374,348 @@ class fsIndex(object):
                 biggest_suffix = tree.maxKey()
 
         return biggest_prefix + biggest_suffix
+
+
+class _ChecksummingWriter(object):
+
+    def __init__(self, f):
+        self._write = f.write
+        self.offset = 0
+        self.crc = 0
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.offset += len(data)
+        self._write(data)
+
+
+def write_delta(f, start, end, changes):
+    """Append a record of index changes to a delta file
+
+    ``changes`` maps oids to file positions and brings an index that
+    was valid for file position ``start`` up to date for position
+    ``end``.
+    """
+    out = _ChecksummingWriter(f)
+    out.write(struct.pack(DELTA_HEADER, DELTA_MAGIC, start, end,
+                          len(changes)))
+    out.write(b''.join(oid + num2str(pos)
+                       for (oid, pos) in sorted(six.iteritems(changes))))
+    f.write(struct.pack(">I", out.crc))
+
+def apply_deltas(fname, index, pos):
+    """Apply the records in a delta file that continue from pos
+
+    Return the file position the index is valid for and the number of
+    records applied.
+    """
+    applied = 0
+    with open(fname, 'rb') as f:
+        while 1:
+            header = f.read(DELTA_HEADER_LEN)
+            if len(header) < DELTA_HEADER_LEN:
+                break
+            magic, start, end, n = struct.unpack(DELTA_HEADER, header)
+            if magic != DELTA_MAGIC:
+                break
+            data = f.read(n * DELTA_ENTRY_LEN)
+            crc = f.read(4)
+            if len(crc) < 4 or (struct.unpack(">I", crc)[0] !=
+                                zlib.crc32(data, zlib.crc32(header))
+                                & 0xffffffff):
+                break # Partially written
+            if start != pos:
+                continue # Written for some other index
+            for i in range(0, len(data), DELTA_ENTRY_LEN):
+                index[data[i:i+8]] = str2num(data[i+8:i+DELTA_ENTRY_LEN])
+            pos = end
+            applied += 1
+    return pos, applied
+
+
+def _bisect(buf, start, n, width, key):
+    # Return the index of the first of n fixed-width entries starting
+    # at start whose leading bytes are >= key.
+    lo = 0
+    hi = n
+    size = len(key)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pos = start + mid * width
+        if buf[pos:pos+size] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class fsIndexFile(object):
+    """Read-only, memory-mapped index saved in the binary format
+    """
+
+    def __init__(self, f, check=True):
+        f.seek(0, 2)
+        size = f.tell()
+        if size < BINARY_HEADER_LEN + BINARY_TRAILER_LEN:
+            raise ValueError("Truncated index file", f.name)
+        buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        magic, version, _ = struct.unpack_from(BINARY_HEADER, buf, 0)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError("Unsupported index file format", f.name)
+        (self.pos, self.nprefixes, self.nentries, self._diroffset, crc
+         ) = struct.unpack_from(BINARY_TRAILER, buf, size - BINARY_TRAILER_LEN)
+        if (self._diroffset + self.nprefixes * DIRECTORY_ENTRY_LEN
+            != size - BINARY_TRAILER_LEN):
+            raise ValueError("Corrupted index file", f.name)
+        if check:
+            computed = 0
+            end = size - 4
+            for i in range(0, end, 1 << 20):
+                computed = zlib.crc32(buf[i:min(i + (1 << 20), end)],
+                                      computed)
+            if computed & 0xffffffff != crc:
+                raise ValueError("Index file checksum mismatch", f.name)
+        self._buf = buf
+
+    def _entry(self, i):
+        # Return the prefix, number of entries and offset of bucket i
+        return struct.unpack_from(
+            DIRECTORY_ENTRY, self._buf,
+            self._diroffset + i * DIRECTORY_ENTRY_LEN)
+
+    def _find_prefix(self, prefix):
+        return _bisect(self._buf, self._diroffset, self.nprefixes,
+                       DIRECTORY_ENTRY_LEN, prefix)
+
+    def prefixes(self):
+        for i in range(self.nprefixes):
+            yield self._entry(i)[0]
+
+    def iterbuckets(self):
+        """Return an iterator of (prefix, bucket string) in prefix order
+        """
+        buf = self._buf
+        for i in range(self.nprefixes):
+            prefix, n, offset = self._entry(i)
+            yield prefix, buf[offset:offset + n * 8]
+
+    def bucket(self, prefix):
+        """Return the bucket string for a prefix, or None"""
+        i = self._find_prefix(prefix)
+        if i < self.nprefixes:
+            p, n, offset = self._entry(i)
+            if p == prefix:
+                return self._buf[offset:offset + n * 8]
+        return None
+
+    def get(self, key, default=None):
+        prefix = key[:6]
+        buf = self._buf
+        i = self._find_prefix(prefix)
+        if i < self.nprefixes:
+            p, n, offset = self._entry(i)
+            if p == prefix:
+                suffix = key[6:]
+                j = _bisect(buf, offset, n, 2, suffix)
+                if j < n and buf[offset + j * 2:offset + j * 2 + 2] == suffix:
+                    pos = offset + n * 2 + j * 6
+                    return str2num(buf[pos:pos+6])
+        return default
+
+    def _key(self, i, j):
+        # Return the jth key of bucket i, or None if j is out of range
+        prefix, n, offset = self._entry(i)
+        if j < 0:
+            j += n
+        if 0 <= j < n:
+            return prefix + self._buf[offset + j * 2:offset + j * 2 + 2]
+        return None
+
+    def minKey(self, key=None):
+        if key is None:
+            i = j = 0
+        else:
+            i = self._find_prefix(key[:6])
+            j = 0
+            if i < self.nprefixes:
+                prefix, n, offset = self._entry(i)
+                if prefix == key[:6]:
+                    j = _bisect(self._buf, offset, n, 2, key[6:])
+                    if j == n:
+                        i += 1
+                        j = 0
+        if i >= self.nprefixes:
+            raise ValueError("empty tree")
+        return self._key(i, j)
+
+    def maxKey(self, key=None):
+        if key is None:
+            i = self.nprefixes - 1
+        else:
+            i = self._find_prefix(key[:6])
+            if i < self.nprefixes:
+                prefix, n, offset = self._entry(i)
+                if prefix == key[:6]:
+                    j = _bisect(self._buf, offset, n, 2, key[6:])
+                    if j < n and self._key(i, j) == key:
+                        return key
+                    if j > 0:
+                        return self._key(i, j - 1)
+            # The answer is the last key of the previous bucket.
+            i -= 1
+        if i < 0:
+            raise ValueError("empty tree")
+        return self._key(i, -1)
+
+
+class MappedfsIndex(fsIndex):
+    """An fsIndex that searches a saved index file
+
+    Buckets are read from the file as they're first used and changes
+    are kept in an in-memory fsIndex.  The full in-memory index is only
+    built if it's needed, for example to delete keys or if the
+    ``_data`` attribute is accessed.
+    """
+
+    def __init__(self, base):
+        self._base = base
+        self._buckets = {} # {prefix -> fsBucket read from base}
+        self._delta = fsIndex()
+
+    def __getattr__(self, name):
+        if name == '_data':
+            return self._load()
+        raise AttributeError(name)
+
+    def _load(self):
+        base = self._base
+        buckets = self._buckets
+        data = OOBTree()
+        for prefix, bucket in base.iterbuckets():
+            tree = buckets.get(prefix)
+            if tree is None:
+                tree = fsBucket().fromString(bucket)
+            data[prefix] = tree
+        for prefix, tree in six.iteritems(self._delta._data):
+            bucket = data.get(prefix)
+            if bucket is None:
+                data[prefix] = tree
+            else:
+                bucket.update(tree)
+        self._data = data
+        self._base = None
+        return data
+
+    def __getitem__(self, key):
+        if self._base is None:
+            return fsIndex.__getitem__(self, key)
+        v = self.get(key)
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    def get(self, key, default=None):
+        base = self._base
+        if base is None:
+            return fsIndex.get(self, key, default)
+        v = self._delta.get(key)
+        if v is not None:
+            return v
+        prefix = key[:6]
+        tree = self._buckets.get(prefix)
+        if tree is None:
+            data = base.bucket(prefix)
+            if data is None:
+                return default
+            tree = self._buckets[prefix] = fsBucket().fromString(data)
+        v = tree.get(key[6:])
+        if v is None:
+            return default
+        return str2num(v)
+
+    def __setitem__(self, key, value):
+        if self._base is None:
+            return fsIndex.__setitem__(self, key, value)
+        self._delta[key] = value
+
+    def __delitem__(self, key):
+        if self._base is not None:
+            self._load()
+        fsIndex.__delitem__(self, key)
+
+    def __len__(self):
+        base = self._base
+        if base is None:
+            return fsIndex.__len__(self)
+        return base.nentries + sum(1 for key in self._delta
+                                   if base.get(key) is None)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        self._data = OOBTree()
+        self._base = None
+
+    def _iterbuckets(self):
+        base = self._base
+        if base is None:
+            for item in fsIndex._iterbuckets(self):
+                yield item
+            return
+
+        delta = iter(six.iteritems(self._delta._data))
+        dprefix, dtree = next(delta, (None, None))
+        for prefix, data in base.iterbuckets():
+            while dprefix is not None and dprefix < prefix:
+                yield dprefix, dtree.toString()
+                dprefix, dtree = next(delta, (None, None))
+            if prefix == dprefix:
+                bucket = fsBucket().fromString(data)
+                bucket.update(dtree)
+                data = bucket.toString()
+                dprefix, dtree = next(delta, (None, None))
+            yield prefix, data
+        while dprefix is not None:
+            yield dprefix, dtree.toString()
+            dprefix, dtree = next(delta, (None, None))
+
+    def iteritems(self):
+        if self._base is None:
+            for item in fsIndex.iteritems(self):
+                yield item
+            return
+        for prefix, data in self._iterbuckets():
+            for suffix, value in six.iteritems(fsBucket().fromString(data)):
+                yield (prefix + suffix, str2num(value))
+
+    def __iter__(self):
+        for key, _ in self.iteritems():
+            yield key
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for _, value in self.iteritems():
+            yield value
+
+    def minKey(self, key=None):
+        if self._base is None:
+            return fsIndex.minKey(self, key)
+        return self._pick(min, 'minKey', key)
+
+    def maxKey(self, key=None):
+        if self._base is None:
+            return fsIndex.maxKey(self, key)
+        return self._pick(max, 'maxKey', key)
+
+    def _pick(self, choose, name, key):
+        found = []
+        for index in self._base, self._delta:
+            try:
+                found.append(getattr(index, name)(key))
+            except ValueError:
+                pass
+        if not found:
+            raise ValueError("empty tree")
+        return choose(found)
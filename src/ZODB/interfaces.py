@@ -159,6 +159,28 @@ class IConnection(Interface):
         Raises ConnectionStateError if the connection is closed.
         """
 
+    def get_many(oids):
+        """Return the persistent objects with the given object ids.
+
+        A list of objects, in the order of the object ids, is
+        returned.  Unlike `get`, the objects are loaded, rather than
+        ghosts.  The records of objects that weren't in the cache, or
+        were ghosts, are loaded from the storage together.
+
+        Raises KeyError if an oid does not exist.
+
+        Raises ConnectionStateError if the connection is closed.
+        """
+
+    def activate_many(objects):
+        """Load the states of ghost objects of this connection.
+
+        The records of the ghosts are loaded from the storage
+        together.  Objects that aren't ghosts are left alone.
+
+        Raises ConnectionStateError if the connection is closed.
+        """
+
     def cacheMinimize():
         """Deactivate all unmodified objects in the cache.
 
@@ -871,6 +893,32 @@ class IStorage(Interface):
         """
 
 
+class IMultiLoadStorage(IStorage):
+
+    def loadBeforeMany(oids, tid):
+        """Load the object data written before a transaction id
+
+        A list with an item for each of the object ids in the given
+        sequence is returned.  Each item is what `IStorage.loadBefore`
+        would return for the object id.
+
+        If an object id isn't in the storage, then POSKeyError is
+        raised.
+        """
+
+class IMultiStoreStorage(IStorage):
+
+    def storeMany(records, transaction):
+        """Store data for several objects
+
+        The records argument is a sequence of (oid, serial, data)
+        tuples.  This is equivalent to calling `IStorage.store` for
+        each record, with an empty version, and returns None.
+
+        Storages that wrap other storages and transform the data they
+        store must implement this method if the storages they wrap do.
+        """
+
 class IPrefetchStorage(IStorage):
 
     def prefetch(oids, tid):
@@ -1234,6 +1282,16 @@ class IMVCCStorage(IStorage):
         A POSKeyError is raised if there is no record for the object id.
         """
 
+class IMVCCMultiLoadStorage(IMVCCStorage):
+
+    def load_many(oids):
+        """Load current data for the given object ids
+
+        A list of data records and serials, in the order of the object
+        ids in the given sequence, is returned, as `load` would return
+        them.
+        """
+
 class IMVCCPrefetchStorage(IMVCCStorage):
 
     def prefetch(oids):
@@ -6,10 +6,14 @@ and start time and moves it into a storage adapter.  This allows ZODB
 to treat Relstoage and other storages in pretty much the same way and
 also simplifies the implementation of the DB and Connection classes.
 """
+import itertools
+import weakref
+from collections import OrderedDict
+
 import zope.interface
 
 from . import interfaces, serialize, POSException
-from .utils import p64, u64, Lock
+from .utils import p64, u64, z64, Lock, load_before_many
 
 class Base(object):
 
@@ -37,20 +41,145 @@ class Base(object):
     def __len__(self):
         return len(self._storage)
 
+class RecordCache(object):
+    """Records loaded through MVCCAdapter instances, shared by them
+
+    Entries are keyed by oid and record tid, and hold the record data
+    and the tid of the transaction that replaced the record, or None
+    if the record is current.  The current records for the oids in
+    committed transactions are given an end tid when the adapter is
+    invalidated.  If the storage has transactions that the adapter
+    wasn't invalidated for, as when the storage is used directly, the
+    cache is cleared.  The least recently used entries are discarded
+    when the total data size exceeds the cache size.
+    """
+
+    tid = z64 # The last transaction invalidated
+
+    def __init__(self, size):
+        self.size = size
+        self.bytes = 0
+        self.generation = 0 # incremented when entries are invalidated
+        self._data = OrderedDict() # {(oid, tid) -> [data, end_tid]}
+        self._tids = {} # {oid -> set of tids}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def load(self, oid, before):
+        """Return the data and tid of a record loaded before a tid
+
+        None is returned if there isn't one in the cache.
+        """
+        with self._lock:
+            for tid in self._tids.get(oid, ()):
+                if tid < before:
+                    key = oid, tid
+                    entry = self._data[key]
+                    end = entry[1]
+                    if end is None or before <= end:
+                        del self._data[key] # Move to the end
+                        self._data[key] = entry
+                        return entry[0], tid
+
+    def store(self, oid, before, r, generation):
+        """Store the result of ``loadBefore(oid, before)``
+
+        If entries were invalidated since ``generation``, the record
+        may no longer be current, so it's only used for loads before
+        the same tid.
+        """
+        data, tid, end = r
+        with self._lock:
+            key = oid, tid
+            if key in self._data:
+                return
+            if end is None and generation != self.generation:
+                end = before
+            self._data[key] = [data, end]
+            self._tids.setdefault(oid, set()).add(tid)
+            self.bytes += len(data)
+            while self.bytes > self.size and self._data:
+                key, entry = self._data.popitem(False)
+                self._remove(key, entry)
+
+    def _remove(self, key, entry):
+        oid, tid = key
+        tids = self._tids[oid]
+        tids.remove(tid)
+        if not tids:
+            del self._tids[oid]
+        self.bytes -= len(entry[0])
+
+    def invalidate(self, tid, oids):
+        # Records current before tid are replaced by it.
+        with self._lock:
+            self.generation += 1
+            if tid > self.tid:
+                self.tid = tid
+            for oid in oids:
+                for rtid in self._tids.get(oid, ()):
+                    entry = self._data[oid, rtid]
+                    if entry[1] is None and rtid < tid:
+                        entry[1] = tid
+
+    def sync(self, tid):
+        """Note the storage's last transaction
+        """
+        if tid > self.tid:
+            with self._lock:
+                if tid > self.tid:
+                    self.tid = tid
+                    self._clear()
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self.generation += 1
+        self._data.clear()
+        self._tids.clear()
+        self.bytes = 0
+
 class MVCCAdapter(Base):
+    """Adapt an IStorage to IMVCCStorage
+
+    Invalidations are appended to a log that instances read from when
+    they're polled, so delivering them doesn't depend on the number of
+    instances.  Entries that every open instance has read are dropped.
+    When the entries hold more than `invalidation_log_size` oids, the
+    oldest are dropped until they hold half as many, and instances
+    that haven't read them invalidate their caches entirely.
+    """
 
-    def __init__(self, storage):
+    invalidation_log_size = 100000
+
+    def __init__(self, storage, record_cache_size=0,
+                 invalidation_log_size=None):
         Base.__init__(self, storage)
-        self._instances = set()
         self._lock = Lock()
+        # The sequence number of the first entry and the entries, each
+        # a tid, oids (None for all objects) and the id of the instance
+        # that committed the transaction, if any.  Entries are
+        # appended in place.  When the log is trimmed, it's replaced.
+        self._log = (0, [])
+        self._log_oids = 0 # The number of oids in the log's entries
+        self._trim_at = self._min_trim # Log length to trim read entries at
+        self._instance_ids = itertools.count(1)
+        self._instances = weakref.WeakValueDictionary() # {id -> instance}
+        if invalidation_log_size is not None:
+            self.invalidation_log_size = invalidation_log_size
+        if record_cache_size:
+            self._records = RecordCache(record_cache_size)
+        else:
+            self._records = None
         if hasattr(storage, 'registerDB'):
             storage.registerDB(self)
 
     def new_instance(self):
-        instance = MVCCAdapterInstance(self)
-        with self._lock:
-            self._instances.add(instance)
-        return instance
+        return MVCCAdapterInstance(self)
 
     def before_instance(self, before=None):
         return HistoricalStorageAdapter(self._storage, before)
@@ -58,94 +187,184 @@ class MVCCAdapter(Base):
     def undo_instance(self):
         return UndoAdapterInstance(self)
 
-    def _release(self, instance):
-        with self._lock:
-            self._instances.remove(instance)
-
     closed = False
     def close(self):
         if not self.closed:
             self.closed = True
             self._storage.close()
-            del self._instances
             del self._storage
 
-    def invalidateCache(self):
-        with self._lock:
-            for instance in self._instances:
-                instance._invalidateCache()
+    _min_trim = 100
 
-    def invalidate(self, transaction_id, oids):
+    def _append(self, tid, oids, instance_id):
         with self._lock:
-            for instance in self._instances:
-                instance._invalidate(oids)
+            start, log = self._log
+            log.append((tid, oids, instance_id))
+            self._log_oids += _entry_size(oids)
+            if (len(log) >= self._trim_at or
+                self._log_oids > self.invalidation_log_size):
+                self._trim()
+
+    def _trim(self):
+        # Drop the entries every open instance has read and, if the
+        # rest hold too many oids, the oldest of them, too.  Called
+        # with the lock held.
+        start, log = self._log
+        end = start + len(log)
+        trim = min([i._position for i in list(self._instances.values())]
+                   + [end]) - start
+        trim = max(trim, 0)
+        count = self._log_oids
+        for tid, oids, instance_id in log[:trim]:
+            count -= _entry_size(oids)
+        if count > self.invalidation_log_size:
+            target = self.invalidation_log_size // 2
+            while count > target and trim < len(log):
+                count -= _entry_size(log[trim][1])
+                trim += 1
+        if trim:
+            log = log[trim:]
+            self._log = start + trim, log
+            self._log_oids = count
+        self._trim_at = max(2 * len(log), self._min_trim)
 
-    def _invalidate_finish(self, oids, committing_instance):
-        with self._lock:
-            for instance in self._instances:
-                if instance is not committing_instance:
-                    instance._invalidate(oids)
+    def invalidateCache(self):
+        if self._records is not None:
+            self._records.clear()
+        self._append(None, None, None)
+
+    def invalidate(self, transaction_id, oids):
+        oids = frozenset(oids)
+        if self._records is not None:
+            self._records.invalidate(transaction_id, oids)
+        self._append(transaction_id, oids, None)
+
+    def _invalidate_finish(self, tid, oids, committing_instance):
+        # oids aren't changed by the committing instance afterwards.
+        if self._records is not None:
+            self._records.invalidate(tid, oids)
+        instance_id = None
+        if committing_instance is not None:
+            instance_id = committing_instance._id
+        self._append(tid, oids, instance_id)
 
     references = serialize.referencesf
     transform_record_data = untransform_record_data = lambda self, data: data
 
     def pack(self, pack_time, referencesf):
-        return self._storage.pack(pack_time, referencesf)
+        try:
+            return self._storage.pack(pack_time, referencesf)
+        finally:
+            if self._records is not None:
+                # Packing removes records without invalidations.
+                self._records.clear()
+
+def _entry_size(oids):
+    # Entries invalidating all objects count as one oid.
+    return 1 if oids is None else len(oids)
 
 class MVCCAdapterInstance(Base):
 
     _copy_methods = Base._copy_methods + (
-        'loadSerial', 'new_oid', 'tpc_vote',
+        'loadSerial', 'loadBeforeMany', 'new_oid', 'tpc_vote',
         'checkCurrentSerialInTransaction', 'tpc_abort',
         )
 
     def __init__(self, base):
         self._base = base
         Base.__init__(self, base._storage)
-        self._lock = Lock()
-        self._invalidations = set()
+        self._id = next(base._instance_ids)
+        with base._lock:
+            start, log = base._log
+            self._position = start + len(log) # of the next log entry to read
+            base._instances[self._id] = self
         self._start = None # Transaction start time
         self._sync = getattr(self._storage, 'sync', lambda : None)
 
     def release(self):
-        self._base._release(self)
+        # Released instances no longer keep log entries from being trimmed.
+        # Remove ours under the lock _trim holds while it looks at them.
+        with self._base._lock:
+            self._base._instances.pop(self._id, None)
 
     close = release
 
-    def _invalidateCache(self):
-        with self._lock:
-            self._invalidations = None
-
-    def _invalidate(self, oids):
-        with self._lock:
-            try:
-                self._invalidations.update(oids)
-            except AttributeError:
-                if self._invalidations is not None:
-                    raise
+    def _read_invalidations(self):
+        # Return the position after the log entries not yet read and
+        # the oids they invalidate, or None if all objects are.
+        start, log = self._base._log
+        end = start + len(log)
+        if self._position < start:
+            return end, None # Entries were trimmed before we read them
+        oids = set()
+        for tid, toids, instance_id in log[self._position - start:
+                                           end - start]:
+            if toids is None:
+                return end, None
+            if instance_id != self._id:
+                oids.update(toids)
+        return end, oids
+
+    @property
+    def _invalidations(self):
+        return self._read_invalidations()[1]
 
     def sync(self, force=True):
         if force:
             self._sync()
 
     def poll_invalidations(self):
-        self._start = p64(u64(self._storage.lastTransaction()) + 1)
-        with self._lock:
-            if self._invalidations is None:
-                self._invalidations = set()
-                return None
-            else:
-                result = list(self._invalidations)
-                self._invalidations.clear()
-                return result
+        last = self._storage.lastTransaction()
+        self._start = p64(u64(last) + 1)
+        if self._base._records is not None:
+            self._base._records.sync(last)
+        self._position, oids = self._read_invalidations()
+        if oids is None:
+            return None
+        return list(oids)
 
     def load(self, oid):
         assert self._start is not None
+        records = self._base._records
+        if records is not None:
+            r = records.load(oid, self._start)
+            if r is not None:
+                return r
+            generation = records.generation
         r = self._storage.loadBefore(oid, self._start)
         if r is None:
             raise POSException.ReadConflictError(repr(oid))
+        if records is not None:
+            records.store(oid, self._start, r, generation)
         return r[:2]
 
+    def load_many(self, oids):
+        assert self._start is not None
+        results = [None] * len(oids)
+        records = self._base._records
+        if records is None:
+            missing = list(range(len(oids)))
+        else:
+            missing = []
+            for i, oid in enumerate(oids):
+                r = records.load(oid, self._start)
+                if r is None:
+                    missing.append(i)
+                else:
+                    results[i] = r
+            generation = records.generation
+
+        if missing:
+            moids = [oids[i] for i in missing]
+            loaded = load_before_many(self._storage, moids, self._start)
+            for i, oid, r in zip(missing, moids, loaded):
+                if r is None:
+                    raise POSException.ReadConflictError(repr(oid))
+                if records is not None:
+                    records.store(oid, self._start, r, generation)
+                results[i] = r[:2]
+        return results
+
     def prefetch(self, oids):
         try:
             self._storage.prefetch(oids, self._start)
@@ -166,6 +385,15 @@ class MVCCAdapterInstance(Base):
         self._storage.store(oid, serial, data, version, transaction)
         self._modified.add(oid)
 
+    def storeMany(self, records, transaction):
+        storeMany = getattr(self._storage, 'storeMany', None)
+        if storeMany is None:
+            for oid, serial, data in records:
+                self.store(oid, serial, data, '', transaction)
+        else:
+            storeMany(records, transaction)
+            self._modified.update(oid for oid, _, _ in records)
+
     def storeBlob(self, oid, serial, data, blobfilename, version, transaction):
         self._storage.storeBlob(
             oid, serial, data, blobfilename, '', transaction)
@@ -176,7 +404,7 @@ class MVCCAdapterInstance(Base):
         self._modified = None
 
         def invalidate_finish(tid):
-            self._base._invalidate_finish(modified, self)
+            self._base._invalidate_finish(tid, modified, self)
             func(tid)
 
         return self._storage.tpc_finish(transaction, invalidate_finish)
@@ -222,6 +450,15 @@ class HistoricalStorageAdapter(Base):
             raise POSException.POSKeyError(oid)
         return r[:2]
 
+    def load_many(self, oids):
+        result = []
+        for oid, r in zip(oids, load_before_many(
+                self._storage, oids, self._before)):
+            if r is None:
+                raise POSException.POSKeyError(oid)
+            result.append(r[:2])
+        return result
+
 
 class UndoAdapterInstance(Base):
 
@@ -256,7 +493,7 @@ class UndoAdapterInstance(Base):
     def tpc_finish(self, transaction, func = lambda tid: None):
 
         def invalidate_finish(tid):
-            self._base._invalidate_finish(self._undone, None)
+            self._base._invalidate_finish(tid, self._undone, None)
             func(tid)
 
         self._storage.tpc_finish(transaction, invalidate_finish)
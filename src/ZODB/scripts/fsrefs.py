@@ -52,6 +52,10 @@ and directly refers to a persistent object P but there's a problem with P:
  - If P can't be loaded (but does exist in the database), a message saying
    that O refers to an object that can't be loaded is displayed.
 
+If the storage has a ``.refs`` file recording the references of its
+records, it's used to find the references of objects, and pickles
+are only examined to report problems.
+
 fsrefs also (indirectly) checks that the .index file is sane, because
 fsrefs uses the index to get its idea of what constitutes "all the objects
 in the database".
@@ -62,9 +66,11 @@ revisions of objects; therefore fsrefs cannot find problems in versions or
 in non-current revisions.
 """
 from __future__ import print_function
+import os
 import traceback
 
 from ZODB.FileStorage import FileStorage
+from ZODB.FileStorage.references import datapos
 from ZODB.TimeStamp import TimeStamp
 from ZODB.utils import u64, oid_repr, get_pickle_metadata, load_current
 from ZODB.serialize import get_refs
@@ -105,7 +111,9 @@ def main(path=None):
         path, = args
 
 
-    fs = FileStorage(path, read_only=1)
+    fs = FileStorage(path, read_only=1,
+                     refs_sidecar=os.path.exists(path + '.refs'))
+    references = fs._loaded_references()
 
     # Set of oids in the index that failed to load due to POSKeyError.
     # This is what happens if undo is applied to the transaction creating
@@ -135,6 +143,12 @@ def main(path=None):
     for oid in fs._index.keys():
         if oid in inactive:
             continue
+        if references is not None:
+            oids = references.get(datapos(fs, fs._index[oid]))
+            if oids is not None and not [
+                ref for ref in oids
+                if ref not in fs._index or ref in inactive]:
+                continue
         data, serial = load_current(fs, oid)
         refs = get_refs(data)
         missing = [] # contains 3-tuples of oid, klass-metadata, reason
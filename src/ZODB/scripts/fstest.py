@@ -77,7 +77,9 @@ def U64(v):
         return l
 
 def check(path):
-    with open(path, 'rb') as file:
+    # Use a large buffer, so seeks to nearby records don't need
+    # system calls.
+    with open(path, 'rb', 1 << 22) as file:
         file.seek(0, 2)
         file_size = file.tell()
         if file_size == 0:
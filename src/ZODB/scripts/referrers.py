@@ -19,9 +19,17 @@ $Id$
 from ZODB.serialize import referencesf
 
 def referrers(storage):
+    # File storages may have recorded the references of their records.
+    loaded_references = getattr(storage, '_loaded_references', None)
+    references = loaded_references() if loaded_references else None
     result = {}
     for transaction in storage.iterator():
         for record in transaction:
-            for oid in referencesf(record.data):
+            refs = None
+            if references is not None:
+                refs = references.get(record.pos)
+            if refs is None:
+                refs = referencesf(record.data)
+            for oid in refs:
                 result.setdefault(oid, []).append((record.oid, record.tid))
     return result
@@ -134,12 +134,14 @@ A number of legacyforms are defined:
 
 """
 import logging
+import struct
 
 from persistent import Persistent
 from persistent.wref import WeakRefMarker, WeakRef
 from ZODB import broken
 from ZODB.POSException import InvalidObjectReference
 from ZODB._compat import PersistentPickler, PersistentUnpickler, BytesIO, _protocol
+from ZODB._compat import Unpickler
 
 
 _oidtypes = bytes, type(None)
@@ -623,6 +625,243 @@ class ObjectReader(object):
         obj.__setstate__(state)
 
 
+# Scanning pickles for references
+#
+# Finding references with an unpickler's noload() means running the
+# unpickler over both pickles in a record, creating the containers
+# they describe along the way.  Instead, we can walk the opcodes,
+# keeping a stack of just the values a persistent id can be made of:
+# strings, tuples and, so they can be skipped, lists.  Everything
+# else is represented by None.  Pickles using opcodes we don't
+# handle, and pickles we can't scan, are passed to noload() instead,
+# so results and errors are the same.
+#
+# Where noload() is implemented in C, it's faster than scanning in
+# Python, so we only scan where the unpickler is written in Python,
+# as on PyPy.  See ZODB/tests/refspeed.py.
+
+_scan_pickles = hasattr(Unpickler.noload, '__code__')
+
+class _Unscannable(Exception):
+    pass
+
+_LIST = object() # stands in for lists
+_MARK = object()
+
+# Opcodes that push a value we don't care about, and their argument
+# sizes.
+_skip_push = {
+    ord(b'K'): 1,    # BININT1
+    ord(b'M'): 2,    # BININT2
+    ord(b'J'): 4,    # BININT
+    ord(b'G'): 8,    # BINFLOAT
+    ord(b'N'): 0,    # NONE
+    ord(b'\x88'): 0, # NEWTRUE
+    ord(b'\x89'): 0, # NEWFALSE
+    ord(b'}'): 0,    # EMPTY_DICT
+    ord(b'\x8f'): 0, # EMPTY_SET
+    }
+
+# Opcodes with length-prefixed string arguments and the sizes of the
+# lengths.
+_string_push = {
+    ord(b'U'): 1,    # SHORT_BINSTRING
+    ord(b'C'): 1,    # SHORT_BINBYTES
+    ord(b'\x8c'): 1, # SHORT_BINUNICODE
+    ord(b'T'): 4,    # BINSTRING
+    ord(b'B'): 4,    # BINBYTES
+    ord(b'X'): 4,    # BINUNICODE
+    ord(b'\x8e'): 8, # BINBYTES8
+    ord(b'\x8d'): 8, # BINUNICODE8
+    }
+
+# Length-prefixed arguments of opcodes that push values we don't
+# care about.
+_skip_long = {
+    ord(b'\x8a'): 1, # LONG1
+    ord(b'\x8b'): 4, # LONG4
+    }
+
+# Opcodes with newline-terminated arguments that push values we don't
+# care about.
+_skip_line = {
+    ord(b'I'): 1,    # INT
+    ord(b'L'): 1,    # LONG
+    ord(b'F'): 1,    # FLOAT
+    ord(b'V'): 1,    # UNICODE
+    ord(b'c'): 2,    # GLOBAL
+    }
+
+_unpack_length = {
+    1: None,
+    4: struct.Struct('<I').unpack_from,
+    8: struct.Struct('<Q').unpack_from,
+    }
+
+def _scan_references(p):
+    """Return the persistent ids in the two pickles of a record
+
+    Strings are returned as bytes and lists as _LIST.  None is returned
+    if the pickles can't be scanned.
+    """
+    p = bytes(p)
+    data = bytearray(p)
+    refs = []
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    marks = []
+    memo = {}
+    end = len(data)
+    pos = 0
+    stops = 0
+    try:
+        while 1:
+            op = data[pos]
+            pos += 1
+            # The most common opcodes come first.
+            if op == 0x71: # BINPUT
+                memo[data[pos]] = stack[-1]
+                pos += 1
+            elif op == 0x43 or op == 0x55: # SHORT_BINBYTES, SHORT_BINSTRING
+                n = pos + 1 + data[pos]
+                if n > end:
+                    raise _Unscannable
+                push(p[pos+1:n])
+                pos = n
+            elif op == 0x68: # BINGET
+                push(memo[data[pos]])
+                pos += 1
+            elif op == 0x86: # TUPLE2
+                stack[-2:] = [tuple(stack[-2:])]
+            elif op == 0x51: # BINPERSID
+                refs.append(stack[-1])
+                stack[-1] = None
+            elif op == 0x4b: # BININT1
+                push(None)
+                pos += 1
+            elif op == 0x28: # MARK
+                marks.append(len(stack))
+            elif op == 0x75 or op == 0x65: # SETITEMS, APPENDS
+                del stack[marks.pop():]
+            elif op == 0x73: # SETITEM
+                del stack[-2:]
+            elif op == 0x62 or op == 0x61: # BUILD, APPEND
+                pop()
+            elif op == 0x52 or op == 0x81: # REDUCE, NEWOBJ
+                stack[-2:] = [None]
+            elif op in _skip_push:
+                push(None)
+                pos += _skip_push[op]
+            elif op in _string_push:
+                size = _string_push[op]
+                if size == 1:
+                    n = data[pos]
+                else:
+                    n = _unpack_length[size](p, pos)[0]
+                pos += size
+                if pos + n > end:
+                    raise _Unscannable
+                push(p[pos:pos+n])
+                pos += n
+            elif op == 0x72: # LONG_BINPUT
+                memo[_unpack_length[4](p, pos)[0]] = stack[-1]
+                pos += 4
+            elif op == 0x6a: # LONG_BINGET
+                push(memo[_unpack_length[4](p, pos)[0]])
+                pos += 4
+            elif op == 0x94: # MEMOIZE
+                memo[len(memo)] = stack[-1]
+            elif op == 0x85: # TUPLE1
+                stack[-1] = (stack[-1], )
+            elif op == 0x87: # TUPLE3
+                stack[-3:] = [tuple(stack[-3:])]
+            elif op == 0x74: # TUPLE
+                k = marks.pop()
+                stack[k:] = [tuple(stack[k:])]
+            elif op == 0x29: # EMPTY_TUPLE
+                push(())
+            elif op == 0x5d: # EMPTY_LIST
+                push(_LIST)
+            elif op == 0x6c: # LIST
+                del stack[marks.pop():]
+                push(_LIST)
+            elif op == 0x64 or op == 0x91: # DICT, FROZENSET
+                del stack[marks.pop():]
+                push(None)
+            elif op == 0x90 or op == 0x31: # ADDITEMS, POP_MARK
+                del stack[marks.pop():]
+            elif op == 0x30: # POP
+                pop()
+            elif op == 0x92: # NEWOBJ_EX
+                stack[-3:] = [None]
+            elif op == 0x93: # STACK_GLOBAL
+                stack[-2:] = [None]
+            elif op == 0x32: # DUP
+                push(stack[-1])
+            elif op in _skip_long:
+                size = _skip_long[op]
+                if size == 1:
+                    n = data[pos]
+                else:
+                    n = _unpack_length[4](p, pos)[0]
+                push(None)
+                pos += size + n
+            elif op in _skip_line:
+                for i in range(_skip_line[op]):
+                    pos = p.index(b'\n', pos) + 1
+                push(None)
+            elif op == 0x70: # PUT
+                n = p.index(b'\n', pos)
+                memo[int(p[pos:n])] = stack[-1]
+                pos = n + 1
+            elif op == 0x67: # GET
+                n = p.index(b'\n', pos)
+                push(memo[int(p[pos:n])])
+                pos = n + 1
+            elif op == 0x50: # PERSID
+                n = p.index(b'\n', pos)
+                refs.append(p[pos:n])
+                push(None)
+                pos = n + 1
+            elif op == 0x80: # PROTO
+                pos += 1
+            elif op == 0x95: # FRAME
+                pos += 8
+            elif op == 0x2e: # STOP
+                stops += 1
+                if stops == 2:
+                    break
+                # The second pickle was written by the same pickler,
+                # so it can refer to values memoized by the first.
+                del stack[:]
+                del marks[:]
+            else:
+                # Including STRING, whose argument would need decoding,
+                # and opcodes for which noload does odd things.
+                raise _Unscannable
+    except (_Unscannable, IndexError, KeyError, ValueError, struct.error):
+        return None
+    if pos > end:
+        return None
+    return refs
+
+def _noload_references(p):
+    refs = []
+    u = PersistentUnpickler(None, refs.append, BytesIO(p))
+    u.noload()
+    u.noload()
+    return refs
+
+def _references(p):
+    # Return the persistent ids in a record's pickles.
+    refs = None
+    if _scan_pickles:
+        refs = _scan_references(p)
+    if refs is None:
+        refs = _noload_references(p)
+    return refs
+
 def referencesf(p, oids=None):
     """Return a list of object ids found in a pickle
 
@@ -633,10 +872,7 @@ def referencesf(p, oids=None):
     Weak and multi-database references are not included.
     """
 
-    refs = []
-    u = PersistentUnpickler(None, refs.append, BytesIO(p))
-    u.noload()
-    u.noload()
+    refs = _references(p)
 
     # Now we have a list of referencs.  Need to convert to list of
     # oids:
@@ -650,7 +886,7 @@ def referencesf(p, oids=None):
         elif isinstance(reference, (bytes, str)):
             oid = reference
         else:
-            assert isinstance(reference, list)
+            assert reference is _LIST or isinstance(reference, list)
             continue
 
         if not isinstance(oid, bytes):
@@ -674,10 +910,7 @@ def get_refs(a_pickle):
     klass information is None.
     """
 
-    refs = []
-    u = PersistentUnpickler(None, refs.append, BytesIO(a_pickle))
-    u.noload()
-    u.noload()
+    refs = _references(a_pickle)
 
     # Now we have a list of references.  Need to convert to list of
     # oids and class info:
@@ -688,9 +921,9 @@ def get_refs(a_pickle):
         if isinstance(reference, tuple):
             oid, klass = reference
         elif isinstance(reference, (bytes, str)):
-            data, klass = reference, None
+            oid, klass = reference, None
         else:
-            assert isinstance(reference, list)
+            assert reference is _LIST or isinstance(reference, list)
             continue
 
         if not isinstance(oid, bytes):
@@ -698,6 +931,23 @@ def get_refs(a_pickle):
             # this happens on Python 3 when all bytes in the oid are < 0x80
             oid = oid.encode('ascii')
 
+        if isinstance(klass, tuple):
+            # Old (module, name) class metadata.
+            klass = tuple(_text(name) for name in klass)
+
         result.append((oid, klass))
 
     return result
+
+if bytes is str:
+    def _text(name):
+        return name
+else:
+    def _text(name):
+        # Scanned strings are bytes, where unpickling gives text.
+        if isinstance(name, bytes):
+            try:
+                return name.decode('ascii')
+            except UnicodeDecodeError:
+                pass
+        return name
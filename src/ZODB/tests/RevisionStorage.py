@@ -169,4 +169,22 @@ class RevisionStorage(object):
         results = self._storage.loadBefore(oid2, revid2)
         eq(results, None)
 
+    def checkLoadBeforeMany(self):
+        if not hasattr(self._storage, 'loadBeforeMany'):
+            return
+        oids = [self._storage.new_oid() for i in range(5)]
+        revids = []
+        for i, oid in enumerate(oids):
+            revids.append(self._dostore(oid, data=MinPO(i)))
+        revids.append(self._dostore(oids[2], revids[2], data=MinPO(9)))
+
+        for tid in [p64(u64(revid) + 1) for revid in revids] + [revids[0]]:
+            self.assertEqual(
+                self._storage.loadBeforeMany(oids[::-1] + oids[:2], tid),
+                [self._storage.loadBefore(oid, tid)
+                 for oid in oids[::-1] + oids[:2]])
+        self.assertEqual(self._storage.loadBeforeMany([], revids[0]), [])
+        self.assertRaises(KeyError, self._storage.loadBeforeMany,
+                          [oids[0], self._storage.new_oid()], revids[-1])
+
     # TODO:  There are other edge cases to handle, including pack.
@@ -56,6 +56,10 @@ class HexStorage(object):
         else:
             return r
 
+    def loadBeforeMany(self, oids, tid):
+        return [r if r is None else (unhexlify(r[0][2:]), r[1], r[2])
+                for r in ZODB.utils.load_before_many(self.base, oids, tid)]
+
     def loadSerial(self, oid, serial):
         return unhexlify(self.base.loadSerial(oid, serial)[2:])
 
@@ -75,6 +79,16 @@ class HexStorage(object):
         return self.base.store(
             oid, serial, b'.h'+hexlify(data), version, transaction)
 
+    def storeMany(self, records, transaction):
+        records = [(oid, serial, b'.h'+hexlify(data))
+                   for oid, serial, data in records]
+        storeMany = getattr(self.base, 'storeMany', None)
+        if storeMany is None:
+            for oid, serial, data in records:
+                self.base.store(oid, serial, data, '', transaction)
+        else:
+            storeMany(records, transaction)
+
     def restore(self, oid, serial, data, version, prev_txn, transaction):
         return self.base.restore(
             oid, serial, data and (b'.h'+hexlify(data)), version, prev_txn,
@@ -130,8 +144,9 @@ class ServerHexStorage(HexStorage):
     """
 
     copied_methods = HexStorage.copied_methods + (
-        'load', 'loadBefore', 'loadSerial', 'store', 'restore',
-        'iterator', 'storeBlob', 'restoreBlob', 'record_iternext',
+        'load', 'loadBefore', 'loadBeforeMany', 'loadSerial', 'store',
+        'storeMany', 'restore', 'iterator', 'storeBlob', 'restoreBlob',
+        'record_iternext',
         )
 
 class Transaction(object):
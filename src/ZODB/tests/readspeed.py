@@ -0,0 +1,138 @@
+from __future__ import print_function
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+usage="""Measure FileStorage read latency while commits hold the storage lock
+
+A FileStorage is filled with objects that have several revisions.
+Their revisions are then read with loadSerial, getTid and history,
+first with no other activity, then while another thread commits
+transactions and holds the storage lock for a while in each commit,
+as slow commits do.
+
+Options:
+
+    -n n       The number of reads of each kind (default 1000)
+
+    -o n       The number of objects (default 100)
+
+    -r n       The number of revisions of each object (default 5)
+
+    -l ms      How long each commit holds the storage lock, in
+               milliseconds (default 10)
+"""
+
+import getopt
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from ZODB.Connection import TransactionMetaData
+from ZODB.FileStorage import FileStorage
+from ZODB.utils import p64, z64
+
+def commit(storage, records, hold=0):
+    t = TransactionMetaData()
+    storage.tpc_begin(t)
+    for oid, serial, data in records:
+        storage.store(oid, serial, data, '', t)
+    storage.tpc_vote(t)
+    if hold:
+        # Hold the storage lock, as a commit writing a lot of data does.
+        with storage._lock:
+            time.sleep(hold)
+    return storage.tpc_finish(t)
+
+def populate(storage, nobjects, nrevisions):
+    serials = dict((p64(i), [z64]) for i in range(nobjects))
+    for r in range(nrevisions):
+        tid = commit(storage, [(oid, s[-1], b'x' * 100)
+                               for oid, s in serials.items()])
+        for s in serials.values():
+            s.append(tid)
+    for s in serials.values():
+        del s[0]
+    return serials
+
+def measure(storage, serials, nrep):
+    oids = sorted(serials)
+    reads = (
+        ('loadSerial', lambda oid: storage.loadSerial(
+            oid, random.choice(serials[oid]))),
+        ('getTid', storage.getTid),
+        ('history', lambda oid: storage.history(oid, 3)),
+        )
+    for name, f in reads:
+        times = []
+        for i in range(nrep):
+            oid = random.choice(oids)
+            t = time.time()
+            f(oid)
+            times.append(time.time() - t)
+        times.sort()
+        print("  %-12s mean %8.1f  median %8.1f  max %8.1f usec" % (
+            name,
+            sum(times) * 1e6 / nrep,
+            times[nrep // 2] * 1e6,
+            times[-1] * 1e6,
+            ))
+
+def main(args):
+    opts, args = getopt.getopt(args, 'n:o:r:l:')
+    nrep = 1000
+    nobjects = 100
+    nrevisions = 5
+    hold = .01
+    for o, v in opts:
+        if o == '-n':
+            nrep = int(v)
+        elif o == '-o':
+            nobjects = int(v)
+        elif o == '-r':
+            nrevisions = int(v)
+        elif o == '-l':
+            hold = float(v) / 1000
+
+    d = tempfile.mkdtemp()
+    storage = FileStorage(os.path.join(d, 'Data.fs'))
+    try:
+        serials = populate(storage, nobjects, nrevisions)
+
+        print("No commits")
+        measure(storage, serials, nrep)
+
+        stop = threading.Event()
+        def commits():
+            oid = p64(nobjects)
+            serial = z64
+            while not stop.is_set():
+                serial = commit(storage, [(oid, serial, b'y' * 100)], hold)
+        thread = threading.Thread(target=commits)
+        thread.start()
+        try:
+            print("Commits holding the storage lock for %s ms" % (
+                hold * 1000))
+            measure(storage, serials, nrep)
+        finally:
+            stop.set()
+            thread.join()
+    finally:
+        storage.close()
+        shutil.rmtree(d)
+
+if __name__=='__main__':
+    main(sys.argv[1:])
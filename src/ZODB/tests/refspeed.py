@@ -0,0 +1,81 @@
+from __future__ import print_function
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+usage="""Compare ways of finding the references in object records
+
+Records are serialized with each pickle protocol and their references
+are found with an unpickler's noload() and by scanning pickle opcodes.
+
+Options:
+
+    -n n       The number of repetitions (default 10000)
+
+    -r n       The number of references in each record (default 50)
+"""
+
+import getopt
+import sys
+import time
+
+import persistent
+
+from ZODB import serialize
+from ZODB._compat import PersistentPickler
+from ZODB._compat import HIGHEST_PROTOCOL
+
+class P(persistent.Persistent):
+    pass
+
+def record(protocol, nrefs):
+    class Writer(serialize.ObjectWriter):
+        def __init__(self):
+            super(Writer, self).__init__()
+            self._p = PersistentPickler(
+                self.persistent_id, self._file, protocol)
+
+    ob = P()
+    ob._p_oid = b'\0' * 8
+    ob.refs = []
+    for i in range(nrefs):
+        ref = P()
+        ref._p_oid = ('%08d' % i).encode('ascii')
+        ob.refs.append(ref)
+    ob.data = dict((str(i), i) for i in range(nrefs))
+    return Writer().serialize(ob)
+
+def main(args):
+    opts, args = getopt.getopt(args, 'n:r:')
+    nrep = 10000
+    nrefs = 50
+    for o, v in opts:
+        if o == '-n':
+            nrep = int(v)
+        elif o == '-r':
+            nrefs = int(v)
+
+    for protocol in range(1, HIGHEST_PROTOCOL + 1):
+        p = record(protocol, nrefs)
+        print("protocol %s, %s bytes" % (protocol, len(p)))
+        if serialize._scan_references(p) is None:
+            print("  can't be scanned")
+        for name, f in (('noload', serialize._noload_references),
+                        ('scan', serialize._scan_references)):
+            t = time.time()
+            for i in range(nrep):
+                f(p)
+            t = time.time() - t
+            print("  %-8s %8.2f usec" % (name, t * 1e6 / nrep))
+
+if __name__=='__main__':
+    main(sys.argv[1:])
@@ -1212,6 +1212,15 @@ class ModifyOnGetStateObject(Persistent):
         self.p = self._v_p
         return Persistent.__getstate__(self)
 
+class LogOnGetstateObject(Persistent):
+
+    def __init__(self, log):
+        self._v_log = log
+
+    def __getstate__(self):
+        self._v_log.append('getstate')
+        return Persistent.__getstate__(self)
+
 
 class StubStorage(object):
     """Very simple in-memory storage that does *just* enough to support tests.
@@ -1373,6 +1382,159 @@ class TestConnection(unittest.TestCase):
 
         db.close()
 
+    def test_get_many(self):
+        from persistent.mapping import PersistentMapping
+        db = ZODB.DB(None)
+        with db.transaction() as conn:
+            for i in range(5):
+                conn.root()[i] = PersistentMapping(x=i)
+        with db.transaction() as conn:
+            oids = [conn.root()[i]._p_oid for i in range(5)]
+
+        loads = []
+        def loadBeforeMany(oids, tid):
+            loads.append(len(oids))
+            return [db.storage.loadBefore(oid, tid) for oid in oids]
+        db.storage.loadBeforeMany = loadBeforeMany
+
+        # Use a connection with an empty cache.
+        conn0 = db.open()
+        conn = db.open(transaction.TransactionManager())
+        ghost = conn.get(oids[1])
+        obs = conn.get_many(oids[2:] + oids[:3])
+        self.assertEqual([ob['x'] for ob in obs], [2, 3, 4, 0, 1, 2])
+        self.assertTrue(obs[4] is ghost)
+        self.assertEqual(loads, [5]) # the missing ones and the ghost
+        self.assertEqual([ob._p_changed for ob in obs], [False] * 6)
+        self.assertEqual(conn._load_count, 5)
+        self.assertEqual(conn._preloaded, {})
+
+        # activate_many loads the ghosts together
+        conn.cacheMinimize()
+        conn.activate_many(obs + [conn.root()])
+        self.assertEqual(loads, [5, 6])
+        self.assertEqual([ob._p_changed for ob in obs], [False] * 6)
+
+        conn.cacheMinimize()
+        conn.activate_many([])
+        self.assertEqual(loads, [5, 6])
+        self.assertRaises(KeyError, conn.get_many, [oids[0], p64(42)])
+        self.assertEqual(loads, [5, 6, 2])
+        self.assertEqual(conn._preloaded, {})
+        conn.close()
+        self.assertRaises(ZODB.POSException.ConnectionStateError,
+                          conn.get_many, oids)
+
+        # Storages without loadBeforeMany are used too.
+        del db.storage.loadBeforeMany
+        conn = db.open(transaction.TransactionManager())
+        conn.cacheMinimize()
+        obs = conn.get_many(oids)
+        self.assertEqual([ob['x'] for ob in obs], list(range(5)))
+        self.assertEqual(loads, [5, 6, 2])
+        conn.close()
+        conn0.close()
+        db.close()
+
+    def test_get_many_loads_ghosts_with_missing_objects(self):
+        from persistent.mapping import PersistentMapping
+        db = ZODB.DB(None)
+        with db.transaction() as conn:
+            for i in range(6):
+                conn.root()[i] = PersistentMapping(x=i)
+        with db.transaction() as conn:
+            oids = [conn.root()[i]._p_oid for i in range(6)]
+
+        calls = []
+        loadBefore = db.storage.loadBefore
+        def loadBeforeMany(oids, tid):
+            calls.append(sorted(oids))
+            return [loadBefore(oid, tid) for oid in oids]
+        db.storage.loadBeforeMany = loadBeforeMany
+        def counting_loadBefore(oid, tid):
+            calls.append(oid)
+            return loadBefore(oid, tid)
+
+        # Use a connection with an empty cache.
+        conn0 = db.open()
+        conn = db.open(transaction.TransactionManager())
+        ghosts = [conn.get(oid) for oid in oids[::2]]
+        self.assertEqual([ob._p_changed for ob in ghosts], [None] * 3)
+        # Only loadBeforeMany should be used from here on.
+        db.storage.loadBefore = counting_loadBefore
+        obs = conn.get_many(oids)
+        self.assertEqual([ob['x'] for ob in obs], list(range(6)))
+        self.assertEqual([obs[i] for i in (0, 2, 4)], ghosts)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0], sorted(oids))
+        self.assertEqual(conn._preloaded, {})
+        conn.close()
+        conn0.close()
+        db.close()
+
+    def test_serialize_early(self):
+        db = ZODB.DB(None, serialize_early=True)
+        log = []
+        tpc_begin = db.storage.tpc_begin
+        def logging_tpc_begin(*args):
+            log.append('tpc_begin')
+            return tpc_begin(*args)
+        db.storage.tpc_begin = logging_tpc_begin
+        store = db.storage.store
+        def logging_store(*args):
+            log.append('store')
+            return store(*args)
+        db.storage.store = logging_store
+
+        # Objects are pickled before the storage commit begins,
+        # including objects added while pickling.
+        tm = transaction.TransactionManager()
+        conn = db.open(tm)
+        self.assertTrue(conn.serialize_early)
+        conn.root.x = ModifyOnGetStateObject(StubObject())
+        conn.root.y = LogOnGetstateObject(log)
+        tm.commit()
+        self.assertEqual(log, ['getstate', 'tpc_begin'] + ['store'] * 5)
+        self.assertEqual(conn._prepared, None)
+
+        with db.transaction() as conn2:
+            self.assertTrue(isinstance(conn2.root.x.p, StubObject))
+            self.assertTrue(isinstance(conn2.root.y, LogOnGetstateObject))
+
+        # Objects are pickled during the commit with savepoints
+        del log[:]
+        conn.root.y._p_changed = True
+        tm.savepoint()
+        conn.root.y._p_changed = True
+        tm.commit()
+        self.assertEqual(log, ['getstate', 'tpc_begin', 'getstate', 'store'])
+
+        # or when the option is off.
+        del log[:]
+        conn.serialize_early = False
+        conn.root.y._p_changed = True
+        tm.commit()
+        self.assertEqual(log, ['tpc_begin', 'getstate', 'store'])
+
+        # Errors when pickling abort the transaction.
+        conn.serialize_early = True
+        conn.root.z = ErrorOnGetstateObject()
+        self.assertRaises(ErrorOnGetstateException, tm.commit)
+        tm.abort()
+        self.assertEqual(conn._prepared, None)
+        self.assertFalse('z' in conn.root())
+        conn.close()
+        db.close()
+
+        db = databaseFromString("""
+            <zodb>
+              <mappingstorage/>
+              serialize-early true
+            </zodb>
+            """)
+        self.assertTrue(db.serialize_early)
+        db.close()
+
 class StubDatabase(object):
 
     def __init__(self):
@@ -1388,6 +1550,7 @@ class StubDatabase(object):
         pass
 
     large_record_size = 1<<30
+    serialize_early = False
 
 def test_suite():
     s = unittest.makeSuite(ConnectionDotAdd)
@@ -15,6 +15,7 @@ from six import PY2
 
 from ZODB.tests.MinPO import MinPO
 import doctest
+from binascii import hexlify
 import os
 import re
 import sys
@@ -110,6 +111,87 @@ class DBTests(ZODB.tests.util.TestCase):
         check(db.undoLog(0, 3)  , True)
         check(db.undoInfo(0, 3) , True)
 
+    def test_open_affinity(self):
+        db = self.db
+        tms = [transaction.TransactionManager() for i in range(3)]
+        a = db.open(tms[0], affinity='a')
+        b = db.open(tms[1], affinity='b')
+        c = db.open(tms[2])
+        a.close()
+        b.close()
+        c.close()
+
+        # c is on top of the stack, but connections last used for a
+        # key are preferred:
+        self.assertTrue(db.open(tms[0], affinity='a') is a)
+        self.assertTrue(db.open(tms[1], affinity='b') is b)
+        # Otherwise connections are popped as usual, and remember the
+        # new key:
+        self.assertTrue(db.open(tms[2], affinity='c') is c)
+        c.close()
+        self.assertTrue(db.open(tms[2]) is c)
+        c.close()
+        self.assertTrue(db.open(tms[2], affinity='c') is c)
+
+        self.assertEqual(db.cacheAffinityDetail(), [
+            {'affinity': 'a', 'hits': 1, 'misses': 1},
+            {'affinity': 'b', 'hits': 1, 'misses': 1},
+            {'affinity': 'c', 'hits': 1, 'misses': 1},
+            ])
+        a.close()
+        b.close()
+        c.close()
+
+    def test_affinity_stats_are_bounded(self):
+        db = self.db
+        db.pool.affinity_stats_size = 3
+        tm = transaction.TransactionManager()
+        for affinity in 'abc':
+            db.open(tm, affinity=affinity).close()
+        # a and b were counted, but the connection was last opened
+        # with c.
+        db.open(tm, affinity='d').close()
+        self.assertEqual([d['affinity'] for d in db.cacheAffinityDetail()],
+                         ['c', 'd'])
+
+    def test_cache_snapshot(self):
+        from persistent.mapping import PersistentMapping
+        self.db.close()
+        db = ZODB.DB('test.fs', cache_snapshot='test.snapshot',
+                     cache_snapshot_interval=0)
+        with db.transaction() as conn:
+            for i in range(5):
+                conn.root()[i] = PersistentMapping(x=i)
+        tm = transaction.TransactionManager()
+        conn = db.open(tm)
+        conn.cacheMinimize()
+        root = conn.root()
+        root[3]['x']
+        root[1]['x']
+        expected = sorted([root._p_oid, root[3]._p_oid, root[1]._p_oid])
+        # Least recently used first:
+        oids = [oid for oid, ob in conn._cache.lru_items()]
+        self.assertEqual(sorted(oids), expected)
+        conn.close()
+        db.close()
+        with open('test.snapshot', 'rb') as f:
+            self.assertEqual(
+                f.read(),
+                b' '.join(hexlify(oid) for oid in reversed(oids)) + b'\n')
+
+        # Opening with warm_cache loads the objects into a new
+        # connection in the background:
+        self.db = db = ZODB.DB('test.fs', cache_snapshot='test.snapshot',
+                               warm_cache=True)
+        [thread, _] = db._snapshot_threads
+        thread.join()
+        [(_, conn)] = db.pool.available
+        self.assertEqual(
+            [oid for oid, ob in conn._cache.lru_items()], oids)
+        conn = db.open()
+        self.assertEqual(conn.root()[3]._p_changed, False)
+        conn.close()
+
 def test_invalidateCache():
     """The invalidateCache method invalidates a connection caches for all of
     the connections attached to a database::
@@ -106,6 +106,31 @@ class DemoStorageTests(
         self._checkHistory(base_and_changes())
         self._storage = self._storage.pop()
 
+    def checkLoadBeforeManyBaseAndChanges(self):
+        oids = [self._storage.new_oid() for i in range(4)]
+        revids = [self._dostore(oid, data=i) for i, oid in enumerate(oids)]
+        self._storage = self._storage.push()
+        revids.append(self._dostore(oids[1], revids[1], data=5))
+        oids.append(self._storage.new_oid())
+        revids.append(self._dostore(oids[-1], data=6))
+
+        loads = []
+        base = self._storage.base
+        def loadBeforeMany(oids, tid):
+            loads.append(oids)
+            return [base.loadBefore(oid, tid) for oid in oids]
+        base.loadBeforeMany = loadBeforeMany
+
+        for revid in revids:
+            tid = ZODB.utils.p64(ZODB.utils.u64(revid) + 1)
+            self.assertEqual(
+                self._storage.loadBeforeMany(oids, tid),
+                [self._storage.loadBefore(oid, tid) for oid in oids])
+            # The objects that are only in the base are loaded together.
+            self.assertEqual(loads.pop(), [oids[0], oids[2], oids[3]])
+        del base.loadBeforeMany
+        self._storage = self._storage.pop()
+
 class DemoStorageHexTests(DemoStorageTests):
 
     def setUp(self):
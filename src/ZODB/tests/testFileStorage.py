@@ -16,6 +16,8 @@ import os
 if os.environ.get('USE_ZOPE_TESTING_DOCTEST'):
     from zope.testing import doctest
 import sys
+import threading
+import time
 import unittest
 import transaction
 import ZODB.FileStorage
@@ -179,6 +181,28 @@ class FileStorageTests(
         self.open()
         self.assertEqual(self._storage._saved, 1)
 
+    def check_saved_index_is_searched_in_place(self):
+        oids = [self._storage.new_oid() for i in range(10)]
+        self._multi_store(oids, b'1')
+        self._storage.close()
+        self.open()
+        index = self._storage._index
+        if sys.platform != 'win32':
+            self.assertEqual(index.__class__.__name__, 'MappedfsIndex')
+        for oid in oids:
+            self.assertEqual(self._storage.load(oid)[0], b'1')
+
+        # New records are found, and are saved in the next index:
+        new = [self._storage.new_oid() for i in range(5)]
+        tid = self._multi_store(new, b'2')
+        self.assertEqual(len(index), 15)
+        self._storage.close()
+        self.open()
+        for oid in oids + new:
+            self.assertEqual(self._storage.load(oid)[0],
+                             b'2' if oid in new else b'1')
+        self.assertEqual(self._storage.lastTransaction(), tid)
+
     def checkStoreBumpsOid(self):
         # If .store() is handed an oid bigger than the storage knows
         # about already, it's crucial that the storage bump its notion
@@ -305,18 +329,595 @@ class FileStorageTests(
         self.assertEqual(load_current(storage, z64)[0],
                          b'foo' if fail else b'bar')
 
-    # We want to be sure that the above test detects any regression
-    # in the code it checks, because any bug here is like a time bomb: not
-    # obvious, hard to reproduce, with possible data corruption.
-    # It's even more important that FilePool.flush() is quite aggressive and
-    # we'd like to optimize it when Python gets an API to flush read buffers.
-    # Therefore, 'checkFlushAfterTruncate' is tested in turn by another unit
-    # test.
-    # On Windows, flushing explicitely is not (always?) necessary.
-    if sys.platform != 'win32':
-        def checkFlushNeededAfterTruncate(self):
-            self._storage._files.flush = lambda: None
-            self.checkFlushAfterTruncate(True)
+    def checkPrefetch(self):
+        storage = self._storage
+        oids = [storage.new_oid() for i in range(300)]
+        revid = self._multi_store(oids, b'x')
+        tid = p64(U64(storage.lastTransaction()) + 1)
+
+        storage.prefetch(iter(oids), tid)
+        self.assertEqual(len(storage._prefetched), len(oids))
+
+        # Loads are served from (and remove entries from) the cache:
+        storage._files.get = None
+        for oid in oids:
+            self.assertEqual(storage.loadBefore(oid, tid),
+                             (b'x', revid, None))
+        self.assertEqual(len(storage._prefetched), 0)
+        del storage._files.get
+
+        # Commits drop records whose end tid they'd change:
+        storage.prefetch(oids, tid)
+        revid2 = self._dostoreNP(oids[0], revid, b'y')
+        r = storage.loadBefore(oids[0], tid)
+        storage._prefetched.clear()
+        self.assertEqual(r, storage.loadBefore(oids[0], tid))
+
+        # Records for tids beyond the last transaction aren't kept:
+        storage._prefetched.clear()
+        storage.prefetch(oids, p64(U64(revid2) + 2))
+        self.assertEqual(len(storage._prefetched), 0)
+
+    def checkLoadBeforeManyUsesOneFile(self):
+        storage = self._storage
+        oids = [storage.new_oid() for i in range(10)]
+        revid = self._multi_store(oids, b'x')
+        tid = p64(U64(revid) + 1)
+        gets = []
+        get = storage._files.get
+        def counting_get(*args):
+            gets.append(args)
+            return get(*args)
+        storage._files.get = counting_get
+
+        storage.prefetch(oids[:5], tid)
+        del gets[:]
+        self.assertEqual(storage.loadBeforeMany(oids[::-1], tid),
+                         [(b'x', revid, None)] * 10)
+        self.assertEqual(gets, [(tid,)])
+        self.assertEqual(len(storage._prefetched), 0)
+
+        # Prefetched records don't need a file:
+        storage.prefetch(oids, tid)
+        del gets[:]
+        self.assertEqual(storage.loadBeforeMany(oids, tid),
+                         [(b'x', revid, None)] * 10)
+        self.assertEqual(gets, [])
+        del storage._files.get
+
+    def checkPrefetchCacheSize(self):
+        self._storage.close()
+        self.open(prefetch_cache_size=100)
+        storage = self._storage
+        oids = [storage.new_oid() for i in range(50)]
+        self._multi_store(oids, b'x' * 10)
+        tid = p64(U64(storage.lastTransaction()) + 1)
+        storage.prefetch(oids, tid)
+        self.assertTrue(0 < len(storage._prefetched) < len(oids))
+        self.assertTrue(storage._prefetched.bytes <= 100)
+        self.assertEqual(storage.loadBefore(oids[-1], tid)[0], b'x' * 10)
+
+    def checkIndexCheckpoints(self):
+        self._storage.close()
+        self.open(checkpoint_transactions=2)
+        storage = self._storage
+        oids = [storage.new_oid() for i in range(5)]
+        tids = [self._multi_store([oid], b'x') for oid in oids]
+        storage._checkpointer.flush()
+        self.assertTrue(os.path.exists('FileStorageTests.fs.index_delta'))
+
+        # A storage opened now, as it would be after a crash, uses the
+        # checkpoints and only reads the last transaction:
+        reader = ZODB.FileStorage.FileStorage('FileStorageTests.fs',
+                                              read_only=True)
+        self.assertEqual(reader._used_index, 1)
+        self.assertEqual(reader._used_deltas, 2)
+        self.assertEqual([reader.getTid(oid) for oid in oids], tids)
+        reader.close()
+
+        # Saving the index removes the checkpoints:
+        storage.close()
+        self.assertFalse(os.path.exists('FileStorageTests.fs.index_delta'))
+        self.open()
+        self.assertEqual(self._storage._used_deltas, 0)
+        self.assertEqual([self._storage.getTid(oid) for oid in oids], tids)
+
+    def checkIndexCheckpointSize(self):
+        self._storage.close()
+        self.open(checkpoint_size=1000)
+        storage = self._storage
+        oids = [storage.new_oid() for i in range(5)]
+        for oid in oids:
+            self._multi_store([oid], b'x' * 400)
+        storage._checkpointer.flush()
+
+        # After a crash, checkpoints are folded into the index:
+        fs = getattr(storage, 'base', storage)
+        fs._save_index = lambda: None
+        storage.close()
+        self.open()
+        self.assertTrue(self._storage._used_deltas > 0)
+        self.assertFalse(os.path.exists('FileStorageTests.fs.index_delta'))
+        self.assertEqual(len(self._storage), 5)
+
+    def checkIndexCheckpointsAfterCrashWithoutCheckpoints(self):
+        self._storage.close()
+
+        def commit(n, crash):
+            self.open(checkpoint_transactions=5)
+            storage = self._storage
+            for i in range(n):
+                self._multi_store([storage.new_oid()], b'x')
+            storage._checkpointer.flush()
+            if crash:
+                fs = getattr(storage, 'base', storage)
+                fs._save_index = lambda: None
+            storage.close()
+
+        commit(2, False)
+        # Too few transactions are committed for a checkpoint before
+        # a crash, so the index is saved when the storage is opened
+        # and later checkpoints start from it.
+        commit(3, True)
+        commit(10, True)
+        self.open()
+        self.assertEqual(self._storage._used_deltas, 2)
+        self.assertEqual(len(self._storage), 15)
+
+    def checkTidIndex(self):
+        storage = self._storage
+        fs = getattr(storage, 'base', storage)
+        tids = [self._multi_store([storage.new_oid()], b'x')
+                for i in range(5)]
+        it = ZODB.FileStorage.FileIterator('FileStorageTests.fs')
+        positions = [t._tpos for t in it]
+        it.close()
+        self.assertEqual([fs._tids.get(tid) for tid in tids], positions)
+        self.assertEqual(fs._tids.get(p64(U64(tids[2]) + 1)), None)
+        self.assertEqual(fs._tids.find(p64(U64(tids[2]) + 1)), positions[3])
+
+        # Iterators start at the transaction found in the index:
+        fs._tids = ZODB.FileStorage.tidindex.TidIndex()
+        for tid, pos in zip(tids, positions):
+            fs._tids.append(tid, pos)
+        it = storage.iterator(p64(U64(tids[2]) + 1))
+        self.assertEqual([t.tid for t in it], tids[3:])
+        it.close()
+
+        # The index is saved with the storage's index and restored
+        # when it's opened:
+        storage.close()
+        self.assertTrue(os.path.exists('FileStorageTests.fs.tindex'))
+        self.open()
+        fs = getattr(self._storage, 'base', self._storage)
+        self.assertEqual([fs._tids.get(tid) for tid in tids], positions)
+
+        # Transactions committed since it was saved are added:
+        fs._save_index = lambda: None
+        tids.append(self._multi_store([self._storage.new_oid()], b'x'))
+        self._storage.close()
+        self.open()
+        fs = getattr(self._storage, 'base', self._storage)
+        self.assertEqual(fs._used_index, 1)
+        self.assertEqual(len(fs._tids), 6)
+        self.assertEqual(fs._tids.last()[0], tids[-1])
+        self.assertEqual(fs._txn_find(tids[-1], 1), fs._tids.last()[1])
+
+        # A damaged index is rebuilt when it's needed:
+        self._storage.close()
+        with open('FileStorageTests.fs.tindex', 'r+b') as f:
+            f.seek(24)
+            f.write(b'\1' * 8)
+        self.open()
+        fs = getattr(self._storage, 'base', self._storage)
+        self.assertEqual(fs._tids, None)
+        self.assertEqual([fs._txn_find(tid, 1) for tid in tids[:5]],
+                         positions)
+        self.assertEqual(len(fs._tids), 6)
+
+    def checkTidIndexRebuiltAfterPack(self):
+        db = DB(self._storage)
+        with db.transaction() as conn:
+            conn.root.y = util.P()
+        with db.transaction() as conn:
+            conn.root.x = 1
+        db.pack()
+        fs = getattr(self._storage, 'base', self._storage)
+        self.assertEqual(fs._tids, None)
+        with db.transaction() as conn:
+            conn.root.x = 2
+        self.assertEqual(fs._tids, None)
+
+        # Undo builds the index:
+        info = db.undoInfo()
+        self.assertEqual(len(info), 1)
+        db.undo(info[0]['id'])
+        transaction.commit()
+        it = ZODB.FileStorage.FileIterator('FileStorageTests.fs')
+        transactions = [(t.tid, t._tpos, t.status) for t in it]
+        it.close()
+        self.assertEqual(len(transactions), 4)
+        self.assertEqual([(tid, fs._tids.get(tid))
+                          for tid, pos, status in transactions],
+                         [(tid, pos) for tid, pos, status in transactions])
+        self.assertEqual([status for tid, pos, status in transactions],
+                         ['p', 'p', ' ', ' '])
+        self.assertEqual(fs._tids.packed, transactions[1][1])
+
+        # Transactions before the last packed one can't be undone:
+        self.assertRaises(POSException.UndoError, fs._txn_find,
+                          transactions[0][0], 1)
+        self.assertEqual(fs._txn_find(transactions[0][0], 0), 4)
+        self.assertEqual(fs._txn_find(transactions[1][0], 1),
+                         transactions[1][1])
+        db.close()
+
+    def checkRevisionIndex(self):
+        self._storage.close()
+        self.open(revision_index_threshold=3)
+        storage = self._storage
+        fs = getattr(storage, 'base', storage)
+        revisions = fs._revisions
+        oid = storage.new_oid()
+        tids = []
+        revid = z64
+        for i in range(10):
+            revid = self._dostore(oid, revid, data=i)
+            tids.append(revid)
+        before = tids + [p64(U64(tid) + 1) for tid in tids]
+
+        # Results without the index:
+        fs._revisions = None
+        expected = [storage.loadBefore(oid, tid) for tid in before]
+        serials = [storage.loadSerial(oid, tid) for tid in tids]
+        fs._revisions = revisions
+
+        # Loads that follow few back pointers don't index the object:
+        self.assertEqual(storage.loadBefore(oid, tids[-1]), expected[9])
+        self.assertEqual(len(revisions), 0)
+        self.assertEqual(storage.loadBefore(oid, tids[5]), expected[5])
+        self.assertEqual(len(revisions), 1)
+
+        # Indexed revisions are found by reading one record:
+        reads = []
+        read_data_header = fs._read_data_header
+        def counting_read_data_header(pos, *args):
+            reads.append(pos)
+            return read_data_header(pos, *args)
+        fs._read_data_header = counting_read_data_header
+        self.assertEqual([storage.loadBefore(oid, tid) for tid in before],
+                         expected)
+        self.assertEqual([storage.loadSerial(oid, tid) for tid in tids],
+                         serials)
+        self.assertRaises(POSException.POSKeyError,
+                          storage.loadSerial, oid, before[-2])
+        self.assertEqual(len(reads), 9 + 10 + 10)
+        del fs._read_data_header
+
+        # Commits add revisions:
+        revid = self._dostore(oid, revid, data=10)
+        self.assertEqual(storage.loadBefore(oid, revid)[1:],
+                         (tids[-1], revid))
+        self.assertEqual(storage.loadBefore(oid, p64(U64(revid) + 1))[1:],
+                         (revid, None))
+        self.assertEqual(revisions.serial(oid, revid),
+                         fs._lookup_pos(oid))
+
+        # Packing changes positions, so the index is cleared:
+        storage.pack(time.time(), lambda p: [], gc=False)
+        self.assertEqual(len(revisions), 0)
+
+    def checkRevisionIndexSize(self):
+        from ZODB.FileStorage.FileStorage import RevisionIndex
+        revisions = RevisionIndex(3, 5)
+        index = {p64(1): 30, p64(2): 40}
+        revisions.add(p64(1), [p64(1), p64(2), p64(3)], [10, 20, 30],
+                      index.get)
+        revisions.add(p64(2), [p64(1), p64(2)], [35, 40], index.get)
+        self.assertEqual(revisions.revisions, 5)
+
+        # When there are too many revisions, those of the least
+        # recently used objects are discarded:
+        self.assertEqual(revisions.before(p64(1), p64(2)), (10, p64(2)))
+        revisions.committed(p64(4), {p64(1): 50})
+        self.assertEqual(list(revisions._data), [p64(1)])
+        self.assertEqual(revisions.revisions, 4)
+
+        # Transactions committed before an object was indexed aren't
+        # added again:
+        revisions.committed(p64(4), {p64(1): 50})
+        self.assertEqual(revisions._data[p64(1)],
+                         ([p64(1), p64(2), p64(3), p64(4)], [10, 20, 30, 50]))
+        self.assertEqual(revisions.revisions, 4)
+
+    def _multi_store(self, oids, data):
+        t = TransactionMetaData()
+        self._storage.tpc_begin(t)
+        for oid in oids:
+            self._storage.store(oid, z64, data, '', t)
+        self._storage.tpc_vote(t)
+        return self._storage.tpc_finish(t)
+
+    def checkStoreMany(self):
+        storage = self._storage
+        oids = [storage.new_oid() for i in range(5)]
+        revid = self._multi_store(oids[:3], b'x')
+
+        t = TransactionMetaData()
+        storage.tpc_begin(t)
+        storage.storeMany([(oids[2], revid, b'y'), (oids[0], revid, b'y'),
+                           (oids[4], z64, b'z'), (oids[3], z64, b'z')], t)
+        storage.storeMany([], t)
+        storage.tpc_vote(t)
+        revid2 = storage.tpc_finish(t)
+        self.assertEqual([load_current(storage, oid) for oid in oids],
+                         [(b'y', revid2), (b'x', revid), (b'y', revid2),
+                          (b'z', revid2), (b'z', revid2)])
+        self.assertEqual(storage.loadBefore(oids[0], revid2),
+                         (b'x', revid, revid2))
+
+        # Records with old serials are conflicts unless they're resolved:
+        t = TransactionMetaData()
+        storage.tpc_begin(t)
+        self.assertRaises(POSException.ConflictError, storage.storeMany,
+                          [(oids[1], revid, b'w'), (oids[0], revid, b'w')], t)
+        storage.tpc_abort(t)
+        self.assertRaises(POSException.StorageTransactionError,
+                          storage.storeMany, [(oids[1], revid, b'w')], t)
+
+    def checkStoreManyUsedByConnections(self):
+        db = DB(self._storage)
+        calls = []
+        storeMany = self._storage.storeMany
+        def counting_storeMany(records, transaction):
+            calls.append(len(records))
+            return storeMany(records, transaction)
+        self._storage.storeMany = counting_storeMany
+        with db.transaction() as conn:
+            conn.root.x = [util.P() for i in range(10)]
+        self.assertEqual(calls, [11])
+        with db.transaction() as conn:
+            self.assertEqual(len(conn.root.x), 10)
+        db.close()
+
+    def checkFlushNeededAfterTruncate(self):
+        # Read buffers only cover committed data, so readers never see
+        # data from aborted transactions, even without flushing.
+        self._storage._files.flush = lambda: None
+        self.checkFlushAfterTruncate()
+
+    def checkReadersDontBlockCommits(self):
+        storage = self._storage
+        revid = self._dostoreNP(z64, data=b'a')
+        with storage._files.get() as f:
+            # A reader is out, but commits and aborts don't wait for it.
+            revid2 = self._dostoreNP(z64, revid, b'b')
+            t = TransactionMetaData()
+            storage.tpc_begin(t)
+            storage.store(z64, revid2, b'c', '', t)
+            storage.tpc_vote(t)
+            storage.tpc_abort(t)
+            self.assertEqual(load_current(storage, z64), (b'b', revid2))
+        self.assertEqual(load_current(storage, z64), (b'b', revid2))
+
+        # While a transaction is finished, loads of earlier data don't
+        # wait for it.
+        t = TransactionMetaData()
+        storage.tpc_begin(t)
+        storage.store(z64, revid2, b'd', '', t)
+        storage.tpc_vote(t)
+        loaded = []
+        storage.tpc_finish(
+            t, lambda tid: loaded.append(storage.loadBefore(z64, tid)))
+        self.assertEqual(loaded, [(b'b', revid2, None)])
+
+    def checkReadersDontWaitForStorageLock(self):
+        storage = self._storage
+        fs = getattr(storage, 'base', storage)
+        revid = self._dostoreNP(z64, data=b'a')
+        revid2 = self._dostoreNP(z64, revid, b'b')
+        expected = (
+            storage.loadSerial(z64, revid),
+            storage.getTid(z64),
+            [d['tid'] for d in storage.history(z64, 2)],
+            )
+
+        # Another thread holds the storage lock, as while committing,
+        # but readers use files from the pool and don't wait for it.
+        locked = threading.Event()
+        release = threading.Event()
+        def hold_lock():
+            with fs._lock:
+                locked.set()
+                release.wait(30)
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        results = []
+        def read():
+            results.append((storage.loadSerial(z64, revid),
+                            storage.getTid(z64),
+                            [d['tid'] for d in storage.history(z64, 2)],
+                            ))
+            results.append(storage.loadSerial(z64, revid2))
+        reader = threading.Thread(target=read)
+        try:
+            self.assertTrue(locked.wait(30))
+            reader.start()
+            reader.join(5)
+            # The reads finished while the lock was still held.
+            self.assertFalse(reader.is_alive())
+            self.assertFalse(release.is_set())
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(results, [expected, b'b'])
+            self.assertEqual(expected, (b'a', revid2, [revid2, revid]))
+        finally:
+            release.set()
+            thread.join(30)
+            reader.join(30)
+
+class FileStorageMMapTests(FileStorageTests):
+
+    def open(self, **kwargs):
+        kwargs.setdefault('use_mmap', True)
+        FileStorageTests.open(self, **kwargs)
+
+    def checkMappingFollowsCommits(self):
+        storage = self._storage
+        self.assertEqual(storage._files.size, storage._pos)
+        revid = self._dostore(z64)
+        self.assertEqual(storage._files.size, storage._pos)
+        revid = self._dostoreNP(z64, revid, b'x' * 1000)
+        self.assertEqual(len(storage._files._mapping()), storage._pos)
+        self.assertEqual(load_current(storage, z64)[1], revid)
+
+    def checkReadsOfRecordsCommittedAfterMapping(self):
+        # A transaction is committed after readers get their mappings,
+        # but before they look up records in the index.
+        storage = self._storage
+        revid = self._dostoreNP(z64, data=b'x')
+        revids = []
+        def commit_then_lookup(oid):
+            revids.append(self._dostoreNP(z64, revids[-1], b'x' * 1000))
+            return ZODB.FileStorage.FileStorage._lookup_pos(storage, oid)
+        storage._lookup_pos = commit_then_lookup
+        reads = [
+            lambda: storage.load(z64),
+            lambda: storage.loadBefore(z64, p64(U64(revids[-1]) + 1)),
+            lambda: storage.getTid(z64),
+            lambda: storage.loadSerial(z64, revids[-1]),
+            lambda: storage.history(z64, 2),
+            ]
+        for read in reads:
+            revids.append(revid)
+            read()
+            revid = revids[-1]
+        del storage._lookup_pos
+        self.assertEqual(storage.getTid(z64), revid)
+
+    def checkReadersFollowConcurrentCommits(self):
+        # Records committed after a reader got its mapping, but
+        # before it looked them up in the index, can be read.
+        storage = self._storage
+        revid = self._dostoreNP(z64, data=b'x')
+        stop = threading.Event()
+        errors = []
+        def read():
+            while not stop.is_set():
+                try:
+                    storage.load(z64)
+                    storage.getTid(z64)
+                    storage.history(z64)
+                    load_current(storage, z64)
+                except Exception as e:
+                    errors.append(e)
+                    break
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        try:
+            for i in range(100):
+                revid = self._dostoreNP(z64, revid, b'x' * 100)
+                if errors:
+                    break
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join(30)
+        self.assertEqual(errors, [])
+
+class FileStorageGroupCommitTests(FileStorageTests):
+
+    def open(self, **kwargs):
+        kwargs.setdefault('group_commit', True)
+        FileStorageTests.open(self, **kwargs)
+
+    def checkCommitsShareSyncs(self):
+        storage = self._storage
+        oids = [storage.new_oid() for i in range(4)]
+        syncs = []
+        proceed = threading.Event()
+        def fsync(fileno):
+            syncs.append(storage.lastTransaction())
+            proceed.wait(30)
+        finished = []
+        def commit(oid):
+            finished.append(self._dostoreNP(oid, data=b'x'))
+        def wait_for_requests(n):
+            for i in range(3000):
+                if storage._group_sync._requested == n:
+                    break
+                time.sleep(.01)
+            self.assertEqual(storage._group_sync._requested, n)
+
+        module = sys.modules['ZODB.FileStorage.FileStorage']
+        fsync_orig = module.fsync
+        module.fsync = fsync
+        try:
+            threads = [threading.Thread(target=commit, args=(oid,))
+                       for oid in oids]
+            last = storage.lastTransaction()
+            threads[0].start()
+            wait_for_requests(1)
+            # While the first commit's data are synced, others commit
+            # and wait for the next sync.
+            for thread in threads[1:]:
+                thread.start()
+            wait_for_requests(4)
+            self.assertEqual(finished, [])
+            self.assertEqual(len(syncs), 1)
+            # Nothing is published before it's synced.
+            self.assertEqual(storage.lastTransaction(), last)
+            for oid in oids:
+                self.assertRaises(POSException.POSKeyError, storage.getTid, oid)
+            proceed.set()
+            for thread in threads:
+                thread.join(30)
+        finally:
+            module.fsync = fsync_orig
+
+        self.assertEqual(len(finished), 4)
+        self.assertEqual(syncs[0], last)
+        self.assertTrue(syncs[1] < max(finished))
+        self.assertEqual(storage.lastTransaction(), max(finished))
+        self.assertEqual(len(syncs), 2)
+        self.assertEqual(storage._group_sync.syncs, 2)
+        for oid in oids:
+            self.assertEqual(load_current(storage, oid)[0], b'x')
+
+    def checkUnsyncedCommitsConflict(self):
+        # Transactions written while earlier ones wait to be synced
+        # see their changes, though readers don't.
+        storage = self._storage
+        oid = storage.new_oid()
+        revid = self._dostoreNP(oid, data=b'x')
+        proceed = threading.Event()
+        module = sys.modules['ZODB.FileStorage.FileStorage']
+        fsync_orig = module.fsync
+        module.fsync = lambda fileno: proceed.wait(30)
+        finished = []
+        thread = threading.Thread(target=lambda: finished.append(
+            self._dostoreNP(oid, revid, data=b'y')))
+        try:
+            thread.start()
+            for i in range(3000):
+                if storage._group_sync._requested:
+                    break
+                time.sleep(.01)
+            self.assertEqual(storage.getTid(oid), revid)
+            self.assertRaises(POSException.ConflictError,
+                              self._dostoreNP, oid, revid, data=b'z')
+            t = TransactionMetaData()
+            storage.tpc_begin(t)
+            self.assertRaises(POSException.ReadConflictError,
+                              storage.checkCurrentSerialInTransaction,
+                              oid, revid, t)
+            storage.tpc_abort(t)
+        finally:
+            proceed.set()
+            thread.join(30)
+            module.fsync = fsync_orig
+
+        self.assertEqual(load_current(storage, oid), (b'y', finished[0]))
 
 class FileStorageHexTests(FileStorageTests):
 
@@ -705,7 +1306,8 @@ def readonly_open_nonexistent_file():
 def test_suite():
     suite = unittest.TestSuite()
     for klass in [
-        FileStorageTests, FileStorageHexTests,
+        FileStorageTests, FileStorageHexTests, FileStorageMMapTests,
+        FileStorageGroupCommitTests,
         Corruption.FileStorageCorruptTests,
         FileStorageRecoveryTest, FileStorageHexRecoveryTest,
         FileStorageNoRestoreRecoveryTest,
@@ -16,6 +16,7 @@ import sys
 import unittest
 
 from persistent import Persistent
+from persistent.mapping import PersistentMapping
 from persistent.wref import WeakRef
 
 import zope.testing.setupstack
@@ -23,6 +24,7 @@ import zope.testing.setupstack
 import ZODB.tests.util
 from ZODB import serialize
 from ZODB._compat import Pickler, PersistentUnpickler, BytesIO, _protocol, IS_JYTHON
+from ZODB._compat import PersistentPickler
 
 class PersistentObject(Persistent):
     pass
@@ -145,6 +147,64 @@ class SerializerTestCase(unittest.TestCase):
 
         self.assertEqual(refs, [['w', (b'abcd',)]])
 
+    def _record_pickles(self, protocol):
+        # Records with strong, weak and class-less references, pickled
+        # with the given protocol.
+        class Writer(serialize.ObjectWriter):
+            def __init__(self):
+                super(Writer, self).__init__()
+                self._p = PersistentPickler(
+                    self.persistent_id, self._file, protocol)
+
+        objects = []
+        for i in range(5):
+            o = PersistentObject()
+            o._p_oid = ('%08d' % i).encode('ascii')
+            objects.append(o)
+        newargs = ClassWithNewargs(1)
+        top = PersistentObject()
+        top._p_oid = b'\x80' * 8
+        top.refs = objects[1:] + objects[1:] # memoized the second time
+        top.weak = WeakRef(objects[0])
+        top.data = {'x': [1, 2.5, b'y', u'z', None, True, 1 << 70]}
+        top.mapping = PersistentMapping(a=objects[2])
+        top.mapping._p_oid = b'\x90' * 8
+        empty = PersistentObject()
+        empty._p_oid = b'\xa0' * 8
+        return [Writer().serialize(ob)
+                for ob in (top, top.mapping, empty, objects[3])]
+
+    def test_scan_references(self):
+        # Scanning opcodes finds the same references as noload.
+        for protocol in range(1, _protocol + 1):
+            for p in self._record_pickles(protocol):
+                refs = serialize._scan_references(p)
+                self.assertEqual(
+                    refs,
+                    [serialize._LIST if isinstance(r, list) else r
+                     for r in serialize._noload_references(p)])
+
+    def test_referencesf_scanning(self):
+        scan_pickles = serialize._scan_pickles
+        try:
+            for p in self._record_pickles(_protocol):
+                serialize._scan_pickles = False
+                expected = (serialize.referencesf(p), serialize.get_refs(p))
+                serialize._scan_pickles = True
+                self.assertEqual(
+                    (serialize.referencesf(p), serialize.get_refs(p)),
+                    expected)
+        finally:
+            serialize._scan_pickles = scan_pickles
+
+    def test_scan_references_falls_back_to_noload(self):
+        # Pickles that can't be scanned are left to noload, so errors
+        # are the same.
+        p = self._record_pickles(_protocol)[0]
+        for bad in (p[:-1], p[:len(p) // 2], b'S\'x\'\n.' + p):
+            self.assertEqual(serialize._scan_references(bad), None)
+        self.assertRaises(Exception, serialize.referencesf, p[:-1])
+
 
 class SerializerFunctestCase(unittest.TestCase):
 
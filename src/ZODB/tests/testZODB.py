@@ -122,6 +122,30 @@ class ZODBTests(ZODB.tests.util.TestCase):
     def checkExportImportAborted(self):
         self.checkExportImport(abort_it=True)
 
+    def checkExportInBatches(self):
+        # Records are written in the same order however many are
+        # loaded at once.
+        self.populate()
+        conn = self._db.open()
+        ob = conn.root()['test']
+        progress = []
+        f1 = conn.exportFile(ob._p_oid, batch_size=1)
+        f2 = conn.exportFile(ob._p_oid, batch_size=30,
+                             progress=progress.append)
+        self.assertEqual(progress, [1, 31, 61, 91, 101])
+        f1.seek(0)
+        f2.seek(0)
+        self.assertEqual(f1.read(), f2.read())
+        f1.close()
+
+        f2.seek(0)
+        new_ob = conn.importFile(f2)
+        f2.close()
+        self.assertEqual(sorted((k, v[0]) for k, v in new_ob.items()),
+                         sorted((k, v[0]) for k, v in ob.items()))
+        transaction.abort()
+        conn.close()
+
     def checkResetCache(self):
         # The cache size after a reset should be 0.  Note that
         # _resetCache is not a public API, but the resetCaches()
@@ -0,0 +1,137 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+import sys
+import threading
+import unittest
+
+import transaction
+from persistent.mapping import PersistentMapping
+
+import ZODB
+
+try:
+    import asyncio
+    from ZODB.asyncdb import AsyncDB
+except ImportError:
+    asyncio = None
+
+class AsyncDBTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.adb = AsyncDB(ZODB.DB(None), loop=self.loop)
+        self.threads = []
+        loadBefore = self.adb.db.storage.loadBefore
+        def load(oid, tid):
+            self.threads.append(threading.current_thread())
+            return loadBefore(oid, tid)
+        self.adb.db.storage.loadBefore = load
+
+    def tearDown(self):
+        self.adb.close()
+        self.loop.close()
+
+    def run_(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_open_get_and_commit(self):
+        conn = self.run_(self.adb.open())
+        root = self.run_(conn.root())
+        self.assertFalse(root._p_changed)
+        root['x'] = PersistentMapping(a=1)
+        self.run_(conn.commit())
+        oid = root['x']._p_oid
+        self.run_(conn.close())
+
+        conn = self.run_(self.adb.open())
+        conn.connection.cacheMinimize()
+        del self.threads[:]
+        x = self.run_(conn.get_async(oid))
+        self.assertEqual(x._p_changed, False)
+        self.assertEqual(x['a'], 1)
+        # Loads are made in the thread pool, not the loop's thread:
+        self.assertTrue(self.threads)
+        self.assertNotIn(threading.current_thread(), self.threads)
+
+        root = self.run_(conn.root())
+        conn.connection.cacheMinimize()
+        [x] = self.run_(conn.get_many([oid]))
+        self.assertEqual(x['a'], 1)
+        conn.connection.cacheMinimize()
+        self.run_(conn.activate_many([root, x]))
+        self.assertFalse(root._p_changed or x._p_changed)
+
+        x['a'] = 2
+        self.run_(conn.abort())
+        self.assertEqual(x['a'], 1)
+        self.run_(conn.close())
+
+    def test_connections_have_own_transactions(self):
+        conn1 = self.run_(self.adb.open())
+        conn2 = self.run_(self.adb.open())
+        self.assertFalse(
+            conn1.transaction_manager is conn2.transaction_manager)
+        self.assertFalse(conn1.transaction_manager is transaction.manager)
+        self.run_(conn1.root())['x'] = 1
+        self.run_(conn1.commit())
+        self.run_(conn2.abort())
+        self.assertEqual(self.run_(conn2.root())['x'], 1)
+        self.run_(conn1.close())
+        self.run_(conn2.close())
+
+    def test_transaction(self):
+        cm = self.adb.transaction('test')
+        conn = self.run_(cm.__aenter__())
+        self.run_(conn.root())['x'] = 1
+        self.assertFalse(self.run_(cm.__aexit__(None, None, None)))
+        self.assertTrue(conn.connection.opened is None)
+        self.assertEqual(
+            self.adb.db.history(ZODB.utils.z64)[0]['description'], 'test')
+
+        cm = self.adb.transaction()
+        conn = self.run_(cm.__aenter__())
+        self.run_(conn.root())['x'] = 2
+        try:
+            raise ValueError
+        except ValueError:
+            self.assertFalse(self.run_(cm.__aexit__(*sys.exc_info())))
+
+        with self.adb.db.transaction() as conn:
+            self.assertEqual(conn.root.x, 1)
+
+if sys.version_info >= (3, 5):
+    # Only compiled for versions with the async syntax.
+    exec(compile('''
+def test_async_with(self):
+    with self.adb.db.transaction() as conn:
+        conn.root.x = PersistentMapping()
+        conn.root.y = PersistentMapping()
+    async def add(key, value):
+        async with self.adb.transaction() as conn:
+            root = await conn.root()
+            await conn.activate_many([root[key]])
+            root[key]['a'] = value
+    async def both():
+        await asyncio.gather(add('x', 1), add('y', 2))
+    self.run_(both())
+    with self.adb.db.transaction() as conn:
+        self.assertEqual((conn.root.x['a'], conn.root.y['a']), (1, 2))
+''', __file__, 'exec'))
+    AsyncDBTests.test_async_with = test_async_with
+    del test_async_with
+
+def test_suite():
+    if asyncio is None:
+        return unittest.TestSuite()
+    return unittest.makeSuite(AsyncDBTests)
@@ -0,0 +1,139 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+import threading
+import unittest
+
+import ZODB
+import ZODB.config
+
+from ZODB.MappingStorage import MappingStorage
+from ZODB.mvccadapter import MVCCAdapter
+from ZODB.utils import p64
+
+class InvalidationLogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = MVCCAdapter(MappingStorage())
+
+    def tearDown(self):
+        self.adapter.close()
+
+    def test_poll_invalidations(self):
+        adapter = self.adapter
+        adapter.invalidate(p64(1), [p64(1)])
+        instance1 = adapter.new_instance()
+        instance2 = adapter.new_instance()
+        # Instances only see invalidations made after they're created.
+        self.assertEqual(instance1.poll_invalidations(), [])
+
+        adapter.invalidate(p64(2), {p64(2): 1, p64(3): 1})
+        adapter._invalidate_finish(p64(3), set([p64(4)]), instance1)
+        self.assertEqual(sorted(instance1.poll_invalidations()),
+                         [p64(2), p64(3)])
+        self.assertEqual(instance1.poll_invalidations(), [])
+        self.assertEqual(sorted(instance2._invalidations),
+                         [p64(2), p64(3), p64(4)])
+        self.assertEqual(sorted(instance2.poll_invalidations()),
+                         [p64(2), p64(3), p64(4)])
+
+        adapter.invalidate(p64(4), [p64(5)])
+        adapter.invalidateCache()
+        adapter.invalidate(p64(5), [p64(6)])
+        self.assertEqual(instance1.poll_invalidations(), None)
+        self.assertEqual(instance1.poll_invalidations(), [])
+
+    def test_read_entries_are_trimmed(self):
+        adapter = self.adapter
+        instance1 = adapter.new_instance()
+        instance2 = adapter.new_instance()
+        for i in range(adapter._min_trim):
+            adapter.invalidate(p64(i + 1), [p64(i)])
+        # Entries are kept until every open instance has read them.
+        self.assertEqual(len(adapter._log[1]), adapter._min_trim)
+        instance1.poll_invalidations()
+        adapter.invalidate(p64(101), [p64(100)])
+        self.assertEqual(len(adapter._log[1]), adapter._min_trim + 1)
+
+        # An idle instance, however far behind, gets exact invalidations.
+        self.assertEqual(sorted(instance2.poll_invalidations()),
+                         [p64(i) for i in range(101)])
+        for i in range(101, 2 * adapter._min_trim + 2):
+            adapter.invalidate(p64(i + 1), [p64(i)])
+        # The log is trimmed to the slowest instance, instance1.
+        self.assertEqual(adapter._log[0], 100)
+
+        # Released instances don't keep entries.
+        instance1.release()
+        instance2.release()
+        for i in range(2 * adapter._min_trim + 2, 4 * adapter._min_trim + 4):
+            adapter.invalidate(p64(i + 1), [p64(i)])
+        self.assertTrue(len(adapter._log[1]) < adapter._min_trim)
+        self.assertEqual(adapter._log_oids, len(adapter._log[1]))
+
+    def test_release_waits_for_trim(self):
+        # Instances are released under the lock held while the log
+        # is trimmed, so trimming never sees them change.
+        adapter = self.adapter
+        instance = adapter.new_instance()
+        thread = threading.Thread(target=instance.release)
+        with adapter._lock:
+            thread.start()
+            thread.join(.1)
+            self.assertTrue(thread.is_alive())
+            self.assertTrue(instance._id in adapter._instances)
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(instance._id in adapter._instances)
+
+    def test_trimmed_log(self):
+        adapter = self.adapter
+        adapter.invalidation_log_size = 10
+        instance1 = adapter.new_instance()
+        instance2 = adapter.new_instance()
+        for i in range(5):
+            adapter.invalidate(p64(i + 1), [p64(2 * i), p64(2 * i + 1)])
+            self.assertEqual(len(instance1.poll_invalidations()), 2)
+        self.assertEqual(len(adapter._log[1]), 5)
+        self.assertEqual(adapter._log_oids, 10)
+
+        # When the entries hold too many oids, the oldest are dropped
+        # until they hold half as many, so instances that haven't read
+        # them invalidate their caches.
+        adapter.invalidate(p64(6), [p64(10)])
+        self.assertEqual(adapter._log[0], 3)
+        self.assertEqual(adapter._log_oids, 5)
+        self.assertEqual(sorted(instance1.poll_invalidations()), [p64(10)])
+        self.assertEqual(instance2.poll_invalidations(), None)
+        self.assertEqual(instance2.poll_invalidations(), [])
+
+    def test_invalidation_log_size_option(self):
+        adapter = MVCCAdapter(MappingStorage(), invalidation_log_size=42)
+        self.assertEqual(adapter.invalidation_log_size, 42)
+        adapter.close()
+        db = ZODB.config.databaseFromString("""
+            <zodb>
+              <mappingstorage/>
+              invalidation-log-size 42
+            </zodb>
+            """)
+        self.assertEqual(db._mvcc_storage.invalidation_log_size, 42)
+        db.close()
+        db = ZODB.DB(None)
+        self.assertEqual(db._mvcc_storage.invalidation_log_size,
+                         MVCCAdapter.invalidation_log_size)
+        db.close()
+
+
+def test_suite():
+    return unittest.makeSuite(InvalidationLogTests)
@@ -0,0 +1,156 @@
+##############################################################################
+#
+# Copyright (c) Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+import unittest
+
+import transaction
+from persistent.mapping import PersistentMapping
+
+import ZODB
+import ZODB.config
+from ZODB.mvccadapter import RecordCache
+from ZODB.utils import p64, z64
+
+class RecordCacheTests(unittest.TestCase):
+
+    def test_load_and_store(self):
+        cache = RecordCache(100)
+        self.assertEqual(cache.load(z64, p64(5)), None)
+        cache.store(z64, p64(5), (b'x', p64(2), None), cache.generation)
+        self.assertEqual(cache.load(z64, p64(3)), (b'x', p64(2)))
+        self.assertEqual(cache.load(z64, p64(9)), (b'x', p64(2)))
+        self.assertEqual(cache.load(z64, p64(2)), None)
+
+        # Invalidation ends current records:
+        cache.invalidate(p64(6), [z64])
+        self.assertEqual(cache.load(z64, p64(6)), (b'x', p64(2)))
+        self.assertEqual(cache.load(z64, p64(7)), None)
+        cache.store(z64, p64(7), (b'y', p64(6), None), cache.generation)
+        self.assertEqual(cache.load(z64, p64(7)), (b'y', p64(6)))
+        self.assertEqual(cache.load(z64, p64(5)), (b'x', p64(2)))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.bytes, 2)
+
+        cache.clear()
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+    def test_store_after_invalidation(self):
+        # Records loaded while other records are invalidated may no
+        # longer be current, so they're only used for the same tids.
+        cache = RecordCache(100)
+        generation = cache.generation
+        cache.invalidate(p64(6), [p64(1)])
+        cache.store(z64, p64(5), (b'x', p64(2), None), generation)
+        self.assertEqual(cache.load(z64, p64(5)), (b'x', p64(2)))
+        self.assertEqual(cache.load(z64, p64(6)), None)
+
+    def test_sync(self):
+        # Transactions the cache wasn't told about clear it.
+        cache = RecordCache(100)
+        cache.store(z64, p64(5), (b'x', p64(2), None), cache.generation)
+        cache.invalidate(p64(4), [p64(1)])
+        cache.sync(p64(4))
+        self.assertEqual(len(cache), 1)
+        cache.sync(p64(5))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.tid, p64(5))
+
+    def test_size(self):
+        cache = RecordCache(25)
+        for i in range(5):
+            cache.store(p64(i), p64(9), (b'x' * 10, p64(1), None), 0)
+            cache.load(p64(0), p64(9)) # Keep using the first record
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.bytes, 20)
+        self.assertEqual(cache.load(p64(0), p64(9)), (b'x' * 10, p64(1)))
+        self.assertEqual(cache.load(p64(4), p64(9)), (b'x' * 10, p64(1)))
+
+
+class DBRecordCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = ZODB.DB(None, record_cache_size=1<<20)
+        self.loads = []
+        loadBefore = self.db.storage.loadBefore
+        def load(oid, tid):
+            self.loads.append(oid)
+            return loadBefore(oid, tid)
+        self.db.storage.loadBefore = load
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_connections_share_records(self):
+        with self.db.transaction() as conn:
+            conn.root.x = PersistentMapping(a=1)
+        del self.loads[:]
+
+        tm1 = transaction.TransactionManager()
+        tm2 = transaction.TransactionManager()
+        conn1 = self.db.open(tm1)
+        conn1.cacheMinimize()
+        conn2 = self.db.open(tm2)
+        self.assertEqual(conn1.root.x['a'], 1)
+        self.assertEqual(len(self.loads), 2)
+        self.assertEqual(conn2.root.x['a'], 1)
+        self.assertEqual(len(self.loads), 2)
+
+        # Commits invalidate the records they change, but connections
+        # viewing earlier data still get it from the cache.
+        conn1.root.x['a'] = 2
+        tm1.commit()
+        conn2.cacheMinimize()
+        self.assertEqual(conn2.root.x['a'], 1)
+        self.assertEqual(len(self.loads), 2)
+        tm2.abort()
+        self.assertEqual(conn2.root.x['a'], 2)
+        self.assertEqual(len(self.loads), 3)
+
+        conn1.close()
+        conn2.close()
+
+    def test_invalidateCache(self):
+        with self.db.transaction() as conn:
+            conn.root.x = 1
+        conn = self.db.open()
+        conn.cacheMinimize()
+        conn.root.x
+        conn.close()
+        records = self.db._mvcc_storage._records
+        self.assertTrue(len(records))
+        self.db._mvcc_storage.invalidateCache()
+        self.assertEqual(len(records), 0)
+
+    def test_config(self):
+        db = ZODB.config.databaseFromString("""
+            <zodb>
+              <mappingstorage/>
+              record-cache-size 10MB
+            </zodb>
+            """)
+        self.assertEqual(db._mvcc_storage._records.size, 10<<20)
+        db.close()
+        db = ZODB.config.databaseFromString("""
+            <zodb>
+              <mappingstorage/>
+            </zodb>
+            """)
+        self.assertEqual(db._mvcc_storage._records, None)
+        db.close()
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(RecordCacheTests),
+        unittest.makeSuite(DBRecordCacheTests),
+        ))
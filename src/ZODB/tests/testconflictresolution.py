@@ -29,12 +29,14 @@ def setUp(test):
     zope.testing.module.setUp(test, 'ConflictResolution_txt')
     ZODB.ConflictResolution._class_cache.clear()
     ZODB.ConflictResolution._unresolvable.clear()
+    ZODB.ConflictResolution._resolvers.clear()
 
 def tearDown(test):
     zope.testing.module.tearDown(test)
     ZODB.tests.util.tearDown(test)
     ZODB.ConflictResolution._class_cache.clear()
     ZODB.ConflictResolution._unresolvable.clear()
+    ZODB.ConflictResolution._resolvers.clear()
 
 
 class ResolveableWhenStateDoesNotChange(persistent.Persistent):
@@ -313,6 +315,100 @@ And load the pickle:
     """
 
 
+class Counter(persistent.Persistent):
+
+    value = 0
+
+    def __getstate__(self):
+        return self.value
+
+    def __setstate__(self, state):
+        self.value = state
+
+    def _p_resolveConflict(self, old, committed, new):
+        return committed + new - old
+
+def cache_states_of_committed_revisions():
+    """
+    Objects like counters conflict again and again with the same
+    committed revisions, so their unpickled states are cached, and
+    storages count resolution attempts and outcomes:
+
+    >>> db = ZODB.DB('t.fs') # FileStorage!
+    >>> storage = db.storage
+    >>> conn = db.open()
+    >>> conn.root.x = Counter()
+    >>> transaction.commit()
+    >>> serial0 = conn.root.x._p_serial
+    >>> conn.root.x.value = 1
+    >>> transaction.commit()
+    >>> serial1 = conn.root.x._p_serial
+    >>> oid = conn.root.x._p_oid
+
+    >>> def new(value):
+    ...     conn.root.x.value = value
+    ...     transaction.commit()
+    ...     return storage.loadSerial(oid, conn.root.x._p_serial)
+
+    >>> p = storage.tryToResolveConflict(oid, serial1, serial0, new(2))
+    >>> conn._reader.getState(p)
+    3
+    >>> p = storage.tryToResolveConflict(oid, serial1, serial0, new(5))
+    >>> conn._reader.getState(p)
+    6
+
+    >>> stats = storage.conflictResolutionStats()
+    >>> stats['attempts'], stats['resolved'], stats['failed']
+    (2, 2, 0)
+    >>> stats['state_hits'], stats['state_misses']
+    (2, 2)
+
+    States that resolvers could change aren't cached:
+
+    >>> conn.root.y = ResolveableWhenStateDoesNotChange()
+    >>> conn.root.y.v = 1
+    >>> transaction.commit()
+    >>> serial = conn.root.y._p_serial
+    >>> for i in range(2):
+    ...     p = storage.tryToResolveConflict(
+    ...         conn.root.y._p_oid, serial, serial,
+    ...         storage.loadSerial(conn.root.y._p_oid, serial))
+    >>> stats = storage.conflictResolutionStats()
+    >>> stats['state_hits'], stats['state_misses']
+    (2, 6)
+    >>> len(storage._crs_states)
+    2
+
+    Failures are counted, including those of objects that don't
+    support conflict resolution:
+
+    >>> conn.root.z = Unresolvable()
+    >>> transaction.commit()
+    >>> serial = conn.root.z._p_serial
+    >>> storage.tryToResolveConflict(
+    ...     conn.root.z._p_oid, serial, serial,
+    ...     storage.loadSerial(conn.root.z._p_oid, serial))
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ConflictError: database conflict error (oid 0x03, ...
+    >>> stats = storage.conflictResolutionStats()
+    >>> stats['attempts'], stats['resolved'], stats['failed']
+    (5, 4, 1)
+    >>> stats['unresolvable']
+    1
+
+    The number of states kept is limited:
+
+    >>> storage._crs_states.clear()
+    >>> storage._crs_states.size = 1
+    >>> p = storage.tryToResolveConflict(oid, serial1, serial0, new(2))
+    >>> len(storage._crs_states)
+    1
+
+    >>> db.close()
+    """
+
 class FailHard(persistent.Persistent):
 
     def _p_resolveConflict(self, old, committed, new):
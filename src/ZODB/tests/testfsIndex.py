@@ -194,6 +194,38 @@ class Test(unittest.TestCase):
         self.assertEqual(index.minKey(b), c)
         self.assertRaises(ValueError, index.minKey, d)
 
+class MappedTest(Test):
+
+    def setUp(self):
+        Test.setUp(self)
+        setUp(self)
+        self.index.save(0, 'index')
+        self.index = fsIndex.load('index', mapped=True)['index']
+        self.assertEqual(self.index.__class__.__name__, 'MappedfsIndex')
+
+    def tearDown(self):
+        del self.index
+        tearDown(self)
+
+    def testFindsKeysInBothFileAndMemory(self):
+        index = self.index
+        index[p64(1)] = 2
+        index[p64(1<<40)] = 3
+        self.assertEqual(
+            index.items()[:3],
+            [(z64, 1), (p64(1), 2), (p64(1000), 1001)])
+        self.assertEqual(index.minKey(p64(1)), p64(1))
+        self.assertEqual(index.minKey(p64(2)), p64(1000))
+        self.assertEqual(index.maxKey(), p64(1<<40))
+        self.assertEqual(index.maxKey(p64(1<<39)), p64(199000))
+        self.assertEqual(len(index), 202)
+
+        # Using _data loads everything:
+        self.assertEqual(len(index._data), 5)
+        self.assertEqual(index._base, None)
+        self.assertEqual(len(index), 202)
+        self.assertEqual(index[p64(1<<40)], 3)
+
 def fsIndex_save_and_load():
     """
 fsIndex objects now have save methods for saving them to disk in a new
@@ -218,10 +250,57 @@ Note that we pass a file position, which gets saved with the index data.
     >>> info['index'].__getstate__() == index.__getstate__()
     True
 
-If we save the data in the old format, we can still read it:
-
+The data are saved in a binary format that can be searched without
+loading it.  Pass mapped=True to get an index that does this:
+
+    >>> info = fsIndex.load('index', mapped=True)
+    >>> mapped = info['index']
+    >>> mapped.__class__.__name__
+    'MappedfsIndex'
+    >>> mapped[p64(1<<15)], mapped.get(p64(1)), p64(1<<16) in mapped
+    (32768, None, True)
+    >>> len(mapped), mapped.minKey(p64(1)) == p64(1<<15)
+    (8192, True)
+
+Changes are kept in memory and saved along with the mapped data:
+
+    >>> mapped[p64(1)] = 1
+    >>> mapped[p64(1<<15)] = 2
+    >>> len(mapped), mapped[p64(1)], mapped[p64(1<<15)]
+    (8193, 1, 2)
+    >>> mapped.save(43, 'index2')
+    >>> info = fsIndex.load('index2')
+    >>> info['pos'], len(info['index']), info['index'][p64(1<<15)]
+    (43, 8193, 2)
+
+Binary index files are checksummed:
+
+    >>> with open('index', 'r+b') as fp:
+    ...     _ = fp.seek(100)
+    ...     _ = fp.write(b'x')
+    >>> fsIndex.load('index')
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Index file checksum mismatch', 'index')
+
+If we save the data in the older formats, a stream of pickles, or a
+single pickle, we can still read it:
+
+    >>> from ZODB._compat import Pickler
     >>> from ZODB._compat import dump
     >>> from ZODB._compat import _protocol
+    >>> with open('old', 'wb') as fp:
+    ...     pickler = Pickler(fp, _protocol)
+    ...     pickler.dump(42)
+    ...     for k, v in six.iteritems(index._data):
+    ...         pickler.dump((k, v.toString()))
+    ...     pickler.dump(None)
+    >>> info = fsIndex.load('old', mapped=True)
+    >>> info['pos']
+    42
+    >>> info['index'].__getstate__() == index.__getstate__()
+    True
+
     >>> with open('old', 'wb') as fp:
     ...     dump(dict(pos=42, index=index), fp, _protocol)
     >>> info = fsIndex.load('old')
@@ -232,8 +311,52 @@ If we save the data in the old format, we can still read it:
 
     """
 
+def fsIndex_deltas():
+    """
+Changes to an index can be appended to a delta file, along with the
+file positions the index was valid for before and after the changes:
+
+    >>> from ZODB.fsIndex import apply_deltas, write_delta
+    >>> with open('delta', 'wb') as fp:
+    ...     write_delta(fp, 100, 200, {p64(1): 150, p64(2): 160})
+    ...     write_delta(fp, 200, 300, {p64(1): 250})
+
+The changes are applied to an index when they continue from its
+position:
+
+    >>> index = fsIndex({p64(1): 50})
+    >>> apply_deltas('delta', index, 100)
+    (300, 2)
+    >>> index.items() == [(p64(1), 250), (p64(2), 160)]
+    True
+
+    >>> index = fsIndex({p64(1): 50})
+    >>> apply_deltas('delta', index, 200)
+    (300, 1)
+    >>> index.items() == [(p64(1), 250)]
+    True
+
+    >>> apply_deltas('delta', index, 42)
+    (42, 0)
+
+Records that weren't completely written are ignored:
+
+    >>> with open('delta', 'ab') as fp:
+    ...     write_delta(fp, 300, 400, {p64(3): 350})
+    >>> with open('delta', 'rb') as fp:
+    ...     data = fp.read()
+    >>> with open('delta', 'wb') as fp:
+    ...     _ = fp.write(data[:-1])
+    >>> index = fsIndex()
+    >>> apply_deltas('delta', index, 100)
+    (300, 2)
+    >>> p64(3) in index
+    False
+    """
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(Test))
+    suite.addTest(unittest.makeSuite(MappedTest))
     suite.addTest(doctest.DocTestSuite(setUp=setUp, tearDown=tearDown))
     return suite
@@ -376,3 +376,14 @@ def load_current(storage, oid, version=''):
         raise ZODB.POSException.POSKeyError(oid)
     assert r[2] is None
     return r[:2]
+
+def load_before_many(storage, oids, tid):
+    """Load the records for several objects written before a tid
+
+    The storage's ``loadBeforeMany`` method is used if it has one.
+    Otherwise, ``loadBefore`` is called for each object id.
+    """
+    loadBeforeMany = getattr(storage, 'loadBeforeMany', None)
+    if loadBeforeMany is None:
+        return [storage.loadBefore(oid, tid) for oid in oids]
+    return loadBeforeMany(oids, tid)